@@ -0,0 +1,68 @@
+"""
+checkpoint_test.py
+
+Checks that a run resumed from a checkpoint (sim.saveCheckpoint() / sim.loadCheckpoint()) gives the same spikes, traces
+and stim spikes as the same run without interruption, using the HHTut network.
+
+Usage: python checkpoint_test.py  (runs each stage in a separate process, and compares the outputs)
+
+Contributors: salvadordura@gmail.com
+"""
+
+import os
+import sys
+import subprocess
+import cPickle as pk
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'HHTut'))
+
+duration = 200  # ms
+checkpointTime = 100  # ms
+
+
+def runStage (stage):
+    ''' Runs one stage: 'full' (whole run), 'checkpoint' (run until checkpointTime and save checkpoint) or 'resume'
+        (load checkpoint and run until end); saves simData of stage to checkpoint_test_<stage>.pkl '''
+    import HHTut
+    from netpyne import sim
+
+    netParams, simConfig = HHTut.netParams, HHTut.simConfig
+    netParams.popParams['PYR']['numCells'] = 20
+    simConfig.duration = checkpointTime if stage == 'checkpoint' else duration
+    simConfig.recordCells = [0, 1]
+    simConfig.filename = 'checkpoint_test'
+    simConfig.analysis = {}
+
+    sim.create(netParams=netParams, simConfig=simConfig)
+    if stage == 'resume': sim.loadCheckpoint()
+    sim.runSim()
+    if stage == 'checkpoint': sim.saveCheckpoint()
+    sim.gatherData()
+
+    simData = {'spkt': list(sim.allSimData['spkt']), 'spkid': list(sim.allSimData['spkid']),
+               'Vsoma': {cell: list(trace) for cell, trace in sim.allSimData['Vsoma'].iteritems()},
+               'stims': {cell: {stim: list(spikes) for stim, spikes in stims.iteritems()} for cell, stims in sim.allSimData['stims'].iteritems()}}
+    with open('checkpoint_test_%s.pkl' % (stage), 'wb') as fileObj:
+        pk.dump(simData, fileObj)
+
+
+def compare ():
+    with open('checkpoint_test_full.pkl', 'rb') as fileObj: full = pk.load(fileObj)
+    with open('checkpoint_test_resume.pkl', 'rb') as fileObj: resume = pk.load(fileObj)
+    failed = [key for key in full if full[key] != resume[key]]
+    for key in failed:
+        print('  %s differs between full run and run resumed from checkpoint' % (key))
+    for cell in full['Vsoma']:
+        if len(full['Vsoma'][cell]) != len(resume['Vsoma'][cell]):
+            print('  Vsoma of %s has %d samples in full run, but %d in resumed run' % (cell, len(full['Vsoma'][cell]), len(resume['Vsoma'][cell])))
+    print('Checkpoint test %s' % ('FAILED' if failed else 'passed'))
+    return not failed
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        runStage(sys.argv[1])
+    else:
+        for stage in ['full', 'checkpoint', 'resume']:
+            subprocess.check_call([sys.executable, os.path.abspath(__file__), stage])
+        sys.exit(0 if compare() else 1)
@@ -130,7 +130,9 @@ class Cell (object):
         for key, params in sim.cfg.recordTraces.iteritems():
             try:
                 ptr = None
+                recSec = None  # section of recorded variable (required to record from the right thread in multithreaded sims)
                 if 'loc' in params:
+                    recSec = self.secs[params['sec']]['hSec']
                     if 'mech' in params:  # eg. soma(0.5).hh._ref_gna
                         ptr = self.secs[params['sec']]['hSec'](params['loc']).__getattribute__(params['mech']).__getattribute__('_ref_'+params['var'])
                     elif 'synMech' in params:  # eg. soma(0.5).AMPA._ref_g
@@ -145,30 +147,37 @@ class Cell (object):
                         synMechs = [synMech for synMech in sec['synMechs'] if synMech['label']==params['synMech']]
                         ptr = [synMech['hSyn'].__getattribute__('_ref_'+params['var']) for synMech in synMechs]
                         secLocs = [params.sec+str(synMech['loc']) for synMech in synMechs]
+                        recSecs = [sec['hSec']]*len(synMechs)
                     else: 
                         ptr = []
                         secLocs = []
+                        recSecs = []
                         for secName,sec in self.secs.iteritems():
                             synMechs = [synMech for synMech in sec['synMechs'] if synMech['label']==params['synMech']]
                             ptr.extend([synMech['hSyn'].__getattribute__('_ref_'+params['var']) for synMech in synMechs])
                             secLocs.extend([secName+'_'+str(synMech['loc']) for synMech in synMechs])
+                            recSecs.extend([sec['hSec']]*len(synMechs))
 
                 else:
                     if 'pointp' in params: # eg. soma.izh._ref_u
                         if params['pointp'] in self.secs[params['sec']]['pointps']:
                             ptr = self.secs[params['sec']]['pointps'][params['pointp']]['hPointp'].__getattribute__('_ref_'+params['var'])
+                            recSec = self.secs[params['sec']]['hSec']
                     elif 'var' in params: # point process cell eg. cell._ref_v
                         ptr = self.hPointp.__getattribute__('_ref_'+params['var'])
 
                 if ptr:  # if pointer has been created, then setup recording
                     if isinstance(ptr, list):
                         sim.simData[key]['cell_'+str(self.gid)] = {}
-                        for ptrItem,secLoc in zip(ptr, secLocs):
+                        for ptrItem,secLoc,recSecItem in zip(ptr, secLocs, recSecs):
                             sim.simData[key]['cell_'+str(self.gid)][secLoc] = h.Vector(sim.cfg.duration/sim.cfg.recordStep+1).resize(0)
-                            sim.simData[key]['cell_'+str(self.gid)][secLoc].record(ptrItem, sim.cfg.recordStep)
+                            sim.simData[key]['cell_'+str(self.gid)][secLoc].record(ptrItem, sim.cfg.recordStep, sec=recSecItem)
                     else:
                         sim.simData[key]['cell_'+str(self.gid)] = h.Vector(sim.cfg.duration/sim.cfg.recordStep+1).resize(0)
-                        sim.simData[key]['cell_'+str(self.gid)].record(ptr, sim.cfg.recordStep)
+                        if recSec is not None:
+                            sim.simData[key]['cell_'+str(self.gid)].record(ptr, sim.cfg.recordStep, sec=recSec)
+                        else:  # artificial cells (run in thread 0)
+                            sim.simData[key]['cell_'+str(self.gid)].record(ptr, sim.cfg.recordStep)
                     if sim.cfg.verbose: print '  Recording ', key, 'from cell ', self.gid, ' with parameters: ',str(params)
             except:
                 if sim.cfg.verbose: print '  Cannot record ', key, 'from cell ', self.gid
@@ -465,15 +474,20 @@ class CompartCell (Cell):
            
 
     # Create NEURON objs for conns and syns if included in prop (used when loading)
-    def addConnsNEURONObj(self):
+    def addConnsNEURONObj(self, conns=None):
         # Note: loading connections to point process (eg. Izhi2007a) not yet supported
         # Note: assumes weight is in index 0 (netcon.weight[0])
         # assumes python structure exists
-        for conn in self.conns:
+        # conns: subset of self.conns to create NEURON objs for (default: all)
+        # index synMechs and NetStims once, instead of searching lists for each conn
+        synMechs = {(secLabel, synMech['label'], synMech['loc']): synMech for secLabel, sec in self.secs.iteritems() for synMech in sec.get('synMechs', [])}
+        netStims = {stim['source']: stim['hNetStim'] for stim in self.stims if stim.get('type') == 'NetStim' and stim.get('hNetStim')}
+        for conn in (self.conns if conns is None else conns):
             # set postsyn target
-            synMech = next((synMech for synMech in self.secs[conn['sec']]['synMechs'] if synMech['label']==conn['synMech'] and synMech['loc']==conn['loc']), None)
+            synMech = synMechs.get((conn['sec'], conn['synMech'], conn['loc']))
             if not synMech: 
                 synMech = self.addSynMech(conn['synMech'], conn['sec'], conn['loc'])
+                synMechs[(conn['sec'], conn['synMech'], conn['loc'])] = synMech
                 #continue  # go to next conn
             try:
                 postTarget = synMech['hSyn']
@@ -485,7 +499,7 @@ class CompartCell (Cell):
 
             # create NetCon
             if conn['preGid'] == 'NetStim':
-                netstim = next((stim['hNetStim'] for stim in self.stims if stim['source']==conn['preLabel']), None)
+                netstim = netStims.get(conn['preLabel'])
                 if netstim:
                     netcon = h.NetCon(netstim, postTarget)
                 else: continue
@@ -1402,6 +1416,31 @@ class PointCell (Cell):
                     (preGid, self.gid, sec, loc, params['synMech'], weights[i], delays[i],params['threshold']))
 
 
+    # Create NEURON objs for stims and conns (used when loading)
+    def addStimsNEURONObj (self):
+        for stimParams in self.stims:
+            if stimParams['type'] == 'NetStim':
+                self.addNetStim(stimParams, stimContainer=stimParams)
+
+
+    def addConnsNEURONObj (self, conns=None):
+        postTarget = self.hPointp.__getattribute__('_ref_'+self.tags['vref']) if 'vref' in self.tags else self.hPointp
+        netStims = {stim['source']: stim['hNetStim'] for stim in self.stims if stim.get('type') == 'NetStim' and stim.get('hNetStim')}
+        for conn in (self.conns if conns is None else conns):
+            if conn['preGid'] == 'NetStim':
+                netstim = netStims.get(conn['preLabel'])
+                if netstim:
+                    netcon = h.NetCon(netstim, postTarget)
+                else: continue
+            else:
+                netcon = sim.pc.gid_connect(conn['preGid'], postTarget)
+
+            netcon.weight[0] = conn['weight']
+            netcon.delay = conn['delay']
+            netcon.threshold = conn.get('threshold', sim.net.params.defaultThreshold)
+            conn['hNetcon'] = netcon
+
+
     def initV (self):
         pass
 
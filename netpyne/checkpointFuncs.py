@@ -0,0 +1,178 @@
+"""
+checkpointFuncs.py
+
+Contains functions to save a checkpoint of a running simulation (state of NEURON mechanisms and event queue via SaveState,
+recorded Vectors and rest of simData, and state of random number generators) to one file per node, and to restore it,
+so the run can be continued later, or several runs branched from the same state, without simulating from t = 0.
+
+Contributors: salvadordura@gmail.com
+"""
+
+__all__ = []
+__all__.extend(['saveCheckpoint', 'loadCheckpoint'])  # checkpoint
+
+import os
+import json
+import shutil
+import random
+import cPickle as pk
+from neuron import h
+import sim
+from spikeFuncs import _spikeFileSize
+from simFuncs import _netStimRands
+
+
+checkpointFormatVersion = 2  # version of layout of checkpoint directories, saved in index (2: rest of simData saved by path)
+
+
+###############################################################################
+### Helper functions
+###############################################################################
+def _nodeFilename (path, node, ext):
+    return os.path.join(path, 'node_%d.%s' % (node, ext))
+
+
+def _isVector (value):
+    return type(value).__name__ == 'HocObject' and value.hname().startswith('Vector')  # type check (hasattr on netpyne Dicts creates the key)
+
+
+def _simDataLeaves (obj, path=(), vectors=None, others=None):
+    ''' Returns list of (path, Vector) of NEURON Vectors in simData (eg. spikes, traces and stim spikes), and list of
+        (path, value) of the rest of values (including empty dicts) '''
+    if vectors is None: vectors, others = [], []
+    for key, value in obj.iteritems():
+        if _isVector(value):
+            vectors.append((path+(key,), value))
+        elif isinstance(value, dict) and value:
+            _simDataLeaves(value, path+(key,), vectors, others)
+        else:
+            others.append((path+(key,), value))
+    return vectors, others
+
+
+def _setPath (obj, path, value):
+    for key in path[:-1]: obj = obj.setdefault(key, {})
+    obj[path[-1]] = value
+
+
+###############################################################################
+### Save checkpoint
+###############################################################################
+def saveCheckpoint (path=None):
+    ''' Saves state of the running simulation to path: each node saves its NEURON state (SaveState; mechanisms, NetCons and
+        event queue) to node_<rank>.dat, and its recorded Vectors, rest of simData, sequence of the random number generators
+        of NetStims and Python random states to node_<rank>.pkl; node 0 saves index.json (t and nhosts). Files are written
+        to a temporary directory that replaces the previous checkpoint once all nodes have finished. Must be called by all
+        nodes between runs of psolve (eg. from runSimWithIntervalFunc, or via cfg.checkpointInterval).
+        Default path: cfg.filename+'_checkpoint' '''
+    if path is None: path = sim.cfg.filename+'_checkpoint'
+    sim.timing('start', 'checkpointTime')
+    tmpPath = path+'_tmp'
+    if sim.rank == 0:
+        if os.path.exists(tmpPath): shutil.rmtree(tmpPath)
+        os.makedirs(tmpPath)
+    sim.pc.barrier()
+
+    # NEURON state
+    ss = h.SaveState()
+    ss.save()
+    stateFile = h.File()
+    stateFile.wopen(_nodeFilename(tmpPath, sim.rank, 'dat'))
+    ss.fwrite(stateFile)  # closes file
+
+    # recorded Vectors, rest of simData and random number generators
+    sim.writeSpikes()  # spikes recorded so far appended to spike file (if cfg.spikeWriteInterval)
+    vectors, others = _simDataLeaves(sim.simData)
+    nodeState = {'t': h.t,
+                 'vectors': [(vecPath, vec.to_python()) for vecPath, vec in vectors],
+                 'simData': others,  # (path, value) of rest of simData
+                 'randSeqs': [rand.seq() for rand, randId, randSeed in _netStimRands()],
+                 'pyRandomState': random.getstate(),
+                 'spikeFileSize': _spikeFileSize()}
+    try:
+        import numpy as np
+        nodeState['npRandomState'] = np.random.get_state()
+    except ImportError:
+        pass
+    with open(_nodeFilename(tmpPath, sim.rank, 'pkl'), 'wb') as fileObj:
+        pk.dump(nodeState, fileObj, protocol=pk.HIGHEST_PROTOCOL)
+
+    if sim.rank == 0:
+        index = {'format': 'netpyne-checkpoint', 'checkpointFormatVersion': checkpointFormatVersion, 'netpyne_version': sim.version(show=False),
+                 'nhosts': sim.nhosts, 't': h.t, 'duration': sim.cfg.duration}
+        with open(os.path.join(tmpPath, 'index.json'), 'w') as fileObj:
+            json.dump(index, fileObj)
+
+    # replace previous checkpoint
+    sim.pc.barrier()
+    if sim.rank == 0:
+        if os.path.exists(path): shutil.rmtree(path)
+        os.rename(tmpPath, path)
+    sim.pc.barrier()
+    sim.timing('stop', 'checkpointTime')
+    if sim.rank == 0:
+        print('  Saved checkpoint at t = %0.2f ms to %s' % (h.t, path))
+        if sim.cfg.timing: print('  Done; checkpoint saving time = %0.2f s.' % sim.timingData['checkpointTime'])
+    return path
+
+
+###############################################################################
+### Load checkpoint
+###############################################################################
+def loadCheckpoint (path=None):
+    ''' Restores state saved with saveCheckpoint(), so the next sim.runSim() or sim.runSimWithIntervalFunc() continues from
+        it (until cfg.duration) instead of starting from t = 0. Must be called by all nodes after creating the same network
+        (same netParams and cfg) on the same number of nodes, and setting up recording (eg. after sim.create()).
+        Default path: cfg.filename+'_checkpoint' '''
+    if path is None: path = sim.cfg.filename+'_checkpoint'
+    sim.timing('start', 'loadCheckpointTime')
+    with open(os.path.join(path, 'index.json'), 'r') as fileObj:
+        index = json.load(fileObj)
+    if index.get('checkpointFormatVersion') != checkpointFormatVersion:
+        print('  Error: checkpoint %s has format version %s; can only restore version %d' % (path, index.get('checkpointFormatVersion'), checkpointFormatVersion))
+        return None
+    if index['nhosts'] != sim.nhosts:
+        print('  Error: checkpoint %s was saved with %d nodes; cannot be restored with %d nodes' % (path, index['nhosts'], sim.nhosts))
+        return None
+    with open(_nodeFilename(path, sim.rank, 'pkl'), 'rb') as fileObj:
+        nodeState = pk.load(fileObj)
+
+    # initialize as at start of run, and restore NEURON state (sets t)
+    sim.preRun()
+    h.finitialize()
+    ss = h.SaveState()
+    stateFile = h.File()
+    stateFile.ropen(_nodeFilename(path, sim.rank, 'dat'))
+    ss.fread(stateFile)  # closes file
+    ss.restore()
+    h.frecord_init()  # continue recording Vectors from restored t
+
+    # recorded Vectors, rest of simData and random number generators; the last sample of traces (at restored t) is
+    # recorded again by frecord_init, so it is not restored (spike times are restored as saved)
+    for vecPath, values in nodeState['vectors']:
+        obj = sim.simData
+        for key in vecPath[:-1]: obj = obj.get(key, {})
+        if vecPath[-1] in obj and _isVector(obj[vecPath[-1]]):
+            if vecPath[0] in sim.cfg.recordTraces: values = values[:-1]
+            obj[vecPath[-1]].from_python(values)
+        else:
+            print('  Warning: Vector simData%s of checkpoint not found' % (''.join(['[%s]' % (repr(key)) for key in vecPath])))
+    for valuePath, value in nodeState['simData']:
+        _setPath(sim.simData, valuePath, value)
+    rands = _netStimRands()
+    if len(rands) != len(nodeState['randSeqs']):
+        print('  Warning: node %d has %d NetStim random number generators, but checkpoint has %d' % (sim.rank, len(rands), len(nodeState['randSeqs'])))
+    for (rand, randId, randSeed), seq in zip(rands, nodeState['randSeqs']):
+        rand.seq(seq)
+    random.setstate(nodeState['pyRandomState'])
+    if 'npRandomState' in nodeState:
+        import numpy as np
+        np.random.set_state(nodeState['npRandomState'])
+
+    sim.checkpointLoaded = {'t': nodeState['t'], 'spikeFileSize': nodeState['spikeFileSize']}  # used by next runSim()
+    sim.pc.barrier()
+    sim.timing('stop', 'loadCheckpointTime')
+    if sim.rank == 0:
+        print('  Restored checkpoint at t = %0.2f ms from %s' % (h.t, path))
+        if sim.cfg.timing: print('  Done; checkpoint restoring time = %0.2f s.' % sim.timingData['loadCheckpointTime'])
+    return h.t
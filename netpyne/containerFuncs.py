@@ -0,0 +1,260 @@
+"""
+containerFuncs.py
+
+Contains functions to save and load output data as a container: a directory with one NumPy (.npy) file per array and a
+json index (index.json). Cells, conns, spikes and traces are stored in blocks of consecutive gids, so a node or analysis
+script can memory-map only the blocks with the gids it requires (eg. spikes can be loaded without reading any conns).
+Does not require NEURON.
+
+Contributors: salvadordura@gmail.com
+"""
+
+__all__ = []
+__all__.extend(['saveContainer', 'loadContainer'])  # container
+
+import os
+import json
+from collections import OrderedDict
+from hdf5Funcs import _jsonDumps, _isNumber, _columnTypes
+
+
+containerFormatVersion = 1  # version of layout of container directories, saved in index
+
+
+###############################################################################
+### Helper functions
+###############################################################################
+def _saveJson (path, name, obj):
+    with open(os.path.join(path, name), 'w') as fileObj:
+        fileObj.write(_jsonDumps(obj))
+    return name
+
+
+def _loadJson (path, name):
+    with open(os.path.join(path, name), 'r') as fileObj:
+        return json.load(fileObj, object_pairs_hook=OrderedDict)
+
+
+def _saveArray (path, name, data, dtype=None):
+    import numpy as np
+    np.save(os.path.join(path, name), np.asarray(data, dtype=dtype))
+    return name
+
+
+def _gidFromLabel (cellLabel):
+    return int(cellLabel.split('_')[-1]) if isinstance(cellLabel, basestring) and cellLabel.startswith('cell_') else None
+
+
+###############################################################################
+### Save cells of one block (cell data as json, conns as columns)
+###############################################################################
+def _saveCellsBlock (path, iblock, cells):
+    import numpy as np
+    blockInfo = {'numCells': len(cells)}
+    blockInfo['gids'] = _saveArray(path, 'cells_%d_gid.npy' % (iblock), [cell['gid'] for cell in cells], dtype='int64')
+    blockInfo['cells'] = _saveJson(path, 'cells_%d.json' % (iblock), [{k: v for k, v in cell.iteritems() if k != 'conns'} for cell in cells])
+
+    # conns as columns, with index of first conn of each cell (connStart[i]:connStart[i+1] = conns of cell i)
+    connStart = np.zeros(len(cells)+1, dtype='int64')
+    conns = []
+    for i, cell in enumerate(cells):
+        for conn in cell.get('conns', []):
+            conn = dict(conn)
+            preGid = conn.pop('preGid', None)
+            conn['preGid'] = int(preGid) if _isNumber(preGid) else -1
+            conn['preGidLabel'] = '' if _isNumber(preGid) else str(preGid)  # eg. 'NetStim'
+            conns.append(conn)
+        connStart[i+1] = len(conns)
+    blockInfo['numConns'] = len(conns)
+    blockInfo['connStart'] = _saveArray(path, 'conns_%d_start.npy' % (iblock), connStart)
+
+    columns = _columnTypes(conns)
+    blockInfo['connColumns'] = {}
+    for key, colType in columns:
+        dtype = 'S' if colType == 'str' else ('int64' if colType == 'int' else 'float64')
+        blockInfo['connColumns'][key] = _saveArray(path, 'conns_%d_%s.npy' % (iblock, key), [conn[key] for conn in conns], dtype=dtype)
+    columnKeys = set([key for key, colType in columns])
+    others = [{k: v for k, v in conn.iteritems() if k not in columnKeys} for conn in conns]
+    if any(others):
+        blockInfo['connOther'] = _saveJson(path, 'conns_%d_other.json' % (iblock), others)
+    return blockInfo
+
+
+###############################################################################
+### Save data to container directory
+###############################################################################
+def saveContainer (dataSave, path, blockSize=10000):
+    ''' Saves dict with the same structure as saved by sim.saveData() (netpyne_version, simConfig, net, simData) to directory
+        with one .npy file per array and index.json; cells, conns, spikes and traces are split in blocks of blockSize gids'''
+    import numpy as np
+
+    if not os.path.exists(path): os.makedirs(path)
+    index = OrderedDict([('format', 'netpyne-container'), ('containerFormatVersion', containerFormatVersion), ('blockSize', blockSize)])
+    blocks = {}  # block number (gid // blockSize) -> info and files of block
+    getBlock = lambda iblock: blocks.setdefault(iblock, {'gidRange': [iblock*blockSize, (iblock+1)*blockSize-1]})
+
+    for key, val in dataSave.iteritems():
+        if key == 'net':
+            index['net'] = {}
+            for netKey, netVal in val.iteritems():
+                if netKey == 'cells':
+                    cellsBlocks = {}
+                    for cell in sorted(netVal, key=lambda cell: cell['gid']):
+                        cellsBlocks.setdefault(int(cell['gid']) // blockSize, []).append(cell)
+                    for iblock, cells in cellsBlocks.iteritems():
+                        getBlock(iblock).update(_saveCellsBlock(path, iblock, cells))
+                    index['net']['cells'] = True
+                else:  # params and pops (small) as json
+                    index['net'][netKey] = _saveJson(path, 'net_%s.json' % (netKey), netVal)
+
+        elif key == 'simData':
+            index['simData'] = {'traces': {}}
+            others = {}
+            for simKey, simVal in val.iteritems():
+                if simKey in ['spkt', 'spkid']:
+                    continue
+                elif isinstance(simVal, dict) and simVal and all(not isinstance(v, dict) and hasattr(v, '__len__') for v in simVal.values()) \
+                        and all(_gidFromLabel(cellLabel) is not None for cellLabel in simVal):
+                    # dict of traces (eg. ['V_soma']['cell_1']); one 2D array per block if all same length (row i = trace of cell i)
+                    traceBlocks = {}
+                    for cellLabel in sorted(simVal.keys(), key=_gidFromLabel):
+                        traceBlocks.setdefault(_gidFromLabel(cellLabel) // blockSize, []).append(cellLabel)
+                    index['simData']['traces'][simKey] = {}
+                    for iblock, cellLabels in traceBlocks.iteritems():
+                        lengths = set([len(simVal[cellLabel]) for cellLabel in cellLabels])
+                        if len(lengths) == 1:
+                            data = np.array([simVal[cellLabel] for cellLabel in cellLabels], dtype='float64')
+                            fileName = _saveArray(path, 'trace_%s_%d.npy' % (simKey, iblock), data)
+                            index['simData']['traces'][simKey][str(iblock)] = {'cells': cellLabels, 'file': fileName}
+                        else:
+                            files = [_saveArray(path, 'trace_%s_%s.npy' % (simKey, cellLabel), simVal[cellLabel], dtype='float64') for cellLabel in cellLabels]
+                            index['simData']['traces'][simKey][str(iblock)] = {'cells': cellLabels, 'files': files}
+                else:  # eg. stims, avgRate, popRates
+                    others[simKey] = simVal
+            index['simData']['other'] = _saveJson(path, 'simData_other.json', others)
+
+            # spikes of each block (in time order)
+            if 'spkid' in val:
+                spkt = np.asarray(val['spkt'], dtype='float64')
+                spkid = np.asarray(val['spkid'], dtype='float64')
+                spkBlock = (spkid // blockSize).astype('int64')
+                for iblock in np.unique(spkBlock).tolist():
+                    mask = spkBlock == iblock
+                    block = getBlock(iblock)
+                    block['numSpikes'] = int(mask.sum())
+                    block['spkt'] = _saveArray(path, 'spk_%d_t.npy' % (iblock), spkt[mask])
+                    block['spkid'] = _saveArray(path, 'spk_%d_id.npy' % (iblock), spkid[mask])
+                index['simData']['spikes'] = True
+
+        elif isinstance(val, basestring):
+            index[key] = val
+        else:  # eg. simConfig as json
+            index.setdefault('files', {})[key] = _saveJson(path, '%s.json' % (key), val)
+
+    index['blocks'] = OrderedDict([(str(iblock), blocks[iblock]) for iblock in sorted(blocks)])
+    _saveJson(path, 'index.json', index)  # saved last, so container is only valid once all arrays are saved
+
+
+###############################################################################
+### Load cells of one block (only those in gids if provided)
+###############################################################################
+def _loadCellsBlock (path, block, gidSet, load):
+    import numpy as np
+    blockGids = np.load(os.path.join(path, block['gids']))
+    inds = range(len(blockGids)) if gidSet is None else [i for i, gid in enumerate(blockGids.tolist()) if gid in gidSet]
+    if not inds: return []
+    cellsData = _loadJson(path, block['cells'])
+    connStart = np.load(os.path.join(path, block['connStart']))
+    columns = {key: load(fileName) for key, fileName in block.get('connColumns', {}).iteritems()}
+    connOther = _loadJson(path, block['connOther']) if 'connOther' in block else None
+
+    cells = []
+    for ind in inds:
+        cell = cellsData[ind]
+        start, stop = connStart[ind], connStart[ind+1]
+        values = {key: column[start:stop].tolist() for key, column in columns.iteritems()}  # only reads conns of cell
+        cell['conns'] = []
+        for i in range(stop-start):
+            conn = {key: values[key][i] for key in values}
+            if connOther is not None: conn.update(connOther[start+i])
+            preGidLabel = conn.pop('preGidLabel', '')
+            conn['preGid'] = preGidLabel if preGidLabel else conn['preGid']
+            cell['conns'].append(conn)
+        cells.append(cell)
+    return cells
+
+
+###############################################################################
+### Load data from container directory
+###############################################################################
+def loadContainer (path, include=None, gids=None, simDataKeys=None, mmap=True):
+    ''' Loads container saved with saveContainer() and returns dict with the same structure as saved by sim.saveData();
+        include: list of parts to read ('simConfig', 'netParams', 'netCells', 'netPops', 'simData'); default: all
+        gids: list of gids; if provided, only the blocks containing these gids are read, and only their cells, conns, spikes and traces kept
+        simDataKeys: list of simData keys to read (eg. ['spkt', 'spkid']); default: all
+        mmap: arrays (spikes of single block, traces) are returned as read-only memory-mapped views instead of being read into memory'''
+    import numpy as np
+
+    index = _loadJson(path, 'index.json')
+    mmapMode = 'r' if mmap else None
+    load = lambda fileName: np.load(os.path.join(path, fileName), mmap_mode=mmapMode)
+    blockSize = index['blockSize']
+    gidSet = set(gids) if gids is not None else None
+    gidBlocks = set([str(gid // blockSize) for gid in gidSet]) if gidSet is not None else None
+    blocks = [block for iblock, block in index['blocks'].iteritems() if gidBlocks is None or iblock in gidBlocks]
+
+    data = {key: val for key, val in index.iteritems() if key == 'netpyne_version'}
+    for key, fileName in index.get('files', {}).iteritems():  # eg. simConfig
+        if include is None or key in include:
+            data[key] = _loadJson(path, fileName)
+
+    if 'net' in index:
+        net = {}
+        if 'params' in index['net'] and (include is None or 'netParams' in include):
+            net['params'] = _loadJson(path, index['net']['params'])
+        if 'pops' in index['net'] and (include is None or 'netPops' in include):
+            net['pops'] = _loadJson(path, index['net']['pops'])
+        if 'cells' in index['net'] and (include is None or 'netCells' in include):
+            net['cells'] = []
+            for block in blocks:
+                if 'gids' in block: net['cells'].extend(_loadCellsBlock(path, block, gidSet, load))
+        if net: data['net'] = net
+
+    if 'simData' in index and (include is None or 'simData' in include):
+        requested = lambda key: simDataKeys is None or key in simDataKeys
+        simData = {k: v for k, v in _loadJson(path, index['simData']['other']).iteritems() if requested(k)}
+
+        # spikes (only blocks with required gids)
+        if index['simData'].get('spikes') and (requested('spkt') or requested('spkid')):
+            spkBlocks = [block for block in blocks if 'spkid' in block]
+            spkt = [load(block['spkt']) for block in spkBlocks]
+            spkid = [load(block['spkid']) for block in spkBlocks]
+            if len(spkBlocks) == 1:
+                spkt, spkid = spkt[0], spkid[0]
+            else:  # merge blocks in time order
+                spkt = np.concatenate(spkt) if spkt else np.array([])
+                spkid = np.concatenate(spkid) if spkid else np.array([])
+                order = np.argsort(spkt, kind='mergesort')
+                spkt, spkid = spkt[order], spkid[order]
+            if gidSet is not None and len(spkid):
+                mask = np.in1d(spkid, list(gidSet))
+                spkt, spkid = spkt[mask], spkid[mask]
+            if requested('spkt'): simData['spkt'] = spkt
+            if requested('spkid'): simData['spkid'] = spkid
+
+        # traces (only rows of required gids)
+        for traceKey, traceBlocks in index['simData']['traces'].iteritems():
+            if not requested(traceKey): continue
+            simData[traceKey] = {}
+            for iblock, traceBlock in traceBlocks.iteritems():
+                if gidBlocks is not None and iblock not in gidBlocks: continue
+                traces = load(traceBlock['file']) if 'file' in traceBlock else None
+                for i, cellLabel in enumerate(traceBlock['cells']):
+                    if gidSet is not None and _gidFromLabel(cellLabel) not in gidSet: continue
+                    if traces is not None:
+                        simData[traceKey][cellLabel] = traces[i]  # row view of memory-mapped array
+                    else:
+                        simData[traceKey][cellLabel] = load(traceBlock['files'][i])
+        data['simData'] = simData
+
+    return data
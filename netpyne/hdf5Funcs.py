@@ -0,0 +1,300 @@
+"""
+hdf5Funcs.py
+
+Contains functions to save and load output data in HDF5 format using h5py: spikes and traces as chunked and compressed
+datasets, cell tags as a compound table and conns as columnar arrays, so files can be sliced without loading everything
+(eg. only spikes, or only cells and conns of a subset of gids). Does not require NEURON.
+
+Contributors: salvadordura@gmail.com
+"""
+
+__all__ = []
+__all__.extend(['saveHDF5', 'loadHDF5'])  # HDF5
+
+import json
+from numbers import Number
+
+
+hdf5FormatVersion = 1  # version of layout of HDF5 files, saved as attribute
+
+
+###############################################################################
+### Helper functions
+###############################################################################
+def _jsonDumps (obj):
+    return json.dumps(obj, default=lambda x: x.tolist() if hasattr(x, 'tolist') else str(x))
+
+
+def _strType ():
+    import h5py
+    return h5py.special_dtype(vlen=str)
+
+
+def _isNumber (value):
+    return isinstance(value, Number) and not isinstance(value, bool)
+
+
+def _columnTypes (items):
+    ''' Returns ordered list of (key, type) of keys present in all items (dicts) with scalar values of the same type
+        ('int', 'float' or 'str'); remaining keys are saved as json '''
+    if not items: return []
+    columns = []
+    for key in sorted(items[0].keys()):
+        values = [item.get(key) for item in items]
+        if all(isinstance(value, basestring) for value in values):
+            columns.append((key, 'str'))
+        elif all(_isNumber(value) for value in values):
+            columns.append((key, 'int' if all(isinstance(value, (int, long)) for value in values) else 'float'))
+    return columns
+
+
+def _writeColumns (group, items, columns, compression, extraKey='other'):
+    ''' Saves each column as a dataset, and remaining keys of each item as json strings (only if any) '''
+    import numpy as np
+    strType = _strType()
+    numItems = len(items)
+    for key, colType in columns:
+        if colType == 'str':
+            data = np.array([item[key] for item in items], dtype=object)
+            group.create_dataset(key, data=data, dtype=strType, chunks=True if numItems else None, compression=compression)
+        else:
+            data = np.array([item[key] for item in items], dtype='int64' if colType == 'int' else 'float64')
+            group.create_dataset(key, data=data, chunks=True if numItems else None, compression=compression)
+    group.attrs['columns'] = _jsonDumps(columns)
+
+    columnKeys = set([key for key, colType in columns])
+    others = [_jsonDumps({k: v for k, v in item.iteritems() if k not in columnKeys}) for item in items]
+    if any(other != '{}' for other in others):
+        group.create_dataset(extraKey, data=np.array(others, dtype=object), dtype=strType, chunks=True if numItems else None, compression=compression)
+
+
+###############################################################################
+### Save cells (tags table, conns columns and other cell data)
+###############################################################################
+def _saveCells (group, cells, compression):
+    import numpy as np
+    strType = _strType()
+    numCells = len(cells)
+
+    # tags as compound table: gid + scalar tags shared by all cells; remaining tags as json
+    tags = [cell['tags'] for cell in cells]
+    tagColumns = _columnTypes(tags)
+    dtypes = [('gid', 'int64')] + [(str(key), strType if colType == 'str' else ('int64' if colType == 'int' else 'float64')) for key, colType in tagColumns]
+    dtypes.append(('otherTags', strType))
+    table = np.empty(numCells, dtype=dtypes)
+    tagKeys = set([key for key, colType in tagColumns])
+    for i, cell in enumerate(cells):
+        table[i] = tuple([cell['gid']] + [cell['tags'][key] for key, colType in tagColumns] +
+                        [_jsonDumps({k: v for k, v in cell['tags'].iteritems() if k not in tagKeys})])
+    group.create_dataset('tags', data=table, chunks=True if numCells else None, compression=compression)
+    group['tags'].attrs['columns'] = _jsonDumps(tagColumns)
+
+    # rest of cell data (eg. secs, stims) as json per cell
+    otherData = [_jsonDumps({k: v for k, v in cell.iteritems() if k not in ['gid', 'tags', 'conns']}) for cell in cells]
+    group.create_dataset('cellData', data=np.array(otherData, dtype=object), dtype=strType, chunks=True if numCells else None, compression=compression)
+
+    # conns as columns, with index of first conn of each cell (connStart[i]:connStart[i+1] = conns of cell i)
+    connStart = np.zeros(numCells+1, dtype='int64')
+    conns = []
+    for i, cell in enumerate(cells):
+        for conn in cell.get('conns', []):
+            conn = dict(conn)
+            preGid = conn.pop('preGid', None)
+            conn['preGid'] = int(preGid) if _isNumber(preGid) else -1
+            conn['preGidLabel'] = '' if _isNumber(preGid) else str(preGid)  # eg. 'NetStim'
+            conns.append(conn)
+        connStart[i+1] = len(conns)
+    connsGroup = group.create_group('conns')
+    connsGroup.create_dataset('connStart', data=connStart)
+    _writeColumns(connsGroup, conns, _columnTypes(conns), compression)
+
+
+###############################################################################
+### Save simData (spikes and traces as datasets)
+###############################################################################
+def _saveSimData (group, simData, compression):
+    import numpy as np
+    others = {}
+    for key, val in simData.iteritems():
+        if key in ['spkt', 'spkid']:
+            group.create_dataset(key, data=np.array(val, dtype='float64'), chunks=True if len(val) else None, compression=compression)
+        elif isinstance(val, dict) and val and all(not isinstance(v, dict) and hasattr(v, '__len__') for v in val.values()):
+            # dict of traces (eg. ['V_soma']['cell_1']); if all same length save as 2D dataset (row i = trace of cell i)
+            traceGroup = group.create_group(key)
+            cellLabels = sorted(val.keys())
+            lengths = set([len(val[cellLabel]) for cellLabel in cellLabels])
+            length = lengths.pop() if len(lengths) == 1 else 0
+            if length > 0:
+                # write one row (cell trace) at a time, to avoid a copy of all traces in memory
+                data = traceGroup.create_dataset('data', shape=(len(cellLabels), length), dtype='float64', chunks=(1, min(length, 2**17)), compression=compression)
+                for i, cellLabel in enumerate(cellLabels):
+                    data[i, :] = np.asarray(val[cellLabel], dtype='float64')
+                traceGroup.create_dataset('cells', data=np.array(cellLabels, dtype=object), dtype=_strType())
+                traceGroup.attrs['layout'] = 'matrix'
+            else:
+                for cellLabel in cellLabels:
+                    traceGroup.create_dataset(cellLabel, data=np.array(val[cellLabel], dtype='float64'), compression=compression)
+                traceGroup.attrs['layout'] = 'cells'
+        elif isinstance(val, dict) and val and all(isinstance(v, dict) for v in val.values()):
+            # dict of dicts of traces or spikes (eg. ['stims']['cell_1']['background'])
+            nestedGroup = group.create_group(key)
+            for cellLabel, val2 in val.iteritems():
+                cellGroup = nestedGroup.create_group(cellLabel)
+                for label, val3 in val2.iteritems():
+                    cellGroup.create_dataset(label, data=np.array(val3, dtype='float64'))
+            nestedGroup.attrs['layout'] = 'nested'
+        else:
+            others[key] = val
+    group.create_dataset('other', data=np.array(_jsonDumps(others), dtype=object), dtype=_strType())  # eg. avgRate, popRates
+
+
+###############################################################################
+### Save data to HDF5 file
+###############################################################################
+def saveHDF5 (dataSave, filename, compression='gzip'):
+    ''' Saves dict with the same structure as saved by sim.saveData() (netpyne_version, simConfig, net, simData) to HDF5 file'''
+    import h5py
+    import numpy as np
+
+    with h5py.File(filename, 'w') as fileObj:
+        fileObj.attrs['hdf5FormatVersion'] = hdf5FormatVersion
+        for key, val in dataSave.iteritems():
+            if key == 'net':
+                netGroup = fileObj.create_group('net')
+                for netKey, netVal in val.iteritems():
+                    if netKey == 'cells':
+                        _saveCells(netGroup.create_group('cells'), netVal, compression)
+                    else:  # params and pops (small) as json
+                        netGroup.create_dataset(netKey, data=np.array(_jsonDumps(netVal), dtype=object), dtype=_strType())
+            elif key == 'simData':
+                _saveSimData(fileObj.create_group('simData'), val, compression)
+            elif isinstance(val, basestring):
+                fileObj.attrs[key] = val
+            else:  # eg. simConfig as json
+                fileObj.create_dataset(key, data=np.array(_jsonDumps(val), dtype=object), dtype=_strType())
+
+
+###############################################################################
+### Load cells (only those in gids if provided)
+###############################################################################
+def _loadColumns (group, start, stop):
+    ''' Returns list of dicts (one per item) from columns saved with _writeColumns (items start:stop) '''
+    columns = json.loads(group.attrs['columns'])
+    values = {key: group[key][start:stop].tolist() for key, colType in columns}
+    others = group['other'][start:stop] if 'other' in group else None
+    items = []
+    for i in range(stop-start):
+        item = {key: values[key][i] for key, colType in columns}
+        if others is not None: item.update(json.loads(others[i]))
+        items.append(item)
+    return items
+
+
+def _loadCells (group, gids=None):
+    import numpy as np
+    tagsTable = group['tags']
+    tagColumns = json.loads(tagsTable.attrs['columns'])
+    if gids is None:
+        inds = range(len(tagsTable))
+        rows = tagsTable[:]
+    else:
+        inds = np.nonzero(np.in1d(tagsTable['gid'], list(gids)))[0].tolist()  # only reads gid column
+        rows = tagsTable[inds] if inds else []
+    connStart = group['conns/connStart'][:]
+    cellData = group['cellData']
+
+    allConns = _loadColumns(group['conns'], 0, connStart[-1]) if gids is None else None  # read all conns at once
+
+    cells = []
+    for ind, row in zip(inds, rows):
+        cell = json.loads(cellData[ind])
+        cell['gid'] = int(row['gid'])
+        cell['tags'] = json.loads(row['otherTags'])
+        for key, colType in tagColumns:
+            cell['tags'][key] = row[str(key)].item() if hasattr(row[str(key)], 'item') else row[str(key)]
+        cell['conns'] = []
+        if connStart[ind+1] > connStart[ind]:
+            if allConns is not None:
+                conns = allConns[connStart[ind]:connStart[ind+1]]
+            else:
+                conns = _loadColumns(group['conns'], connStart[ind], connStart[ind+1])
+            for conn in conns:
+                preGidLabel = conn.pop('preGidLabel', '')
+                conn['preGid'] = preGidLabel if preGidLabel else conn['preGid']
+                cell['conns'].append(conn)
+        cells.append(cell)
+    return cells
+
+
+###############################################################################
+### Load simData (only spikes and traces of gids and keys if provided)
+###############################################################################
+def _loadSimData (group, gids=None, simDataKeys=None):
+    import numpy as np
+    simData = json.loads(group['other'][()]) if 'other' in group else {}
+    cellLabels = set(['cell_%d' % gid for gid in gids]) if gids is not None else None
+    if simDataKeys is not None:
+        simData = {k: v for k, v in simData.iteritems() if k in simDataKeys}
+
+    # spikes
+    if simDataKeys is None or 'spkt' in simDataKeys or 'spkid' in simDataKeys:
+        if 'spkid' in group:
+            mask = np.in1d(group['spkid'][:], list(gids)) if gids is not None else None
+            for key in ['spkt', 'spkid']:
+                if simDataKeys is None or key in simDataKeys:
+                    simData[key] = group[key][:] if mask is None else group[key][:][mask]
+
+    # traces and stims
+    for key in group:
+        if key in ['spkt', 'spkid', 'other'] or (simDataKeys is not None and key not in simDataKeys):
+            continue
+        layout = group[key].attrs.get('layout')
+        simData[key] = {}
+        if layout == 'matrix':
+            labels = group[key]['cells'][:].tolist()
+            rows = [i for i, label in enumerate(labels) if cellLabels is None or label in cellLabels]
+            data = group[key]['data'][rows, :] if cellLabels is not None else group[key]['data'][:]  # only reads selected rows
+            for irow, row in enumerate(rows):
+                simData[key][labels[row]] = data[irow]
+        elif layout == 'cells':
+            for label in group[key]:
+                if cellLabels is None or label in cellLabels:
+                    simData[key][label] = group[key][label][:]
+        elif layout == 'nested':
+            for label in group[key]:
+                if cellLabels is None or label in cellLabels:
+                    simData[key][label] = {stim: group[key][label][stim][:] for stim in group[key][label]}
+    return simData
+
+
+###############################################################################
+### Load data from HDF5 file
+###############################################################################
+def loadHDF5 (filename, include=None, gids=None, simDataKeys=None):
+    ''' Loads HDF5 file saved with saveHDF5() and returns dict with the same structure as saved by sim.saveData();
+        include: list of parts to read ('simConfig', 'netParams', 'netCells', 'netPops', 'simData'); default: all 
+        gids: list of gids; if provided, only cells, conns, spikes and traces of these cells are read 
+        simDataKeys: list of simData keys to read (eg. ['spkt', 'spkid']); default: all'''
+    import h5py
+
+    data = {}
+    with h5py.File(filename, 'r') as fileObj:
+        for key, val in fileObj.attrs.iteritems():
+            if key != 'hdf5FormatVersion': data[key] = val
+        for key in fileObj:
+            if key == 'net':
+                net = {}
+                netGroup = fileObj['net']
+                if 'params' in netGroup and (include is None or 'netParams' in include):
+                    net['params'] = json.loads(netGroup['params'][()])
+                if 'pops' in netGroup and (include is None or 'netPops' in include):
+                    net['pops'] = json.loads(netGroup['pops'][()])
+                if 'cells' in netGroup and (include is None or 'netCells' in include):
+                    net['cells'] = _loadCells(netGroup['cells'], gids)
+                if net: data['net'] = net
+            elif key == 'simData':
+                if include is None or 'simData' in include:
+                    data['simData'] = _loadSimData(fileObj['simData'], gids, simDataKeys)
+            elif include is None or key in include:  # eg. simConfig
+                data[key] = json.loads(fileObj[key][()])
+    return data
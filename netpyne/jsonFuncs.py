@@ -0,0 +1,280 @@
+"""
+jsonFuncs.py
+
+Contains functions to save and load output data in json format by streaming: data is written to file item by item
+(numpy arrays and NEURON Vectors as compact lists of numbers, in chunks) without building a converted copy in memory,
+and read back without building the full parse tree (numeric lists of simData are parsed directly into numpy arrays,
+and parts not required are skipped). Does not require NEURON.
+
+Contributors: salvadordura@gmail.com
+"""
+
+__all__ = []
+__all__.extend(['saveJsonStream', 'loadJsonStream'])  # json
+
+import re
+import sys
+import json
+from numbers import Number
+from collections import OrderedDict
+
+
+_chunkSize = 2**16  # number of values per chunk of arrays written to file
+_maxDirectLen = 1000  # containers with more items (or with large arrays) are written item by item
+_maxDirectBytes = 2**22  # values larger than this are read item by item instead of with the json decoder
+_readSize = 2**20  # bytes read from file at a time
+
+
+###############################################################################
+### Write functions
+###############################################################################
+def _isNumpyArray (obj):
+    np = sys.modules.get('numpy')  # numpy arrays can only exist if numpy was imported
+    return np is not None and isinstance(obj, np.ndarray)
+
+
+def _isVector (obj):
+    return type(obj).__name__ == 'HocObject' and obj.hname().startswith('Vector')
+
+
+def _isArray (obj):
+    ''' numpy array or NEURON Vector (containers checked first, since netpyne Dicts create missing keys on attribute access) '''
+    if isinstance(obj, (dict, list, tuple)): return False
+    return (_isNumpyArray(obj) and obj.ndim > 0) or _isVector(obj)
+
+
+def _toArray (obj):
+    if _isNumpyArray(obj): return obj
+    return obj.as_numpy()  # NEURON Vector (no copy)
+
+
+def _isLarge (obj):
+    return (_isArray(obj) or isinstance(obj, (dict, list, tuple))) and len(obj) > _maxDirectLen
+
+
+def _default (obj):
+    np = sys.modules.get('numpy')
+    if np is not None and isinstance(obj, (np.ndarray, np.generic)):  # numpy arrays and scalars
+        return obj.tolist()
+    elif _isVector(obj):  # NEURON Vectors
+        return obj.to_python()
+    raise TypeError('%s is not JSON serializable' % (repr(obj)))
+
+
+def _jsonKey (key):
+    if isinstance(key, basestring): return key
+    elif key is None or isinstance(key, (bool, Number)): return json.dumps(key)
+    return str(key)  # eg. tuples
+
+
+def _writeArray (arr, fileObj):
+    if arr.ndim != 1 or arr.dtype.kind not in 'biuf':
+        fileObj.write(json.dumps(arr.tolist(), default=_default))
+        return
+    fileObj.write('[')
+    for start in xrange(0, len(arr), _chunkSize):
+        if start: fileObj.write(',')
+        fileObj.write(json.dumps(arr[start:start+_chunkSize].tolist())[1:-1])
+    fileObj.write(']')
+
+
+def _writeValue (obj, fileObj, depth=0):
+    if _isArray(obj):
+        _writeArray(_toArray(obj), fileObj)
+
+    elif isinstance(obj, dict) and (depth < 2 or len(obj) > _maxDirectLen or any(_isLarge(val) for val in obj.itervalues())):
+        fileObj.write('{')
+        for i, (key, val) in enumerate(obj.iteritems()):
+            if i: fileObj.write(',')
+            fileObj.write(json.dumps(_jsonKey(key)) + ':')
+            _writeValue(val, fileObj, depth+1)
+        fileObj.write('}')
+
+    elif isinstance(obj, (list, tuple)) and (depth < 2 or len(obj) > _maxDirectLen):
+        fileObj.write('[')
+        for start in xrange(0, len(obj), _chunkSize):
+            if start: fileObj.write(',')
+            chunk = obj[start:start+_chunkSize]
+            if not any(isinstance(item, (dict, list, tuple)) or _isArray(item) for item in chunk):  # eg. list of numbers
+                fileObj.write(json.dumps(list(chunk), default=_default)[1:-1])
+            else:
+                for i, item in enumerate(chunk):
+                    if i: fileObj.write(',')
+                    _writeValue(item, fileObj, depth+1)
+        fileObj.write(']')
+
+    else:  # scalars and small containers (eg. cell) written at once
+        fileObj.write(json.dumps(obj, default=_default))
+
+
+###############################################################################
+### Save data to json file by streaming
+###############################################################################
+def saveJsonStream (data, filename):
+    ''' Saves data (dicts, lists, numpy arrays and NEURON Vectors) to json file, walking the data once and writing
+        each item directly to file (no converted copy of the data is created); tuples are saved as lists '''
+    with open(filename, 'w') as fileObj:
+        _writeValue(data, fileObj)
+
+
+###############################################################################
+### Read functions
+###############################################################################
+_wsRe = re.compile(r'[ \t\n\r]*')
+_stringRe = re.compile(r'"(?:[^"\\]|\\.)*"', re.S)
+_scalarRe = re.compile(r'-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?|true|false|null|NaN|-?Infinity')
+_bracketRe = re.compile(r'["\[\]{}]')
+_delimRe = re.compile(r'[,\]}\s]')
+_decoder = json.JSONDecoder(object_pairs_hook=OrderedDict)
+
+
+class _JsonStreamReader (object):
+    ''' Reads json file by parts: the top levels item by item, and each item with the json decoder (or item by item if large) '''
+
+    def __init__ (self, fileObj, include=None):
+        self.fileObj = fileObj
+        self.include = include
+        self.buf = ''
+        self.pos = 0
+
+    def _fill (self):
+        ''' Appends next part of file to buffer (discarding the part already read); returns False at end of file '''
+        chunk = self.fileObj.read(_readSize)
+        if not chunk: return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _peek (self):
+        while True:
+            self.pos = _wsRe.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf): return self.buf[self.pos]
+            if not self._fill(): return ''
+
+    def _matchString (self):
+        while True:
+            m = _stringRe.match(self.buf, self.pos)
+            if m: break
+            if not self._fill(): raise ValueError('Invalid json: unterminated string')
+        self.pos = m.end()
+        return json.loads(m.group())
+
+    def _matchScalar (self):
+        while not _delimRe.search(self.buf, self.pos):  # number could continue in next part of file
+            if not self._fill(): break
+        m = _scalarRe.match(self.buf, self.pos)
+        if not m: raise ValueError('Invalid json: unexpected value %s' % (self.buf[self.pos:self.pos+20]))
+        self.pos = m.end()
+        return _decoder.decode(m.group())
+
+    def _required (self, path):
+        ''' Whether item at path (list of keys) is required '''
+        if self.include is None or not path: return True
+        if path[0] == 'net':
+            return len(path) < 2 or {'params': 'netParams', 'cells': 'netCells', 'pops': 'netPops'}.get(path[1], path[1]) in self.include
+        return path[0] in self.include or path[0] == 'netpyne_version'
+
+    def _readNumbers (self):
+        ''' Reads list of numbers directly into numpy array (used for simData); returns None if list contains other values,
+            or ints that do not fit in int64 '''
+        import numpy as np
+        while True:
+            end = self.buf.find(']', self.pos)
+            if end >= 0: break
+            if not self._fill(): raise ValueError('Invalid json: unterminated list')
+        text = self.buf[self.pos+1:end]
+        if '"' in text or '[' in text or '{' in text or 't' in text or 'l' in text:  # not only numbers
+            return None
+        isFloat = any(c in text for c in '.eENI')
+        arr = np.fromstring(text, dtype='float64' if isFloat else 'int64', sep=',')
+        if not isFloat and arr.size and (arr.max() == np.iinfo('int64').max or arr.min() == np.iinfo('int64').min):  # may be clipped
+            return None
+        self.pos = end+1
+        return arr
+
+    def _readValue (self, path):
+        c = self._peek()
+        depth = len(path)
+        if c == '[' and path and path[0] == 'simData' and self._readNumbersFirst():  # spikes and traces as arrays
+            arr = self._readNumbers()
+            if arr is not None: return arr
+
+        if c and c in '[{' and (depth >= 3 or (depth == 2 and path[0] != 'simData')):  # try to decode at once
+            while True:
+                try:
+                    value, self.pos = _decoder.raw_decode(self.buf, self.pos)
+                    return value
+                except ValueError:  # not complete in buffer
+                    if len(self.buf) - self.pos > _maxDirectBytes or not self._fill(): break  # large or invalid: read item by item
+
+        if c == '{':
+            self.pos += 1
+            obj = OrderedDict()
+            while True:
+                c = self._peek()
+                if c == '}': self.pos += 1; break
+                if c == ',': self.pos += 1; continue
+                key = self._matchString()
+                if self._peek() != ':': raise ValueError('Invalid json: expected ":" after key %s' % (key))
+                self.pos += 1
+                if self._required(path+[key]):
+                    obj[key] = self._readValue(path+[key])
+                else:
+                    self._skipValue()
+            return obj
+        elif c == '[':
+            self.pos += 1
+            obj = []
+            while True:
+                c = self._peek()
+                if c == ']': self.pos += 1; break
+                if c == ',': self.pos += 1; continue
+                obj.append(self._readValue(path+[len(obj)]))
+            return obj
+        elif c == '"':
+            return self._matchString()
+        else:
+            return self._matchScalar()
+
+    def _readNumbersFirst (self):
+        ''' Whether list at current position starts with a number '''
+        while True:
+            start = _wsRe.match(self.buf, self.pos+1).end()
+            if start < len(self.buf): return self.buf[start] in '-0123456789NI'
+            if not self._fill(): return False
+
+    def _skipValue (self):
+        c = self._peek()
+        if c == '"':
+            self._matchString()
+        elif not c or c not in '[{':
+            self._matchScalar()
+        else:
+            level = 0
+            while True:
+                m = _bracketRe.search(self.buf, self.pos)
+                if not m:
+                    self.pos = len(self.buf)
+                    if not self._fill(): raise ValueError('Invalid json: unterminated value')
+                    continue
+                self.pos = m.start()
+                if m.group() == '"':
+                    self._matchString()
+                    continue
+                self.pos += 1
+                level += 1 if m.group() in '[{' else -1
+                if level == 0: return
+
+    def read (self):
+        return self._readValue([])
+
+
+###############################################################################
+### Load data from json file by streaming
+###############################################################################
+def loadJsonStream (filename, include=None):
+    ''' Loads json file reading it by parts, without building the full parse tree: lists of numbers in simData are parsed
+        directly into numpy arrays, and if include is provided ('simConfig', 'netParams', 'netCells', 'netPops', 'simData'),
+        the rest of top-level items are skipped. Dicts are returned as OrderedDicts. '''
+    with open(filename, 'r') as fileObj:
+        return _JsonStreamReader(fileObj, include).read()
@@ -38,6 +38,7 @@ class Network (object):
         self.lid2gid = [] # Empty list for storing local index -> GID (index = local id; value = gid)
         self.gid2lid = {} # Empty dict for storing GID -> local index (key = gid; value = local id) -- ~x6 faster than .index() 
         self.lastGid = 0  # keep track of last cell gid 
+        self.allCellTags = {}  # tags of all cells, including those in other nodes (key = gid; value = tags)
         self.lastGapId = 0  # keep track of last gap junction gid 
 
 
@@ -56,6 +57,14 @@ class Network (object):
         return self.pops
 
 
+    ###############################################################################
+    # Free tags of all cells (only required to build the network)
+    ###############################################################################
+    def clearAllCellTags (self):
+        if isinstance(self.allCellTags, sim.SharedCellTags): self.allCellTags.free()  # node shared memory
+        self.allCellTags = {}  # tags of remote cells gathered from nodes if required later
+
+
     ###############################################################################
     # Create Cells
     ###############################################################################
@@ -64,6 +73,8 @@ class Network (object):
         sim.timing('start', 'createTime')
         if sim.rank==0: 
             print("\nCreating network of %i cell populations on %i hosts..." % (len(self.pops), sim.nhosts)) 
+        if sim.cfg.sharedMemory and sim.nhosts > 1:
+            self.allCellTags = sim.CellTagsColumns()  # tags of all cells encoded as columns (not as dicts) while creating cells
         
         for ipop in self.pops.values(): # For each pop instantiate the network cells (objects of class 'Cell')
             newCells = ipop.createCells() # create cells for this pop using Pop method
@@ -71,6 +82,8 @@ class Network (object):
             sim.pc.barrier()
             if sim.rank==0 and sim.cfg.verbose: print('Instantiated %d cells of population %s'%(len(newCells), ipop.tags['popLabel']))    
         print('  Number of cells on node %i: %i ' % (sim.rank,len(self.cells))) 
+        if sim.cfg.sharedMemory and sim.nhosts > 1:
+            self.allCellTags = sim.shareCellTags(self.allCellTags)  # single copy of tags of all cells per node (read from columns)
         sim.pc.barrier()
         sim.timing('stop', 'createTime')
         if sim.rank == 0 and sim.cfg.timing: print('  Done; cell creation time = %0.2f s.' % sim.timingData['createTime'])
@@ -100,16 +113,19 @@ class Network (object):
                 
                 source = sources.get(target['source'])
 
-                postCellsTags = allCellTags
-                for condKey,condValue in target['conds'].iteritems():  # Find subset of cells that match postsyn criteria
-                    if condKey in ['x','y','z','xnorm','ynorm','znorm']:
-                        postCellsTags = {gid: tags for (gid,tags) in postCellsTags.iteritems() if condValue[0] <= tags.get(condKey, None) < condValue[1]}  # dict with post Cell objects}  # dict with pre cell tags
-                    elif condKey == 'cellList':
-                        pass
-                    elif isinstance(condValue, list): 
-                        postCellsTags = {gid: tags for (gid,tags) in postCellsTags.iteritems() if tags.get(condKey, None) in condValue}  # dict with post Cell objects
-                    else:
-                        postCellsTags = {gid: tags for (gid,tags) in postCellsTags.iteritems() if tags.get(condKey, None) == condValue}  # dict with post Cell objects
+                if isinstance(allCellTags, sim.SharedCellTags):  # filter columns in shared memory
+                    postCellsTags = allCellTags.select({condKey: condValue for condKey,condValue in target['conds'].iteritems() if condKey != 'cellList'})
+                else:
+                    postCellsTags = allCellTags
+                    for condKey,condValue in target['conds'].iteritems():  # Find subset of cells that match postsyn criteria
+                        if condKey in ['x','y','z','xnorm','ynorm','znorm']:
+                            postCellsTags = {gid: tags for (gid,tags) in postCellsTags.iteritems() if condValue[0] <= tags.get(condKey, None) < condValue[1]}  # dict with post Cell objects}  # dict with pre cell tags
+                        elif condKey == 'cellList':
+                            pass
+                        elif isinstance(condValue, list): 
+                            postCellsTags = {gid: tags for (gid,tags) in postCellsTags.iteritems() if tags.get(condKey, None) in condValue}  # dict with post Cell objects
+                        else:
+                            postCellsTags = {gid: tags for (gid,tags) in postCellsTags.iteritems() if tags.get(condKey, None) == condValue}  # dict with post Cell objects
                 
                 # subset of cells from selected pops (by relative indices)                     
                 if 'cellList' in target['conds']:
@@ -243,7 +259,7 @@ class Network (object):
             segNumSyn[secName] = []
             for seg in sec['hSec']:
                 x, y, z = self._posFromLoc(sec['hSec'], seg.x)
-                if gridX and gridY: # 2D
+                if gridX is not None and len(gridX) and len(gridY): # 2D (lists or arrays, eg. in shared memory)
                     distX = [abs(gx-x) for gx in gridX]
                     distY = [abs(gy-y) for gy in gridY]
                     ixs = array(distX).argsort()[:2]
@@ -262,7 +278,7 @@ class Network (object):
                        sigma = ((sigma_x1_y1*abs(x2-x)*abs(y2-y) + sigma_x2_y1*abs(x-x1)*abs(y2-y) + sigma_x1_y2*abs(x2-x)*abs(y-y1) + sigma_x2_y2*abs(x-x1)*abs(y-y1))/(abs(x2-x1)*abs(y2-y1)))
                        #sigma = ((sigma_x1_y1*abs(x2-x)*abs(y2-y) + sigma_x2_y1*abs(x-x1)*abs(y2-y) + sigma_x1_y2*abs(x2-x)*abs(y-y1) + sigma_x2_y2*abs(x-x1)*abs(y-y1))/((x2-x1)*(y2-y1)))
 
-                elif gridY:  # 1d = radial
+                elif len(gridY):  # 1d = radial
                     distY = [abs(gy-y) for gy in gridY]
                     jys = array(distY).argsort()[:2]
                     sigma = zeros((1,2))
@@ -384,10 +400,6 @@ class Network (object):
                             # print scaleNumSyn
                             # print totSynRescale
 
-                            # convert to list so can serialize and save
-                            subConnParam['density']['gridY'] = list(subConnParam['density']['gridY'])
-                            subConnParam['density']['gridValues'] = list(subConnParam['density']['gridValues']) 
-
                             newSecs, newLocs = [], []
                             for sec, nsyns in segNumSyn.iteritems():
                                 for i, seg in enumerate(postCell.secs[sec]['hSec']):
@@ -504,6 +516,8 @@ class Network (object):
         sim.timing('stop', 'connectTime')
         if sim.rank == 0 and sim.cfg.timing: print('  Done; cell connection time = %0.2f s.' % sim.timingData['connectTime'])
 
+        if sim.cfg.reportConnTraffic: sim.reportConnTraffic()  # local vs remote conns in each node
+
         return [cell.conns for cell in self.cells]
 
 
@@ -512,6 +526,8 @@ class Network (object):
     ###############################################################################
     def _findCellsCondition(self, allCellTags, conds):
         try: 
+            if isinstance(allCellTags, sim.SharedCellTags):  # filter columns in shared memory
+                return allCellTags.select(conds)
             cellsTags = dict(allCellTags)
             for condKey,condValue in conds.iteritems():  # Find subset of cells that match presyn criteria
                 if condKey in ['x','y','z','xnorm','ynorm','znorm']:
@@ -535,6 +551,11 @@ class Network (object):
     ###############################################################################
     def _findPrePostCellsCondition(self, allCellTags, preConds, postConds):
         #try:
+        if isinstance(allCellTags, sim.SharedCellTags):  # filter columns in shared memory
+            preCellsTags = allCellTags.select(preConds)
+            postCellsTags = allCellTags.select(postConds) if preCellsTags else None
+            return preCellsTags, postCellsTags
+
         preCellsTags = dict(allCellTags)  # initialize with all presyn cells (make copy)
         postCellsTags = None
 
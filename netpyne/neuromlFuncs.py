@@ -17,44 +17,50 @@ except:
 import pprint; pp = pprint.PrettyPrinter(depth=6)
 import math
 from collections import OrderedDict
+from array import array
 import sim, specs
 
+_chunkRows = 10000  # number of instances or conns written to file at a time
+
 ###############################################################################
 ### Get connection centric network representation as used in NeuroML2
 ###############################################################################  
-def _convertNetworkRepresentation (net, gids_vs_pop_indices):
+def _newColumns (**typecodes):
+    ''' Dict of empty compact arrays (array module) to append conn values to '''
+    return {key: array(typecode) for key, typecode in typecodes.iteritems()}
+
+
+def _columnArray (column):
+    ''' numpy view of compact array (no copy) '''
+    import numpy as np
+    return np.frombuffer(column, dtype='float64' if column.typecode == 'd' else 'int%d'%(8*column.itemsize))
+
 
+def _convertNetworkRepresentation (net, gids_vs_pop_indices):
+    ''' Groups conns of all cells into projections (popPre, popPost, synMech) in a single pass over the cells; returns
+        dict with columns of each projection (compact arrays of indexPre, indexPost, weight and delay) '''
     nn = {}
 
-    for np_pop in net.pops.values(): 
-        print("Adding conns for: %s"%np_pop.tags)
-        if not np_pop.tags['cellModel'] ==  'NetStim':
-            for cell in net.cells:
-                if cell.gid in np_pop.cellGids:
-                    popPost, indexPost = gids_vs_pop_indices[cell.gid]
-                    #print("Cell %s: %s\n    %s[%i]\n"%(cell.gid,cell.tags,popPost, indexPost))
-                    for conn in cell.conns:
-                        preGid = conn['preGid']
-                        if not preGid == 'NetStim':
-                            popPre, indexPre = gids_vs_pop_indices[preGid]
-                            loc = conn['loc']
-                            weight = conn['weight']
-                            delay = conn['delay']
-                            sec = conn['sec']
-                            synMech = conn['synMech']
-                            threshold = conn['threshold']
-
-                            if sim.cfg.verbose: print("      Conn %s[%i]->%s[%i] with %s, w: %s, d: %s"%(popPre, indexPre,popPost, indexPost, synMech, weight, delay))
-
-                            projection_info = (popPre,popPost,synMech)
-                            if not projection_info in nn.keys():
-                                nn[projection_info] = []
-
-                            nn[projection_info].append({'indexPre':indexPre,'indexPost':indexPost,'weight':weight,'delay':delay})
-                        else:
-                            #print("      Conn NetStim->%s[%s] with %s"%(popPost, indexPost, '??'))
-                            pass
-                                
+    for cell in net.cells:
+        if cell.gid not in gids_vs_pop_indices: continue  # NetStim pops
+        popPost, indexPost = gids_vs_pop_indices[cell.gid]
+        for conn in cell.conns:
+            preGid = conn['preGid']
+            if preGid == 'NetStim': continue
+            popPre, indexPre = gids_vs_pop_indices[preGid]
+            synMech = conn['synMech']
+
+            if sim.cfg.verbose: print("      Conn %s[%i]->%s[%i] with %s, w: %s, d: %s"%(popPre, indexPre,popPost, indexPost, synMech, conn['weight'], conn['delay']))
+
+            projection_info = (popPre,popPost,synMech)
+            if projection_info not in nn:
+                nn[projection_info] = _newColumns(indexPre='l', indexPost='l', weight='d', delay='d')
+            columns = nn[projection_info]
+            columns['indexPre'].append(indexPre)
+            columns['indexPost'].append(indexPost)
+            columns['weight'].append(conn['weight'])
+            columns['delay'].append(conn['delay'])
+
     return nn                 
 
 
@@ -62,43 +68,203 @@ def _convertNetworkRepresentation (net, gids_vs_pop_indices):
 ### Get stimulations in representation as used in NeuroML2
 ###############################################################################  
 def _convertStimulationRepresentation (net,gids_vs_pop_indices, nml_doc):
-
+    ''' Groups stims of all cells by source, rate, noise and synMech in a single pass over the cells; returns dict with
+        columns of each group (compact arrays of index, weight and delay) '''
     stims = {}
 
-    for np_pop in net.pops.values(): 
-        if not np_pop.tags['cellModel'] ==  'NetStim':
-            print("Adding stims for: %s"%np_pop.tags)
-            for cell in net.cells:
-                if cell.gid in np_pop.cellGids:
-                    pop, index = gids_vs_pop_indices[cell.gid]
-                    #print("    Cell %s:\n    Tags:  %s\n    Pop:   %s[%i]\n    Stims: %s\n    Conns: %s\n"%(cell.gid,cell.tags,pop, index,cell.stims,cell.conns))
-                    for stim in cell.stims:
-                        ref = stim['source']
-                        rate = stim['rate']
-                        noise = stim['noise']
-                        
-                        netstim_found = False
-                        for conn in cell.conns:
-                            if conn['preGid'] == 'NetStim' and conn['preLabel'] == ref:
-                                assert(not netstim_found)
-                                netstim_found = True
-                                synMech = conn['synMech']
-                                threshold = conn['threshold']
-                                delay = conn['delay']
-                                weight = conn['weight']
-                                
-                        assert(netstim_found)
-                        name_stim = 'NetStim_%s_%s_%s_%s_%s'%(ref,pop,rate,noise,synMech)
+    for cell in net.cells:
+        if cell.gid not in gids_vs_pop_indices or not cell.stims: continue
+        pop, index = gids_vs_pop_indices[cell.gid]
+        netStimConns = {}
+        for conn in cell.conns:
+            if conn['preGid'] == 'NetStim':
+                assert(conn['preLabel'] not in netStimConns)
+                netStimConns[conn['preLabel']] = conn
+
+        for stim in cell.stims:
+            ref = stim['source']
+            rate = stim['rate']
+            noise = stim['noise']
+            conn = netStimConns[ref]
+            synMech = conn['synMech']
+            name_stim = 'NetStim_%s_%s_%s_%s_%s'%(ref,pop,rate,noise,synMech)
+
+            stim_info = (name_stim, pop, rate, noise,synMech)
+            if stim_info not in stims:
+                stims[stim_info] = _newColumns(index='l', weight='d', delay='d')
+            columns = stims[stim_info]
+            columns['index'].append(index)
+            columns['weight'].append(conn['weight'])
+            columns['delay'].append(conn['delay'])
 
-                        stim_info = (name_stim, pop, rate, noise,synMech)
-                        if not stim_info in stims.keys():
-                            stims[stim_info] = []
+    return stims
 
 
-                        stims[stim_info].append({'index':index,'weight':weight,'delay':delay,'threshold':threshold})   
+###############################################################################
+### Write network to NeuroML2 XML file by streaming
+###############################################################################  
+def _writeNetworkXml (fileObj, netId, populations, projections):
+    ''' Writes network element with populations (instances from array of locations) and projections (conns from arrays of
+        columns) to open file, in chunks of rows, without creating NeuroML objects '''
+    fileObj.write('    <network id="%s">\n'%netId)
+
+    for pop in populations:
+        typeAttr = ' type="populationList"' if pop['locations'] is not None else ''
+        fileObj.write('        <population id="%s" component="%s" size="%d"%s>\n'%(pop['id'], pop['component'], pop['size'], typeAttr))
+        if pop['locations'] is not None:
+            for start in xrange(0, pop['size'], _chunkRows):
+                rows = pop['locations'][start:start+_chunkRows]
+                fileObj.write(''.join(['            <instance id="%d">\n                <location x="%s" y="%s" z="%s"/>\n            </instance>\n'
+                                       %(start+i, x, y, z) for i, (x, y, z) in enumerate(rows)]))
+        fileObj.write('        </population>\n')
+
+    # projections before electrical projections, as required by schema
+    for proj in sorted(projections, key=lambda proj: proj['type'] == 'electricalProjection'):
+        columns = proj['columns']
+        if proj['type'] == 'projection':
+            fileObj.write('        <projection id="%s" presynapticPopulation="%s" postsynapticPopulation="%s" synapse="%s">\n'
+                          %(proj['id'], proj['pre'], proj['post'], proj['synapse']))
+            rowFormat = ('            <connectionWD id="%d" preCellId="'+proj['preCellId']+'" preSegmentId="0" preFractionAlong="0.5" postCellId="'
+                         +proj['postCellId']+'" postSegmentId="0" postFractionAlong="0.5" weight="%s" delay="%s ms"/>\n')
+            values = lambda start, stop: zip(columns['indexPre'][start:stop], columns['indexPost'][start:stop], columns['weight'][start:stop], columns['delay'][start:stop])
+        else:
+            fileObj.write('        <electricalProjection id="%s" presynapticPopulation="%s" postsynapticPopulation="%s">\n'
+                          %(proj['id'], proj['pre'], proj['post']))
+            rowFormat = ('            <electricalConnectionInstance id="%d" preCell="'+proj['preCellId']+'" preSegment="0" preFractionAlong="0.5" postCell="'
+                         +proj['postCellId']+'" postSegment="0" postFractionAlong="0.5" synapse="'+proj['synapse']+'"/>\n')
+            values = lambda start, stop: zip(columns['indexPre'][start:stop], columns['indexPost'][start:stop])
+        for start in xrange(0, len(columns['indexPre']), _chunkRows):
+            fileObj.write(''.join([rowFormat%((start+i,)+row) for i, row in enumerate(values(start, start+_chunkRows))]))
+        fileObj.write('        </%s>\n'%proj['type'])
+
+    fileObj.write('    </network>\n')
 
-    #print(stims)
-    return stims
+
+###############################################################################
+### Write network to NeuroML2 HDF5 file by streaming
+###############################################################################  
+def _writeNetworkHdf5 (fileName, docId, notes, netId, populations, projections, topLevelXml):
+    ''' Writes network to NeuroML2 HDF5 network file (layout of libNeuroML NeuroMLHdf5Writer: locations of each population
+        and conns of each projection as arrays, and rest of document as XML in attribute of root group) using h5py;
+        conns are written in chunks of rows from arrays of columns '''
+    import h5py
+    import numpy as np
+
+    with h5py.File(fileName, 'w') as h5file:
+        rootGroup = h5file.create_group('neuroml')
+        rootGroup.attrs['id'] = docId
+        rootGroup.attrs['notes'] = notes
+        rootGroup.attrs['neuroml_top_level'] = topLevelXml
+        netGroup = rootGroup.create_group('network')
+        netGroup.attrs['id'] = netId
+
+        for pop in populations:
+            popGroup = netGroup.create_group('population_%s'%pop['id'])
+            popGroup.attrs['id'] = pop['id']
+            popGroup.attrs['component'] = pop['component']
+            popGroup.attrs['size'] = pop['size']
+            if pop['locations'] is not None:
+                popGroup.attrs['type'] = 'populationList'
+                dataset = popGroup.create_dataset(pop['id'], data=np.array(pop['locations'], dtype='float32').reshape((-1, 3)))
+                for i, column in enumerate(['x', 'y', 'z']): dataset.attrs['column_%d'%i] = column
+
+        for proj in projections:
+            columns = proj['columns']
+            projGroup = netGroup.create_group('projection_%s'%proj['id'])
+            projGroup.attrs['id'] = proj['id']
+            projGroup.attrs['type'] = proj['type']
+            projGroup.attrs['presynapticPopulation'] = proj['pre']
+            projGroup.attrs['postsynapticPopulation'] = proj['post']
+            projGroup.attrs['synapse'] = proj['synapse']
+            colNames = ['pre_cell_id', 'post_cell_id'] + (['weight', 'delay'] if proj['type'] == 'projection' else [])
+            numRows = len(columns['indexPre'])
+            dataset = projGroup.create_dataset(proj['id'], shape=(numRows, len(colNames)+1), dtype='float32', chunks=(min(max(numRows, 1), _chunkRows), len(colNames)+1))
+            for i, column in enumerate(['id'] + colNames): dataset.attrs['column_%d'%i] = column
+            if 'delay' in colNames: dataset.attrs['column_%d_units'%(len(colNames))] = 'ms'
+            keys = ['indexPre', 'indexPost', 'weight', 'delay'][:len(colNames)]
+            for start in xrange(0, numRows, _chunkRows):
+                stop = min(start+_chunkRows, numRows)
+                rows = np.empty((stop-start, len(colNames)+1), dtype='float32')
+                rows[:, 0] = np.arange(start, stop)
+                for i, key in enumerate(keys): rows[:, i+1] = _columnArray(columns[key])[start:stop]
+                dataset[start:stop] = rows
+
+
+
+###############################################################################
+### Write LEMS file to simulate exported network
+###############################################################################  
+def _writeLems (reference, nml_file_name, populations, includes=[], seed=1234):
+    ''' Writes LEMS_<reference>.xml to simulate the network file, with a display and an output file of v of the cells of each
+        population; built from the populations already in memory (id, component, size), without reading the network file back '''
+    import random
+    from pyneuroml.lems import LEMSSimulation, safe_variable
+
+    sim_id = "Sim_%s"%reference
+    ls = LEMSSimulation(sim_id, sim.cfg.duration, sim.cfg.dt, reference)
+    ls.include_neuroml2_file(nml_file_name, include_included=False)
+    for include in includes: ls.include_neuroml2_file(include, include_included=False)
+    my_random = random.Random(seed)  # same line colors in each export
+
+    for pop in populations:
+        if pop['locations'] is not None:  # populationList
+            quantity_template = "%s/%i/"+pop['component']+"/v"
+        else:
+            quantity_template = "%s[%i]/v"
+
+        display_id = 'DispPop__%s'%pop['id']
+        ls.create_display(display_id, "Membrane potentials of cells in %s"%pop['id'], "-90", "50")
+        for i in xrange(pop['size']):
+            ls.add_line_to_display(display_id, "%s[%i]: v"%(pop['id'], i), quantity_template%(pop['id'], i), "1mV", pynml.get_next_hex_color(my_random))
+
+        output_id = 'Volts_file__%s'%pop['id']
+        ls.create_output_file(output_id, "%s.%s.v.dat"%(sim_id, pop['id']))
+        for i in xrange(pop['size']):
+            ls.add_column_to_output_file(output_id, 'v_%s'%safe_variable(quantity_template%(pop['id'], i)), quantity_template%(pop['id'], i))
+
+    ls.save_to_file(file_name='LEMS_%s.xml'%reference)
+
+
+###############################################################################
+### Add conns to a cell in bulk (used when importing from NeuroML2)
+###############################################################################
+def _addCellConns (cell, connsParams):
+    ''' Adds list of conns (single synapse, no shape or plasticity) to a cell, with the same result as calling
+        cell.addConn() for each, but creating all NEURON objects in one pass via cell.addConnsNEURONObj() '''
+    from specs import Dict
+
+    # artificial cells (point process with V not in section), or no python structure to create NEURON objs from: one by one
+    if not sim.cfg.createPyStruct or any('vref' in pointp for sec in cell.secs.itervalues() for pointp in sec.get('pointps', {}).itervalues()):
+        for params in connsParams:
+            cell.addConn(params=params)
+        return
+
+    if sim.net.params.scaleConnWeightModels.get(cell.tags.get('cellModel'), None) is not None:
+        scaleFactor = sim.net.params.scaleConnWeightModels[cell.tags['cellModel']]  # use scale factor specific for this cell model
+    else:
+        scaleFactor = sim.net.params.scaleConnWeight # use global scale factor
+
+    conns = []
+    for params in connsParams:
+        if params['preGid'] == cell.gid: continue  # avoid self connections
+        secLabels = [params['sec']] if params['sec'] in cell.secs else cell._setConnSections(params)
+        if secLabels == -1: continue  # no section available
+        sec = secLabels[0]
+
+        conn = Dict(params)
+        conn['sec'] = sec
+        conn['weight'] = scaleFactor * params['weight']
+        if 'weightNorm' in cell.secs[sec] and isinstance(cell.secs[sec]['weightNorm'], list):  # normalization based on section location
+            nseg = cell.secs[sec]['geom']['nseg']
+            conn['weight'] = conn['weight'] * cell.secs[sec]['weightNorm'][int(round(conn['loc']*nseg))-1]
+        conns.append(conn)
+
+    cell.conns.extend(conns)
+    if sim.cfg.createNEURONObj:
+        cell.addConnsNEURONObj(conns)  # also adds synMechs
+    else:
+        for sec, synMech, loc in OrderedDict.fromkeys((conn['sec'], conn['synMech'], conn['loc']) for conn in conns):
+            cell.addSynMech(synMech, sec, loc)
 
 
 if neuromlExists:
@@ -184,7 +350,10 @@ if neuromlExists:
     ###############################################################################
     ### Export generated structure of network to NeuroML 2 
     ###############################################################################         
-    def exportNeuroML2 (reference, connections=True, stimulations=True):
+    def exportNeuroML2 (reference, connections=True, stimulations=True, fileFormat='xml'):
+        ''' Exports network to reference.net.nml (fileFormat='xml') or to NeuroML2 HDF5 network file reference.net.nml.h5
+            (fileFormat='hdf5'; requires h5py), plus LEMS file. Cells and conns are grouped into populations and projections 
+            in a single pass, and instances and conns are written to file in chunks, without creating NeuroML objects. '''
 
         net = sim.net
         
@@ -193,9 +362,7 @@ if neuromlExists:
         import neuroml
         import neuroml.writers as writers
 
-        nml_doc = neuroml.NeuroMLDocument(id='%s'%reference)
-        nml_net = neuroml.Network(id='%s'%reference)
-        nml_doc.networks.append(nml_net)
+        nml_doc = neuroml.NeuroMLDocument(id='%s'%reference)  # network is streamed to file after the rest of the document
 
         import netpyne
         nml_doc.notes = 'NeuroML 2 file exported from NetPyNE v%s'%(netpyne.__version__)
@@ -427,112 +594,58 @@ if neuromlExists:
                 cells_added.append(str(cell_param_set))
                 
             
+        # assign consecutive indices to cells of each population in a single pass over cells
+        populations = []
         for np_pop in net.pops.values(): 
-            index = 0
-            print("Adding population: %s"%np_pop.tags)
-            positioned = len(np_pop.cellGids)>0
-            type = 'populationList'
             if not np_pop.tags['cellModel'] ==  'NetStim':
-                comp_id = populations_vs_components[np_pop.tags['popLabel']]
-                pop = neuroml.Population(id=np_pop.tags['popLabel'],component=comp_id, type=type)
-                nml_net.populations.append(pop)
-
-                for cell in net.cells:
-                    if cell.gid in np_pop.cellGids:
-                        gids_vs_pop_indices[cell.gid] = (np_pop.tags['popLabel'],index)
-                        inst = neuroml.Instance(id=index)
-                        index+=1
-                        pop.instances.append(inst)
-                        inst.location = neuroml.Location(cell.tags['x'],cell.tags['y'],cell.tags['z'])
-                
-                pop.size = index
+                print("Adding population: %s"%np_pop.tags)
+                populations.append({'id': np_pop.tags['popLabel'], 'component': populations_vs_components[np_pop.tags['popLabel']], 'locations': []})
+        pops_by_label = {pop['id']: pop for pop in populations}
+
+        for cell in net.cells:
+            pop = pops_by_label.get(cell.tags.get('popLabel'))
+            if pop is None: continue
+            gids_vs_pop_indices[cell.gid] = (pop['id'], len(pop['locations']))
+            pop['locations'].append((cell.tags['x'],cell.tags['y'],cell.tags['z']))
+
+        for pop in populations:
+            pop['size'] = len(pop['locations'])
                 
         syn_types = _export_synapses(net, nml_doc)
 
+        projections = []
         if connections:
             nn = _convertNetworkRepresentation(net, gids_vs_pop_indices)
 
-            half_elect_conns_added = []
-            for proj_info in nn.keys():
+            half_elect_conns_added = set()
+            for proj_info, columns in nn.iteritems():
 
                 prefix = "NetConn"
                 popPre,popPost,synMech = proj_info
                 if sim.cfg.verbose: print("Adding proj: %s->%s (%s)"%(popPre,popPost,synMech))
+
+                proj = {'id': "%s_%s_%s_%s"%(prefix,popPre, popPost,synMech), 'type': 'projection', 'pre': popPre, 'post': popPost, 'synapse': synMech,
+                        'preCellId': "../%s/%%d/%s"%(popPre, populations_vs_components[popPre]),
+                        'postCellId': "../%s/%%d/%s"%(popPost, populations_vs_components[popPost]), 'columns': columns}
                 
-                if syn_types[synMech]!='ElectSyn':
-                    projection = neuroml.Projection(id="%s_%s_%s_%s"%(prefix,popPre, popPost,synMech), 
-                                      presynaptic_population=popPre, 
-                                      postsynaptic_population=popPost, 
-                                      synapse=synMech)
-                                      
-                    nml_net.projections.append(projection)
-                else:
-                    
-                    projection = neuroml.ElectricalProjection(id="%s_%s_%s_%s"%(prefix,popPre, popPost,synMech), 
-                                      presynaptic_population=popPre, 
-                                      postsynaptic_population=popPost)
-                                      
-                    nml_net.electrical_projections.append(projection)
-                    
-                index = 0    
-                
-                
-                for conn in nn[proj_info]:
-                    if sim.cfg.verbose: print("Adding conn %s"%conn)
-                    
-                    if syn_types[synMech]!='ElectSyn':
-                        connection = neuroml.ConnectionWD(id=index, \
-                                    pre_cell_id="../%s/%i/%s"%(popPre, conn['indexPre'], populations_vs_components[popPre]), \
-                                    pre_segment_id=0, \
-                                    pre_fraction_along=0.5,
-                                    post_cell_id="../%s/%i/%s"%(popPost, conn['indexPost'], populations_vs_components[popPost]), \
-                                    post_segment_id=0,
-                                    post_fraction_along=0.5,
-                                    delay = '%s ms'%conn['delay'],
-                                    weight = conn['weight'])
-                                    
-                        projection.connection_wds.append(connection)
-                        
-                    else:
-                        ''' <electricalConnectionInstance id="0" preCell="../iafPop1/0/iaf" postCell="../iafPop2/0/iaf" preSegment="0" 
-                           preFractionAlong="0.5" postSegment="0" postFractionAlong="0.5" synapse="gj1"/>'''
-        
-                        connection = neuroml.ElectricalConnectionInstance(id=index, \
-                                    pre_cell="../%s/%i/%s"%(popPre, conn['indexPre'], populations_vs_components[popPre]), \
-                                    pre_segment=0, \
-                                    pre_fraction_along=0.5,
-                                    post_cell="../%s/%i/%s"%(popPost, conn['indexPost'], populations_vs_components[popPost]), \
-                                    post_segment=0,
-                                    post_fraction_along=0.5, 
-                                    synapse=synMech)
-                                    
-                        other_half_elect_conn = "%s_%s_%s_%s -> %s_%s_%s_%s"%(popPost,
-                                                                      connection.post_cell,
-                                                                            connection.post_segment,
-                                                                            connection.post_fraction_along,
-                                                                            popPre,
-                                                                            connection.pre_cell,
-                                                                            connection.pre_segment,
-                                                                            connection.pre_fraction_along)
-                                                                            
-                        if not other_half_elect_conn in half_elect_conns_added:
-                            projection.electrical_connection_instances.append(connection)
-                            half_elect_conns_added.append("%s_%s_%s_%s -> %s_%s_%s_%s"%(popPre,
-                                                                            connection.pre_cell,
-                                                                            connection.pre_segment,
-                                                                            connection.pre_fraction_along,
-                                                                            popPost,
-                                                                            connection.post_cell,
-                                                                            connection.post_segment,
-                                                                            connection.post_fraction_along))
-                        
-                    index+=1
+                if syn_types[synMech]=='ElectSyn':
+                    # keep only one half of each gap junction (pre->post or post->pre)
+                    proj['type'] = 'electricalProjection'
+                    halfColumns = _newColumns(indexPre='l', indexPost='l')
+                    for indexPre, indexPost in zip(columns['indexPre'], columns['indexPost']):
+                        if (popPost, indexPost, popPre, indexPre) not in half_elect_conns_added:
+                            halfColumns['indexPre'].append(indexPre)
+                            halfColumns['indexPost'].append(indexPost)
+                            half_elect_conns_added.add((popPre, indexPre, popPost, indexPost))
+                    proj['columns'] = halfColumns
+
+                projections.append(proj)
 
 
         if stimulations:
             stims = _convertStimulationRepresentation(net, gids_vs_pop_indices, nml_doc)
 
-            for stim_info in stims.keys():
+            for stim_info, columns in stims.iteritems():
                 name_stim, post_pop, rate, noise, synMech = stim_info
 
                 if sim.cfg.verbose: print("Adding stim: %s"%[stim_info])
@@ -546,59 +659,40 @@ if neuromlExists:
                 else:
                     raise Exception("Noise = %s is not yet supported!"%noise)
 
+                numStims = len(columns['index'])
+                populations.append({'id': 'Pop_%s'%name_stim, 'component': source.id, 'size': numStims, 'locations': None})
 
-                stim_pop = neuroml.Population(id='Pop_%s'%name_stim,component=source.id,size=len(stims[stim_info]))
-                nml_net.populations.append(stim_pop)
-
-
-                proj = neuroml.Projection(id="NetConn_%s__%s"%(name_stim, post_pop), 
-                      presynaptic_population=stim_pop.id, 
-                      postsynaptic_population=post_pop, 
-                      synapse=synMech)
-
-                nml_net.projections.append(proj)
-
-                count = 0
-                for stim in stims[stim_info]:
-                    #print("  Adding stim: %s"%stim)
-
-                    connection = neuroml.ConnectionWD(id=count, \
-                            pre_cell_id="../%s[%i]"%(stim_pop.id, count), \
-                            pre_segment_id=0, \
-                            pre_fraction_along=0.5,
-                            post_cell_id="../%s/%i/%s"%(post_pop, stim['index'], populations_vs_components[post_pop]), \
-                            post_segment_id=0,
-                            post_fraction_along=0.5,
-                            delay = '%s ms'%stim['delay'],
-                            weight = stim['weight'])
-                    count+=1
-
-                    proj.connection_wds.append(connection)
+                projections.append({'id': "NetConn_%s__%s"%(name_stim, post_pop), 'type': 'projection', 'pre': 'Pop_%s'%name_stim, 'post': post_pop, 'synapse': synMech,
+                                    'preCellId': "../Pop_%s[%%d]"%(name_stim),
+                                    'postCellId': "../%s/%%d/%s"%(post_pop, populations_vs_components[post_pop]),
+                                    'columns': {'indexPre': array('l', xrange(numStims)), 'indexPost': columns['index'], 
+                                                'weight': columns['weight'], 'delay': columns['delay']}})
 
 
+        # write document without network (cells, synapses and inputs) using libNeuroML, and then stream network to file
         nml_file_name = '%s.net.nml'%reference
-
         writers.NeuroMLWriter.write(nml_doc, nml_file_name)
-
-
-        import pyneuroml.lems
-
-        pyneuroml.lems.generate_lems_file_for_neuroml("Sim_%s"%reference, 
-                                   nml_file_name, 
-                                   reference, 
-                                   sim.cfg.duration, 
-                                   sim.cfg.dt, 
-                                   'LEMS_%s.xml'%reference,
-                                   '.',
-                                   copy_neuroml = False,
-                                   include_extra_files = [],
-                                   gen_plots_for_all_v = False,
-                                   gen_plots_for_only_populations = populations_vs_components.keys(),
-                                   gen_saves_for_all_v = False,
-                                   plot_all_segments = False, 
-                                   gen_saves_for_only_populations = populations_vs_components.keys(),
-                                   save_all_segments = False,
-                                   seed=1234)
+        with open(nml_file_name, 'r') as fileObj:
+            top_level_xml = fileObj.read()
+
+        if fileFormat == 'hdf5':
+            import os
+            os.remove(nml_file_name)
+            nml_file_name = '%s.net.nml.h5'%reference
+            print("Writing network to NeuroML 2 HDF5 file: %s"%nml_file_name)
+            _writeNetworkHdf5(nml_file_name, nml_doc.id, nml_doc.notes, reference, populations, projections, top_level_xml)
+        else:
+            print("Writing network to NeuroML 2 file: %s"%nml_file_name)
+            head = top_level_xml.rstrip()
+            assert(head.endswith('</neuroml>'))
+            with open(nml_file_name, 'w') as fileObj:
+                fileObj.write(head[:-len('</neuroml>')])
+                _writeNetworkXml(fileObj, reference, populations, projections)
+                fileObj.write('</neuroml>\n')
+
+
+        _writeLems(reference, nml_file_name, [pop for pop in populations if pop['id'] in populations_vs_components], 
+                   includes=[include.href for include in nml_doc.includes], seed=1234)
                                
                                
                 
@@ -637,6 +731,9 @@ if neuromlExists:
 
         def __init__(self, netParams):
             self.netParams = netParams
+            self.sec_names = []  # names of postsynaptic sections of conns (conns store index in this list)
+            self.sec_ids = {}
+            self.seg_locations = {}  # section, and start and end of segment along section, of each (population, segment)
 
         def finalise(self):
 
@@ -936,23 +1033,22 @@ if neuromlExists:
                 
                 return self.pop_ids_vs_seg_ids_vs_segs[population_id][seg_id].name, fract_along
             else:
-                fract_sec = -1
-                for sec in self.pop_ids_vs_ordered_segs[population_id].keys():
-                    ind = 0
-                    for seg in self.pop_ids_vs_ordered_segs[population_id][sec]:
-                        if seg.id == seg_id:
-                            nrn_sec = sec
-                            if len(self.pop_ids_vs_ordered_segs[population_id][sec])==1:
-                                fract_sec = fract_along
-                            else:
-                                lens = self.pop_ids_vs_cumulative_lengths[population_id][sec]
-                                to_start = 0.0 if ind==0 else lens[ind-1]
-                                to_end = lens[ind]
-                                tot = lens[-1]
-                                #print to_start, to_end, tot, ind, seg, seg_id
-                                fract_sec = (to_start + fract_along *(to_end-to_start))/(tot)
-                            
-                        ind+=1
+                key = (population_id, seg_id)
+                if key not in self.seg_locations:  # computed once per segment
+                    for sec in self.pop_ids_vs_ordered_segs[population_id].keys():
+                        ind = 0
+                        for seg in self.pop_ids_vs_ordered_segs[population_id][sec]:
+                            if seg.id == seg_id:
+                                if len(self.pop_ids_vs_ordered_segs[population_id][sec])==1:
+                                    self.seg_locations[key] = (sec, None, None, None)
+                                else:
+                                    lens = self.pop_ids_vs_cumulative_lengths[population_id][sec]
+                                    to_start = 0.0 if ind==0 else lens[ind-1]
+                                    self.seg_locations[key] = (sec, to_start, lens[ind], lens[-1])
+                            ind+=1
+
+                nrn_sec, to_start, to_end, tot = self.seg_locations[key]
+                fract_sec = fract_along if tot is None else (to_start + fract_along *(to_end-to_start))/(tot)
                 #print("=============  Converted %s:%s on pop %s to %s on %s"%(seg_id, fract_along, population_id, nrn_sec, fract_sec))
                 return nrn_sec, fract_sec  
 
@@ -975,7 +1071,7 @@ if neuromlExists:
 
             self.log.debug("A projection: %s (%s) from %s -> %s with syn: %s" % (projName, type, prePop, postPop, synapse))
             self.projection_infos[projName] = (projName, prePop, postPop, synapse, type)
-            self.connections[projName] = []
+            self.connections[projName] = _newColumns(preGid='l', postGid='l', postSec='l', postFract='d', delay='d', weight='d')
 
         #
         #  Overridden from DefaultNetworkHandler
@@ -991,16 +1087,24 @@ if neuromlExists:
                                                         weight = 1):
 
 
-            pre_seg_name, pre_fract = self._convert_to_nrn_section_location(prePop,preSegId,preFract)
             post_seg_name, post_fract = self._convert_to_nrn_section_location(postPop,postSegId,postFract)
 
             #self.log.debug("A connection "+str(id)+" of: "+projName+": "+prePop+"["+str(preCellId)+"]."+pre_seg_name+"("+str(pre_fract)+")" \
             #                      +" -> "+postPop+"["+str(postCellId)+"]."+post_seg_name+"("+str(post_fract)+")"+", syn: "+ str(synapseType) \
             #                      +", weight: "+str(weight)+", delay: "+str(delay))
                                   
-            self.connections[projName].append( (self.gids[prePop][preCellId], pre_seg_name,pre_fract, \
-                                                self.gids[postPop][postCellId], post_seg_name, post_fract, \
-                                                delay, weight) )
+            if post_seg_name not in self.sec_ids:
+                self.sec_ids[post_seg_name] = len(self.sec_names)
+                self.sec_names.append(post_seg_name)
+
+            # append to columns of projection (conns are created in bulk after import, only for cells in each node)
+            columns = self.connections[projName]
+            columns['preGid'].append(self.gids[prePop][preCellId])
+            columns['postGid'].append(self.gids[postPop][postCellId])
+            columns['postSec'].append(self.sec_ids[post_seg_name])
+            columns['postFract'].append(post_fract)
+            columns['delay'].append(delay)
+            columns['weight'].append(weight)
 
 
 
@@ -1056,7 +1160,11 @@ if neuromlExists:
     ###############################################################################
     # Import network from NeuroML2
     ###############################################################################
-    def importNeuroML2(fileName, simConfig):
+    def importNeuroML2(fileName, simConfig, simulate=True):
+        ''' Imports network from NeuroML2 file (.nml or .h5): conns of each projection are collected in arrays while parsing,
+            and created in bulk only for cells in each node. If simulate is False, only the network is created (eg. to then 
+            cache it via sim.saveSnapshot()); otherwise, it is also simulated, saved and analyzed. '''
+        import numpy as np
 
         netParams = specs.NetParams()
 
@@ -1113,11 +1221,15 @@ if neuromlExists:
         cells = sim.net.createCells()                 # instantiate network cells based on defined populations  
 
 
+        sim.timing('start', 'connectTime')
+        localGids = np.array(sim.net.lid2gid, dtype='int64')
+
         # Check gids equal....
         for popLabel,pop in sim.net.pops.iteritems():
             #print("%s: %s, %s"%(popLabel,pop, pop.cellGids))
+            popGids = set(nmlHandler.gids[popLabel])
             for gid in pop.cellGids:
-                assert(gid in nmlHandler.gids[popLabel])
+                assert(gid in popGids)
             
         for proj_id in nmlHandler.projection_infos.keys():
             projName, prePop, postPop, synapse, ptype = nmlHandler.projection_infos[proj_id]
@@ -1143,30 +1255,48 @@ if neuromlExists:
             else:
                 threshold = 0
 
-            for conn in nmlHandler.connections[projName]:
-                
-                pre_id, pre_seg, pre_fract, post_id, post_seg, post_fract, delay, weight = conn
-                
-                connParam = {'delay':delay,'weight':weight,'synsPerConn':1, 'sec':post_seg, 'loc':post_fract, 'threshold':threshold}
-                
-                if ptype == 'electricalProjection':
-                    connParam = {'synsPerConn': 1, 
-                                 'sec': post_seg, 
-                                 'loc': post_fract, 
-                                 'gapJunction': True, 
-                                 'weight': 1}
+            # select conns of cells in this node, group them by postGid (keeping file order), and create them in bulk for each cell
+            columns = nmlHandler.connections[projName]
+            postGids = _columnArray(columns['postGid'])
+            local = np.flatnonzero(np.in1d(postGids, localGids))
+            local = local[np.argsort(postGids[local], kind='mergesort')]
+            values = {key: _columnArray(column)[local].tolist() for key, column in columns.iteritems()}
+            bounds = [0] + (np.flatnonzero(np.diff(postGids[local])) + 1).tolist() + [len(local)]
+
+            for start, end in zip(bounds[:-1], bounds[1:]):
+                if start == end: continue  # no local conns
+                cell = sim.net.cells[sim.net.gid2lid[values['postGid'][start]]]
+                connsParams = []
+                for pre_id, post_sec, post_fract, delay, weight in zip(values['preGid'][start:end], values['postSec'][start:end], 
+                                                                     values['postFract'][start:end], values['delay'][start:end], values['weight'][start:end]):
+                    if ptype == 'electricalProjection':
+                        params = {'preGid': pre_id, 
+                                  'sec': nmlHandler.sec_names[post_sec], 
+                                  'loc': post_fract, 
+                                  'synMech': synapse, 
+                                  'weight': 1, 
+                                  'delay': None, 
+                                  'synsPerConn': 1, 
+                                  'gapJunction': True}
+                    else:
+                        params = {'preGid': pre_id, 
+                                  'sec': nmlHandler.sec_names[post_sec], 
+                                  'loc': post_fract, 
+                                  'synMech': synapse, 
+                                  'weight': weight, 
+                                  'delay': delay, 
+                                  'threshold': threshold}
+
+                    if sim.cfg.includeParamsLabel: params['label'] = projName
+                    connsParams.append(params)
+
+                if ptype == 'electricalProjection':  # gap junctions also need pre gap junction params, so added one by one
+                    for params in connsParams:
+                        cell.addConn(params=params)
                 else:
-                    connParam = {'delay': delay,
-                                 'weight': weight,
-                                 'synsPerConn': 1, 
-                                 'sec': post_seg, 
-                                 'loc': post_fract, 
-                                 'threshold': threshold}
+                    _addCellConns(cell, connsParams)
 
-                connParam['synMech'] = synapse
-
-                if post_id in sim.net.lid2gid:  # check if postsyn is in this node's list of gids
-                    sim.net._addCellConn(connParam, pre_id, post_id)
+            del nmlHandler.connections[projName]  # free memory
                     
         
         # add gap junctions of presynaptic cells (need to do separately because could be in different ranks)
@@ -1176,16 +1306,21 @@ if neuromlExists:
                 cell.addConn(preGapParams)
                 
         print('  Number of connections on node %i: %i ' % (sim.rank, sum([len(cell.conns) for cell in sim.net.cells])))
+        sim.pc.barrier()
+        sim.timing('stop', 'connectTime')
+        if sim.rank == 0 and sim.cfg.timing: print('  Done; cell connection time = %0.2f s.' % sim.timingData['connectTime'])
 
                         
 
         #conns = sim.net.connectCells()                # create connections between cells based on params
         stims = sim.net.addStims()                    # add external stimulation to cells (IClamps etc)
         simData = sim.setupRecording()              # setup variables to record for each cell (spikes, V traces, etc)
-        sim.runSim()                      # run parallel Neuron simulation  
-        sim.gatherData()                  # gather spiking data and cell info from each node
-        sim.saveData()                    # save params, cell info and sim output to file (pickle,mat,txt,etc)
-        sim.analysis.plotData()               # plot spike raster
+
+        if simulate:
+            sim.runSim()                      # run parallel Neuron simulation  
+            sim.gatherData()                  # gather spiking data and cell info from each node
+            sim.saveData()                    # save params, cell info and sim output to file (pickle,mat,txt,etc)
+            sim.analysis.plotData()               # plot spike raster
         '''
         h('forall psection()')
         h('forall  if (ismembrane("na_ion")) { print "Na ions: ", secname(), ": ena: ", ena, ", nai: ", nai, ", nao: ", nao } ')
@@ -0,0 +1,412 @@
+"""
+partitionFuncs.py
+
+Contains functions to distribute cells across hosts and threads (eg. based on estimated or measured computational cost)
+
+Contributors: salvadordura@gmail.com
+"""
+
+__all__ = []
+__all__.extend(['estimateCellCost', 'loadCellCosts', 'saveCellCosts'])  # cell cost
+__all__.extend(['partitionCells', 'saveCellPartition', 'loadCellPartition', 'reportConnTraffic'])  # distribution of cells across hosts
+__all__.extend(['partitionThreads'])  # distribution of cells across threads
+
+import heapq
+from numbers import Number
+from neuron import h
+import sim
+
+
+pointCellCost = 0.1  # relative cost of an artificial cell (eg. NetStim, IntFire); 1 = single passive compartment
+_cellRuleCosts = {}  # cache of estimated costs for each cellParams rule
+_cellCostsFile = {}  # cache of measured cell costs loaded from file (read once per run)
+_cellCostsScale = {}  # cache of scale from estimated to measured costs for each file
+_cellPartitionFile = {}  # cache of cell partitions loaded from file
+
+
+###############################################################################
+### Check if cell tags match conditions of cellParams rule (same criteria used in CompartCell.create())
+###############################################################################
+def _cellRuleConds (tags, conds):
+    for (condKey,condVal) in conds.iteritems():  # check if all conditions are met
+        if isinstance(condVal, list):
+            if isinstance(condVal[0], Number):
+                if tags.get(condKey) < condVal[0] or tags.get(condKey) > condVal[1]:
+                    return False
+            elif isinstance(condVal[0], basestring):
+                if tags.get(condKey) not in condVal:
+                    return False
+        elif tags.get(condKey) != condVal:
+            return False
+    return True
+
+
+###############################################################################
+### Clear cached cell costs and partitions (eg. between batch runs with different cellParams)
+###############################################################################
+def _clearCellCosts ():
+    _cellRuleCosts.clear()
+    _cellCostsFile.clear()
+    _cellCostsScale.clear()
+    _cellPartitionFile.clear()
+
+
+###############################################################################
+### Estimate cost of cellParams rule based on num of compartments, mechanisms and synapses
+###############################################################################
+def _cellRuleCost (ruleLabel, rule):
+    if ruleLabel not in _cellRuleCosts:
+        cost = 0.0
+        for sec in rule.get('secs', {}).values():
+            nseg = sec.get('geom', {}).get('nseg', 1)
+            nmechs = len(sec.get('mechs', {})) + len(sec.get('ions', {}))
+            nsyns = len(sec.get('synMechs', [])) + len(sec.get('pointps', {}))
+            cost += nseg * (1 + nmechs) + nsyns  # each mechanism is computed at every segment
+        _cellRuleCosts[ruleLabel] = cost
+    return _cellRuleCosts[ruleLabel]
+
+
+###############################################################################
+### Estimate computational cost of a cell from its tags and the cellParams rules
+###############################################################################
+def estimateCellCost (tags, pointCell=False):
+    if pointCell:
+        return pointCellCost
+    cost = sum([_cellRuleCost(label, rule) for label, rule in sim.net.params.cellParams.iteritems()
+                if _cellRuleConds(tags, rule['conds'])])
+    return cost if cost > 0 else 1.0  # cells without matching rules have at least 1 compartment
+
+
+###############################################################################
+### Load measured cell costs from file (saved with saveCellCosts())
+###############################################################################
+def loadCellCosts (filename):
+    if filename not in _cellCostsFile:
+        import json
+        with open(filename, 'r') as fileObj:
+            data = json.load(fileObj)
+        _cellCostsFile[filename] = {int(gid): cost for gid, cost in data['costs'].iteritems()}
+        _cellCostsScale[filename] = data.get('estimateScale')
+        if sim.rank == 0:
+            print('  Loaded measured costs of %d cells from %s (profiled on %d hosts)' % (len(_cellCostsFile[filename]), filename, data.get('nhosts', 0)))
+            if not _cellCostsScale[filename]:
+                print('  Warning: %s has no scale between estimated and measured costs; using estimated costs for all cells' % (filename))
+    return _cellCostsFile[filename]
+
+
+###############################################################################
+### Cost of a cell: measured (cfg.cellCostFile) or estimated, in the same units
+###############################################################################
+def _cellCost (gid, tags, pointCell=False):
+    estimate = estimateCellCost(tags, pointCell)
+    filename = getattr(sim.cfg, 'cellCostFile', None)
+    if not filename:
+        return estimate
+    measuredCosts = loadCellCosts(filename)
+    scale = _cellCostsScale[filename]
+    if not scale:  # measured costs (seconds) can't be compared with estimates (unitless)
+        return estimate
+    return estimate*scale if gid not in measuredCosts else measuredCosts[gid]
+
+
+###############################################################################
+### Save measured cell costs after running a simulation
+###############################################################################
+def saveCellCosts (filename=None):
+    ''' Estimates the cost of each cell from the computation time of each host (pc.step_time()),
+        so it can be used to distribute cells in future runs (cfg.cellCostFile) '''
+    import numpy as np
+
+    if not filename: filename = sim.cfg.filename+'_cellCosts.json'
+
+    # estimated cost of each local cell, grouped by pop (cells of the same pop assumed to have similar cost)
+    popLabels = list(sim.net.pops.keys())
+    estCosts = {cell.gid: estimateCellCost(cell.tags, isinstance(cell, sim.PointCell)) for cell in sim.net.cells}
+    popEstCosts = [0.0]*len(popLabels)
+    cellPops = {}
+    for cell in sim.net.cells:
+        ipop = popLabels.index(cell.tags['popLabel'])
+        popEstCosts[ipop] += estCosts[cell.gid]
+        cellPops[cell.gid] = ipop
+
+    nodeData = {'stepTime': sim.pc.step_time(), 'popEstCosts': popEstCosts, 'estCosts': estCosts, 'cellPops': cellPops}
+    data = [None]*sim.nhosts
+    data[0] = nodeData
+    gather = sim.pc.py_alltoall(data)
+    sim.pc.barrier()
+
+    if sim.rank == 0:
+        # fit a scale factor per pop so that the estimated costs of each host match its measured computation time
+        A = np.array([node['popEstCosts'] for node in gather])
+        t = np.array([node['stepTime'] for node in gather])
+        used = A.sum(axis=0) > 0
+        popScale = np.zeros(len(popLabels))
+        if np.linalg.matrix_rank(A[:, used]) == used.sum():
+            popScale[used] = np.linalg.lstsq(A[:, used], t)[0]
+
+        costs = {}
+        if all(popScale[used] > 0):
+            print('  Cell costs fitted per population from computation time of %d hosts' % (sim.nhosts))
+            for node in gather:
+                for gid, est in node['estCosts'].iteritems():
+                    costs[gid] = est * popScale[node['cellPops'][gid]]
+        else:  # not enough info to fit each pop (eg. all hosts have same mixture of cells), so scale costs of each host
+            print('  Cell costs scaled by computation time of each host')
+            for node in gather:
+                totalEst = sum(node['estCosts'].values())
+                for gid, est in node['estCosts'].iteritems():
+                    costs[gid] = est * node['stepTime'] / totalEst if totalEst > 0 else 0.0
+
+        # scale to convert estimated costs of cells missing from file (eg. added in later runs) to measured units
+        totalEst = sum([sum(node['estCosts'].values()) for node in gather])
+        estimateScale = sum(costs.values()) / totalEst if totalEst > 0 else 0.0
+
+        import json
+        print('Saving cell costs to %s ... ' % (filename))
+        with open(filename, 'w') as fileObj:
+            json.dump({'nhosts': sim.nhosts, 'duration': sim.cfg.duration, 'estimateScale': estimateScale, 'costs': costs}, fileObj)
+        print('Finished saving!')
+
+    # clean to avoid mem leaks
+    for node in gather:
+        if node:
+            node.clear()
+            del node
+
+
+###############################################################################
+### Distribute cells of a population across hosts
+###############################################################################
+def partitionCells (cellsTags, firstGid, pointCell=False):
+    ''' Returns dict with list of relative cell indices assigned to each host,
+        using the method set in cfg.cellPartition:
+        - 'roundRobin': assign consecutive cells to consecutive hosts (continues from last host used by previous pop)
+        - 'cost': assign each cell to the host with lowest accumulated cost (estimated from cellParams rules, or measured from cfg.cellCostFile)
+        - 'spatial': split the x-z plane of each pop into one tile per host with equal num of cells, so nearby cells are in same host
+        - 'file': use gid-to-host map from cfg.cellPartitionFile (eg. connectivity graph partition saved via saveCellPartition())'''
+    numCells = len(cellsTags)
+    hostCells = {i: [] for i in range(sim.nhosts)}
+    method = getattr(sim.cfg, 'cellPartition', 'roundRobin')
+
+    if method == 'cost':
+        costs = [_cellCost(firstGid+i, tags, pointCell) for i, tags in enumerate(cellsTags)]
+
+        # greedy longest-processing-time: most costly cells first, each to the host with lowest load
+        hostLoads = [(load, host) for host, load in enumerate(sim.hostLoads)]
+        heapq.heapify(hostLoads)
+        for i in sorted(range(numCells), key=lambda i: -costs[i]):
+            load, host = heapq.heappop(hostLoads)
+            hostCells[host].append(i)
+            heapq.heappush(hostLoads, (load+costs[i], host))
+        for load, host in hostLoads:
+            sim.hostLoads[host] = load
+        for host in hostCells:
+            hostCells[host].sort()
+
+    elif method == 'spatial':
+        for host, cellInds in enumerate(_spatialTiles(cellsTags, sim.nhosts)):
+            hostCells[host] = sorted(cellInds)
+
+    elif method == 'file':
+        partition = loadCellPartition(sim.cfg.cellPartitionFile)
+        for i in range(numCells):
+            host = partition.get(firstGid+i)
+            if host is None:  # cells missing from file distributed round robin
+                host = sim.nextHost
+                sim.nextHost = (sim.nextHost+1) % sim.nhosts
+            hostCells[host % sim.nhosts].append(i)
+
+    else:
+        if method != 'roundRobin':
+            print('  Warning: cell partition method %s not recognized; using roundRobin' % (method))
+        for i in range(numCells):
+            hostCells[sim.nextHost].append(i)
+            sim.nextHost+=1
+            if sim.nextHost>=sim.nhosts:
+                sim.nextHost=0
+
+    return hostCells
+
+
+###############################################################################
+### Split cells into spatial tiles (x-z plane) with equal num of cells
+###############################################################################
+def _spatialTiles (cellsTags, numTiles):
+    # num of tiles along x and z, as close as possible to square tiles (given network size)
+    ratio = float(sim.net.params.sizeX) / float(sim.net.params.sizeZ) if sim.net.params.sizeZ else 1.0
+    divisors = [nx for nx in range(1, numTiles+1) if numTiles % nx == 0]
+    numX = min(divisors, key=lambda nx: abs(float(nx)/(numTiles/nx) - ratio))
+    numZ = numTiles / numX
+
+    # sort cells along x and split in strips; then sort each strip along z and split in tiles 
+    tiles = []
+    byX = sorted(range(len(cellsTags)), key=lambda i: (cellsTags[i].get('xnorm', 0), i))
+    for ix in range(numX):
+        strip = byX[len(byX)*ix/numX : len(byX)*(ix+1)/numX]
+        byZ = sorted(strip, key=lambda i: (cellsTags[i].get('znorm', 0), i))
+        for iz in range(numZ):
+            tiles.append(byZ[len(byZ)*iz/numZ : len(byZ)*(iz+1)/numZ])
+    return tiles
+
+
+###############################################################################
+### Load cell partition (gid to host map) from file
+###############################################################################
+def loadCellPartition (filename):
+    if filename not in _cellPartitionFile:
+        import json
+        with open(filename, 'r') as fileObj:
+            data = json.load(fileObj)
+        _cellPartitionFile[filename] = {int(gid): host for gid, host in data['partition'].iteritems()}
+        if sim.rank == 0:
+            print('  Loaded partition of %d cells from %s (%d hosts)' % (len(_cellPartitionFile[filename]), filename, data['nhosts']))
+            if data['nhosts'] != sim.nhosts:
+                print('  Warning: partition computed for %d hosts but running on %d hosts' % (data['nhosts'], sim.nhosts))
+    return _cellPartitionFile[filename]
+
+
+###############################################################################
+### Partition cells based on connectivity graph and save to file
+###############################################################################
+def saveCellPartition (filename=None, nhosts=None):
+    ''' Partitions the network connectivity graph (from sim.net.allCells, after gatherData()) into subsets
+        of equal cost with few connections between them, using greedy graph growing, and saves the 
+        gid-to-host map so it can be used in future runs (cfg.cellPartition='file' and cfg.cellPartitionFile)'''
+    if sim.rank != 0: return
+    if not getattr(sim.net, 'allCells', None) or not any(cell['conns'] for cell in sim.net.allCells):
+        print('Error: cell partition requires sim.net.allCells with conns; please call sim.gatherData() with cfg.saveCellConns=True')
+        return
+    if not filename: filename = sim.cfg.filename+'_cellPartition.json'
+    if not nhosts: nhosts = sim.nhosts
+
+    # undirected connectivity graph and cost of each cell
+    neighbors = {cell['gid']: set() for cell in sim.net.allCells}
+    costs = {}
+    for cell in sim.net.allCells:
+        gid = cell['gid']
+        pointCell = sim.net.pops[cell['tags']['popLabel']].cellModelClass == sim.PointCell
+        costs[gid] = _cellCost(gid, cell['tags'], pointCell=pointCell)
+        for conn in cell['conns']:
+            preGid = conn.get('preGid')
+            if isinstance(preGid, Number) and preGid in neighbors and preGid != gid:
+                neighbors[gid].add(preGid)
+                neighbors[preGid].add(gid)
+
+    # grow each part from a seed, adding the unassigned cell with most conns to the part, until reaching target cost
+    partition = {}
+    unassigned = sorted(neighbors.keys())
+    remainingCost = float(sum(costs.values()))
+    iseed = 0
+    for host in range(nhosts):
+        targetCost = remainingCost / (nhosts - host)
+        partCost = 0.0
+        gains = {}
+        frontier = []
+        while partCost < targetCost or host == nhosts-1:
+            while frontier and (frontier[0][1] in partition or -frontier[0][0] != gains.get(frontier[0][1])):
+                heapq.heappop(frontier)  # discard assigned cells and outdated gains
+            if frontier:
+                gid = heapq.heappop(frontier)[1]
+            else:  # no connected cells left; start from next unassigned cell
+                while iseed < len(unassigned) and unassigned[iseed] in partition: iseed += 1
+                if iseed == len(unassigned): break
+                gid = unassigned[iseed]
+            partition[gid] = host
+            partCost += costs[gid]
+            for neighbor in neighbors[gid]:
+                if neighbor not in partition:
+                    gains[neighbor] = gains.get(neighbor, 0) + 1
+                    heapq.heappush(frontier, (-gains[neighbor], neighbor))
+        remainingCost -= partCost
+
+    numCut = sum([1 for gid in neighbors for neighbor in neighbors[gid] if partition[gid] != partition[neighbor]]) / 2
+    numEdges = sum([len(n) for n in neighbors.values()]) / 2
+    print('  Partitioned %d cells into %d hosts; %d of %d cell pairs connected across hosts' % (len(partition), nhosts, numCut, numEdges))
+
+    import json
+    print('Saving cell partition to %s ... ' % (filename))
+    with open(filename, 'w') as fileObj:
+        json.dump({'nhosts': nhosts, 'partition': partition}, fileObj)
+    print('Finished saving!')
+
+    return partition
+
+
+###############################################################################
+### Count local and remote connections in each host (estimate of spike exchange traffic)
+###############################################################################
+def reportConnTraffic ():
+    numLocal, numRemote = 0, 0
+    remotePreGids = set()
+    for cell in sim.net.cells:
+        for conn in cell.conns:
+            preGid = conn.get('preGid')
+            if not isinstance(preGid, Number) or conn.get('gapJunction'):  # skip NetStims and gap junctions
+                continue
+            if preGid in sim.net.gid2lid:
+                numLocal += 1
+            else:
+                numRemote += 1
+                remotePreGids.add(preGid)
+
+    nodeData = {'local': numLocal, 'remote': numRemote, 'remotePreCells': len(remotePreGids), 'cells': len(sim.net.cells)}
+    if sim.nhosts > 1:
+        data = [None]*sim.nhosts
+        data[0] = nodeData
+        gather = sim.pc.py_alltoall(data)
+        sim.pc.barrier()
+    else:
+        gather = [nodeData]
+
+    if sim.rank == 0:
+        print('  Connection traffic per node (local = presyn cell in same node):')
+        for node, traffic in enumerate(gather):
+            total = traffic['local'] + traffic['remote']
+            print('    Node %d: %d cells; %d local, %d remote conns (%.1f%% local); %d remote presyn cells' % (node, traffic['cells'], 
+                traffic['local'], traffic['remote'], 100.0*traffic['local']/total if total else 0.0, traffic['remotePreCells']))
+        totalLocal = sum([traffic['local'] for traffic in gather])
+        totalRemote = sum([traffic['remote'] for traffic in gather])
+        total = totalLocal + totalRemote
+        print('    Total: %d local, %d remote conns (%.1f%% local); %d remote presyn cell subscriptions' % (totalLocal, totalRemote, 
+            100.0*totalLocal/total if total else 0.0, sum([traffic['remotePreCells'] for traffic in gather])))
+        return gather
+
+
+###############################################################################
+### Set num of threads and distribute cells of this host across threads
+###############################################################################
+def partitionThreads ():
+    ''' Sets the num of threads of this host (cfg.nthreads) and assigns the root section of each cell to the thread 
+        with lowest accumulated cost (estimated, or measured from cfg.cellCostFile); artificial cells run in thread 0 '''
+    nthreads = int(sim.cfg.nthreads)
+    sim.pc.nthread(nthreads, 1)  # 1 = threads run in parallel
+    if nthreads == 1: return
+
+    cellRoots = []
+    for cell in sim.net.cells:
+        secs = getattr(cell, 'secs', None) if isinstance(cell, sim.CompartCell) else None
+        hSec = next((sec['hSec'] for sec in secs.values() if sec.get('hSec') is not None), None) if secs else None
+        if hSec is not None:
+            cellRoots.append((_cellCost(cell.gid, cell.tags), h.SectionRef(sec=hSec).root))
+
+    # add other root sections (not part of cells) with min cell cost, since all root sections need to be assigned to a thread
+    minCost = min([cost for cost, root in cellRoots]) if cellRoots else 0.0
+    cellRootNames = set([root.name() for cost, root in cellRoots])
+    for sec in h.allsec():
+        if not h.SectionRef(sec=sec).has_parent() and sec.name() not in cellRootNames:
+            cellRoots.append((minCost, sec))
+            cellRootNames.add(sec.name())
+
+    # assign largest cells first to thread with lowest cost
+    threadLoads = [(0.0, ith) for ith in range(nthreads)]
+    sim.threadSecLists = [h.SectionList() for ith in range(nthreads)]
+    for cost, root in sorted(cellRoots, key=lambda x: -x[0]):
+        load, ith = heapq.heappop(threadLoads)
+        sim.threadSecLists[ith].append(sec=root)
+        heapq.heappush(threadLoads, (load+cost, ith))
+    for ith, secList in enumerate(sim.threadSecLists):
+        sim.pc.partition(ith, secList)
+
+    if sim.cfg.verbose:
+        print('  Node %d: distributed %d root sections across %d threads; thread costs: %s' % (sim.rank, len(cellRoots), nthreads, 
+            ', '.join(['%.3g' % load for load, ith in sorted(threadLoads, key=lambda x: x[1])])))
@@ -10,6 +10,7 @@ Contributors: salvadordura@gmail.com
 from matplotlib.pylab import arange, seed, rand, array, pi, sqrt, sin, cos, arccos
 import numpy as np
 from neuron import h # Import NEURON
+from partitionFuncs import _cellRuleConds
 import sim
 
 
@@ -28,24 +29,57 @@ class Pop (object):
         self._setCellClass()
 
 
-    def _distributeCells(self, numCellsPop):
-            
-        hostCells = {}
-        for i in range(sim.nhosts):
-            hostCells[i] = []
-            
-        for i in range(numCellsPop):
-            hostCells[sim.nextHost].append(i)
-            
-            sim.nextHost+=1
-            if sim.nextHost>=sim.nhosts:
-                sim.nextHost=0
+    @classmethod
+    def fromTags (cls, label, tags, cellGids=None):
+        ''' Creates population from tags already processed when it was created (eg. loaded from file), without modifying them '''
+        pop = cls.__new__(cls)
+        pop.tags = tags
+        pop.tags['popLabel'] = label
+        pop.cellGids = cellGids if cellGids is not None else []
+        pop._setCellClass(moveParams=False)
+        return pop
+
+
+    def _distributeCells(self, cellsTags):
+        # distribute cells across hosts (round robin by default, or based on cell costs; see sim.partitionCells())
+        hostCells = sim.partitionCells(cellsTags, sim.net.lastGid, pointCell=(self.cellModelClass == sim.PointCell))
         
         if sim.cfg.verbose: 
-            print("Distributed population of %i cells on %s hosts: %s, next: %s"%(numCellsPop,sim.nhosts,hostCells,sim.nextHost))
+            print("Distributed population of %i cells on %s hosts: %s, next: %s"%(len(cellsTags),sim.nhosts,hostCells,sim.nextHost))
+
+        # keep tags of all cells, so don't need to gather them from other nodes to make conns (local cells share same tags dict)
+        localCells = set(hostCells[sim.rank])
+        for i, cellTags in enumerate(cellsTags):
+            if i not in localCells:
+                self._setRemoteCellTags(cellTags)
+        if isinstance(sim.net.allCellTags, sim.CellTagsColumns):  # encoded as columns (cfg.sharedMemory)
+            if sim.net.allCellTags.store:
+                sim.net.allCellTags.addCells(sim.net.lastGid, [self._createdCellTags(cellTags) if i in localCells else cellTags 
+                                                               for i, cellTags in enumerate(cellsTags)])
+        else:
+            for i, cellTags in enumerate(cellsTags):
+                sim.net.allCellTags[sim.net.lastGid+i] = cellTags
         return hostCells
 
 
+    def _setRemoteCellTags(self, cellTags):
+        # modify tags of cells in other nodes in the same way as done when the cell is created in its own node
+        if self.cellModelClass == sim.PointCell:
+            cellTags.pop('params', None)
+        elif self.cellModelClass == sim.CompartCell and sim.cfg.includeParamsLabel:
+            for propLabel, prop in sim.net.params.cellParams.iteritems():
+                if _cellRuleConds(cellTags, prop['conds']):
+                    cellTags.setdefault('label', []).append(propLabel)
+
+
+    def _createdCellTags(self, cellTags):
+        # copy of tags of a local cell, modified in the same way as will be done when the cell is created
+        cellTags = dict(cellTags)
+        if 'label' in cellTags: cellTags['label'] = list(cellTags['label'])
+        self._setRemoteCellTags(cellTags)
+        return cellTags
+
+
     # Function to instantiate Cell objects based on the characteristics of this population
     def createCells(self):
         # add individual cells
@@ -110,9 +144,8 @@ class Pop (object):
                 maxv = self.tags[coord+'normRange'][1] 
                 randLocs[:,icoord] = randLocs[:,icoord] * (maxv-minv) + minv
 
-        for i in self._distributeCells(int(sim.net.params.scale * self.tags['numCells']))[sim.rank]:
-            gid = sim.net.lastGid+i
-            self.cellGids.append(gid)  # add gid list of cells belonging to this population - not needed?
+        cellsTags = []
+        for i in range(int(sim.net.params.scale * self.tags['numCells'])):
             cellTags = {k: v for (k, v) in self.tags.iteritems() if k in sim.net.params.popTagsCopiedToCells}  # copy all pop tags to cell tags, except those that are pop-specific
             cellTags['popLabel'] = self.tags['popLabel']
             cellTags['xnorm'] = randLocs[i,0] # set x location (um)
@@ -121,7 +154,12 @@ class Pop (object):
             cellTags['x'] = sim.net.params.sizeX * randLocs[i,0] # set x location (um)
             cellTags['y'] = sim.net.params.sizeY * randLocs[i,1] # set y location (um)
             cellTags['z'] = sim.net.params.sizeZ * randLocs[i,2] # set z location (um)
-            cells.append(self.cellModelClass(gid, cellTags)) # instantiate Cell object
+            cellsTags.append(cellTags)
+
+        for i in self._distributeCells(cellsTags)[sim.rank]:
+            gid = sim.net.lastGid+i
+            self.cellGids.append(gid)  # add gid list of cells belonging to this population - not needed?
+            cells.append(self.cellModelClass(gid, cellsTags[i])) # instantiate Cell object
             if sim.cfg.verbose: print('Cell %d/%d (gid=%d) of pop %s, on node %d, '%(i, sim.net.params.scale * self.tags['numCells']-1, gid, self.tags['popLabel'], sim.rank))
         sim.net.lastGid = sim.net.lastGid + self.tags['numCells'] 
         return cells
@@ -220,9 +258,8 @@ class Pop (object):
 
         if sim.cfg.verbose and not funcLocs: print 'Volume=%.4f, density=%.2f, numCells=%.0f'%(volume, self.tags['density'], self.tags['numCells'])
 
-        for i in self._distributeCells(self.tags['numCells'])[sim.rank]:
-            gid = sim.net.lastGid+i
-            self.cellGids.append(gid)  # add gid list of cells belonging to this population - not needed?
+        cellsTags = []
+        for i in range(self.tags['numCells']):
             cellTags = {k: v for (k, v) in self.tags.iteritems() if k in sim.net.params.popTagsCopiedToCells}  # copy all pop tags to cell tags, except those that are pop-specific
             cellTags['popLabel'] = self.tags['popLabel']
             cellTags['xnorm'] = randLocs[i,0]  # calculate x location (um)
@@ -231,6 +268,12 @@ class Pop (object):
             cellTags['x'] = sizeX * randLocs[i,0]  # calculate x location (um)
             cellTags['y'] = sizeY * randLocs[i,1]  # calculate y location (um)
             cellTags['z'] = sizeZ * randLocs[i,2]  # calculate z location (um)
+            cellsTags.append(cellTags)
+
+        for i in self._distributeCells(cellsTags)[sim.rank]:
+            gid = sim.net.lastGid+i
+            self.cellGids.append(gid)  # add gid list of cells belonging to this population - not needed?
+            cellTags = cellsTags[i]
             cells.append(self.cellModelClass(gid, cellTags)) # instantiate Cell object
             if sim.cfg.verbose: 
                 print('Cell %d/%d (gid=%d) of pop %s, pos=(%2.f, %2.f, %2.f), on node %d, '%(i, self.tags['numCells']-1, gid, self.tags['popLabel'],cellTags['x'], cellTags['y'], cellTags['z'], sim.rank))
@@ -242,11 +285,8 @@ class Pop (object):
         ''' Create population cells based on list of individual cells'''
         cells = []
         self.tags['numCells'] = len(self.tags['cellsList'])
-        for i in self._distributeCells(len(self.tags['cellsList']))[sim.rank]:
-            #if 'cellModel' in self.tags['cellsList'][i]:
-            #    self.cellModelClass = getattr(f, self.tags['cellsList'][i]['cellModel'])  # select cell class to instantiate cells based on the cellModel tags
-            gid = sim.net.lastGid+i
-            self.cellGids.append(gid)  # add gid list of cells belonging to this population - not needed?
+        cellsTags = []
+        for i in range(len(self.tags['cellsList'])):
             cellTags = {k: v for (k, v) in self.tags.iteritems() if k in sim.net.params.popTagsCopiedToCells}  # copy all pop tags to cell tags, except those that are pop-specific
             cellTags['popLabel'] = self.tags['popLabel']
             cellTags.update(self.tags['cellsList'][i])  # add tags specific to this cells
@@ -258,7 +298,14 @@ class Pop (object):
                 else:
                     cellTags[coord+'norm'] = cellTags[coord] = 0
             if 'propList' not in cellTags: cellTags['propList'] = []  # initalize list of property sets if doesn't exist
-            cells.append(self.cellModelClass(gid, cellTags)) # instantiate Cell object
+            cellsTags.append(cellTags)
+
+        for i in self._distributeCells(cellsTags)[sim.rank]:
+            #if 'cellModel' in self.tags['cellsList'][i]:
+            #    self.cellModelClass = getattr(f, self.tags['cellsList'][i]['cellModel'])  # select cell class to instantiate cells based on the cellModel tags
+            gid = sim.net.lastGid+i
+            self.cellGids.append(gid)  # add gid list of cells belonging to this population - not needed?
+            cells.append(self.cellModelClass(gid, cellsTags[i])) # instantiate Cell object
             if sim.cfg.verbose: print('Cell %d/%d (gid=%d) of pop %d, on node %d, '%(i, self.tags['numCells']-1, gid, i, sim.rank))
         sim.net.lastGid = sim.net.lastGid + len(self.tags['cellsList'])
         return cells
@@ -287,9 +334,8 @@ class Pop (object):
 
         numCells = len(gridLocs)
 
-        for i in self._distributeCells(numCells)[sim.rank]:
-            gid = sim.net.lastGid+i
-            self.cellGids.append(gid)  # add gid list of cells belonging to this population - not needed?
+        cellsTags = []
+        for i in range(numCells):
             cellTags = {k: v for (k, v) in self.tags.iteritems() if k in sim.net.params.popTagsCopiedToCells}  # copy all pop tags to cell tags, except those that are pop-specific
             cellTags['popLabel'] = self.tags['popLabel']
             cellTags['xnorm'] = gridLocs[i][0] / sim.net.params.sizeX # set x location (um)
@@ -298,15 +344,21 @@ class Pop (object):
             cellTags['x'] = gridLocs[i][0]   # set x location (um)
             cellTags['y'] = gridLocs[i][1] # set y location (um)
             cellTags['z'] = gridLocs[i][2] # set z location (um)
-            cells.append(self.cellModelClass(gid, cellTags)) # instantiate Cell object
+            cellsTags.append(cellTags)
+
+        for i in self._distributeCells(cellsTags)[sim.rank]:
+            gid = sim.net.lastGid+i
+            self.cellGids.append(gid)  # add gid list of cells belonging to this population - not needed?
+            cells.append(self.cellModelClass(gid, cellsTags[i])) # instantiate Cell object
             if sim.cfg.verbose: print('Cell %d/%d (gid=%d) of pop %s, on node %d, '%(i, numCells, gid, self.tags['popLabel'], sim.rank))
         sim.net.lastGid = sim.net.lastGid + numCells
         return cells
 
 
 
-    def _setCellClass (self):
+    def _setCellClass (self, moveParams=True):
         # set cell class: CompartCell for compartmental cells of PointCell for point neurons (NetStims, IntFire1,...)
+        # (moveParams=False if tags already have the params of the point process, eg. loaded from file)
         try: # check if cellModel corresponds to an existing point process mechanism; if so, use PointCell
         
             # Make sure it's not a NeuroML2 based cell
@@ -314,11 +366,12 @@ class Pop (object):
             
             tmp = getattr(h, self.tags['cellModel'])
             self.cellModelClass = sim.PointCell
-            excludeTags = ['popLabel', 'cellModel', 'cellType', 'numCells', 'density', 
-                        'xRange', 'yRange', 'zRange', 'xnormRange', 'ynormRange', 'znormRange', 'vref']
-            params = {k: v for k,v in self.tags.iteritems() if k not in excludeTags}
-            self.tags['params'] = params
-            for k in self.tags['params']: self.tags.pop(k)
+            if moveParams:
+                excludeTags = ['popLabel', 'cellModel', 'cellType', 'numCells', 'density', 
+                            'xRange', 'yRange', 'zRange', 'xnormRange', 'ynormRange', 'znormRange', 'vref']
+                params = {k: v for k,v in self.tags.iteritems() if k not in excludeTags}
+                self.tags['params'] = params
+                for k in self.tags['params']: self.tags.pop(k)
             sim.net.params.popTagsCopiedToCells.append('params')
         except:
             self.cellModelClass = sim.CompartCell  # otherwise assume has sections and some cellParam rules apply to it; use CompartCell
@@ -328,7 +381,7 @@ class Pop (object):
     def __getstate__ (self): 
         ''' Removes non-picklable h objects so can be pickled and sent via py_alltoall'''
         odict = self.__dict__.copy() # copy the dict since we change it
-        odict = sim.replaceFuncObj(odict)  # replace h objects with None so can be pickled
+        odict = sim.replaceFuncObj(odict, copy=True)  # replace functions (in copy of nested tags) so can be pickled
         odict['cellModelClass'] = str(odict['cellModelClass'])
         return odict
 
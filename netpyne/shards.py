@@ -0,0 +1,166 @@
+"""
+shards.py
+
+Functions to read and merge output data saved by each node to a separate file (cfg.saveShards).
+Does not require NEURON, so can be used offline, eg. python -m netpyne.shards model_output_shards.json [merged.pkl]
+
+Contributors: salvadordura@gmail.com
+"""
+
+import os
+import json
+from collections import OrderedDict
+
+simDataDicts = ['stims']  # simData keys with dicts of dicts of lists (eg. ['stims']['cell_1']['background'])
+
+
+###############################################################################
+### Load index of shards
+###############################################################################
+def loadShardIndex (filename):
+    with open(filename, 'r') as fileObj:
+        index = json.load(fileObj, object_pairs_hook=OrderedDict)
+    folder = os.path.dirname(filename)
+    for shard in index['shards']:
+        shard['path'] = os.path.join(folder, shard['file'])
+    return index
+
+
+###############################################################################
+### Load data of single shard
+###############################################################################
+_compressionMagic = {'gzip': '\x1f\x8b', 'lz4': '\x04\x22\x4d\x18', 'zstd': '\x28\xb5\x2f\xfd'}  # pkl shards compressed with cfg.pickleCompression
+
+def loadShard (shard, format):
+    if format == 'pkl':
+        import pickle
+        with open(shard['path'], 'rb') as rawFile:
+            header = rawFile.read(4)
+            rawFile.seek(0)
+            compression = next((comp for comp, magic in _compressionMagic.iteritems() if header.startswith(magic)), None)
+            if compression == 'gzip':
+                import gzip
+                return pickle.load(gzip.GzipFile(fileobj=rawFile, mode='rb'))
+            elif compression == 'lz4':
+                import lz4.frame
+                return pickle.load(lz4.frame.LZ4FrameFile(rawFile, mode='r'))
+            elif compression == 'zstd':
+                import io, zstandard
+                return pickle.load(io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(rawFile)))
+            return pickle.load(rawFile)
+    else:
+        with open(shard['path'], 'r') as fileObj:
+            return json.load(fileObj, object_pairs_hook=OrderedDict)
+
+
+###############################################################################
+### Load all shards and merge them into a single dataset (same structure as saved by sim.saveData())
+###############################################################################
+def loadShards (filename, gids=None):
+    ''' Returns dict with netpyne_version, simConfig, net (params, cells, pops) and simData of all shards in index file;
+        if gids is provided, only shards containing those gids are read, and only their cells, spikes and traces kept'''
+    index = loadShardIndex(filename)
+    gidSet = set(gids) if gids is not None else None
+    merged = {'netpyne_version': index['netpyne_version']}
+    cells = []
+    pops = OrderedDict()
+    simData = {}
+    spikes = {'spkt': [], 'spkid': []}  # spikes of each shard, concatenated at the end
+
+    for shard in index['shards']:
+        if gidSet is not None and shard['node'] != 0:  # node 0 always read (contains simConfig and netParams)
+            if 'gids' in shard:
+                if gidSet.isdisjoint(shard['gids']): continue  # skip shards without any of the required gids
+            elif not shard['gidRange'] or not any(shard['gidRange'][0] <= gid <= shard['gidRange'][1] for gid in gidSet):
+                continue  # index saved without gids of each shard
+        data = loadShard(shard, index['format'])
+        for key in ['simConfig']:
+            if key in data: merged[key] = data[key]
+        net = data.get('net', {})
+        if 'params' in net: merged.setdefault('net', {})['params'] = net['params']
+
+        # cells
+        for cell in net.get('cells', []):
+            if gidSet is None or cell['gid'] in gidSet:
+                cells.append(cell)
+
+        # pops (combine cell gids from each shard)
+        for popLabel, pop in net.get('pops', {}).iteritems():
+            if popLabel not in pops:
+                pops[popLabel] = pop
+                pops[popLabel]['cellGids'] = list(pop['cellGids'])
+            else:
+                pops[popLabel]['cellGids'].extend(pop['cellGids'])
+
+        # simData (concatenate spikes, and update dicts of traces)
+        if 'simData' in data:
+            _mergeSimData(simData, spikes, data['simData'], gidSet)
+        del data
+
+    for key, parts in spikes.iteritems():
+        if any(not isinstance(part, list) for part in parts):  # numpy arrays (pkl shards)
+            import numpy as np
+            simData[key] = np.concatenate([np.asarray(part, dtype='float64') for part in parts])
+        elif parts:  # lists (json shards)
+            simData[key] = [value for part in parts for value in part]
+
+    if 'netCells' in index['include'] or 'net' in index['include']:
+        merged.setdefault('net', {})['cells'] = sorted(cells, key=lambda cell: cell['gid'])
+    if 'netPops' in index['include'] or 'net' in index['include']:
+        for pop in pops.values(): pop['cellGids'] = sorted(pop['cellGids'])
+        merged.setdefault('net', {})['pops'] = pops
+    if 'simData' in index['include']:
+        merged['simData'] = simData
+    return merged
+
+
+def _mergeSimData (simData, spikes, shardSimData, gidSet=None):
+    spkids = shardSimData.get('spkid', [])
+    if gidSet is not None:  # keep only spikes of selected gids
+        keep = [i for i, spkid in enumerate(spkids) if int(spkid) in gidSet]
+    for key, val in shardSimData.iteritems():
+        if key in ['spkt', 'spkid']:
+            if gidSet is not None:
+                val = val[keep] if not isinstance(val, list) else [val[i] for i in keep]
+            spikes[key].append(val)
+        elif isinstance(val, dict):
+            simData.setdefault(key, {})
+            for cellLabel, val2 in val.iteritems():
+                if gidSet is not None and cellLabel.startswith('cell_') and int(cellLabel.split('_')[1]) not in gidSet:
+                    continue
+                if key in simDataDicts:
+                    simData[key].setdefault(cellLabel, {}).update(val2)
+                else:
+                    simData[key][cellLabel] = val2
+        elif isinstance(val, list) and key in simData:
+            simData[key].extend(val)
+        else:
+            simData[key] = val
+
+
+###############################################################################
+### Merge shards into a single file (format set by extension: .pkl or .json)
+###############################################################################
+def mergeShards (filename, outFilename=None):
+    index = loadShardIndex(filename)
+    if not outFilename:
+        outFilename = filename.replace('_shards.json', '')+'.'+index['format']
+    data = loadShards(filename)
+    print('Merging %d shards into %s ... ' % (len(index['shards']), outFilename))
+    if outFilename.endswith('.json'):
+        with open(outFilename, 'w') as fileObj:
+            json.dump(data, fileObj, default=lambda obj: obj.tolist())  # numpy arrays of pkl shards
+    else:
+        import pickle
+        with open(outFilename, 'wb') as fileObj:
+            pickle.dump(data, fileObj)
+    print('Finished saving!')
+    return outFilename
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) < 2:
+        print('Usage: python -m netpyne.shards shardsIndexFile [outFile]')
+    else:
+        mergeShards(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None)
@@ -0,0 +1,357 @@
+"""
+sharedMemFuncs.py
+
+Contains functions to place read-only bulk data (eg. connLists, subConn density maps, morphologies, tags of all cells) in
+memory shared by all ranks in the same compute node (MPI-3 shared windows via mpi4py), so there is a single copy per node
+
+Contributors: salvadordura@gmail.com
+"""
+
+__all__ = []
+__all__.extend(['createSharedArrays', 'shareNetParamsArrays', 'CellTagsColumns', 'SharedCellTags', 'shareCellTags', 'freeSharedArrays'])  # shared memory
+
+from collections import Mapping
+from numbers import Number
+import sim
+
+
+_sharedWins = []  # MPI windows of shared arrays (freed via freeSharedArrays())
+_sharedRefs = []  # (dict, key, shared array) of netParams replaced by shareNetParamsArrays() (restored via freeSharedArrays())
+
+
+###############################################################################
+### Create arrays in memory shared by all ranks in same node
+###############################################################################
+def createSharedArrays (arrays, dtype='float64', wins=None):
+    ''' Concatenates list of arrays (same dtype) into a single MPI shared window per node, copied by the first rank in each node,
+        and returns list of numpy arrays (views of the window) with the same shapes. Must be called by all ranks with same shapes.
+        The window is appended to wins if provided (to be freed by the caller), or freed by freeSharedArrays() otherwise.
+        Returns the original arrays if mpi4py is not available.'''
+    import numpy as np
+    try:
+        from mpi4py import MPI
+    except ImportError:
+        if sim.rank == 0: print('  Warning: mpi4py not available, so cannot use shared memory; each rank will keep its own copy')
+        return arrays
+    arrays = [np.asarray(arr, dtype=dtype) for arr in arrays]
+    if not arrays: return arrays
+
+    nodeComm = MPI.COMM_WORLD.Split_type(MPI.COMM_TYPE_SHARED)
+    itemsize = np.dtype(dtype).itemsize
+    size = sum([arr.size for arr in arrays])
+    win = MPI.Win.Allocate_shared(size*itemsize if nodeComm.rank == 0 else 0, itemsize, comm=nodeComm)
+    buf, itemsize = win.Shared_query(0)
+    sharedData = np.ndarray(buffer=buf, dtype=dtype, shape=(size,))
+    (_sharedWins if wins is None else wins).append(win)
+
+    sharedArrays = []
+    offset = 0
+    for arr in arrays:
+        sharedArr = sharedData[offset:offset+arr.size].reshape(arr.shape)
+        if nodeComm.rank == 0:
+            sharedArr[...] = arr
+        sharedArrays.append(sharedArr)
+        offset += arr.size
+    nodeComm.Barrier()
+    for sharedArr in sharedArrays: sharedArr.flags.writeable = False  # read-only
+    nodeComm.Free()
+
+    return sharedArrays
+
+
+###############################################################################
+### Replace bulk data in netParams with shared arrays
+###############################################################################
+def shareNetParamsArrays ():
+    ''' Replaces connLists, subConn density maps (gridX, gridY, gridValues) and 3D points of cell sections in netParams
+        with read-only arrays in node shared memory; the private copies of each rank are released. netParams is not
+        modified if mpi4py is not available. Lists are restored by freeSharedArrays() (called by sim.clearAll())'''
+    try:
+        from mpi4py import MPI
+    except ImportError:
+        if sim.rank == 0: print('  Warning: mpi4py not available, so cannot use shared memory; each rank will keep its own copy')
+        return
+    sim.timing('start', 'shareMemTime')
+    params = sim.net.params
+
+    # connLists (int)
+    connRules = [connParam for connParam in params.connParams.values() if len(connParam.get('connList', [])) > 0]
+    sharedConnLists = createSharedArrays([connParam['connList'] for connParam in connRules], dtype='int64')
+    for connParam, sharedConnList in zip(connRules, sharedConnLists):
+        connParam['connList'] = sharedConnList
+        _sharedRefs.append((connParam, 'connList', sharedConnList))
+
+    # subConn density maps and cell morphologies (float)
+    floatRefs = []  # (dict, key) of each array
+    for subConnParam in params.subConnParams.values():
+        density = subConnParam.get('density')
+        if isinstance(density, dict):
+            floatRefs.extend([(density, key) for key in ['gridX', 'gridY', 'gridValues'] if key in density])
+    for cellRule in params.cellParams.values():
+        for sec in cellRule.get('secs', {}).values():
+            if len(sec.get('geom', {}).get('pt3d', [])) > 0:
+                floatRefs.append((sec['geom'], 'pt3d'))
+    sharedFloats = createSharedArrays([obj[key] for obj, key in floatRefs], dtype='float64')
+    for (obj, key), sharedArr in zip(floatRefs, sharedFloats):
+        obj[key] = sharedArr
+        _sharedRefs.append((obj, key, sharedArr))
+
+    sim.timing('stop', 'shareMemTime')
+    if sim.rank == 0:
+        print('  Placed %d connLists, and %d density maps and morphologies in node shared memory' % (len(connRules), len(floatRefs)))
+        if sim.cfg.timing: print('  Done; shared memory setup time = %0.2f s.' % sim.timingData['shareMemTime'])
+
+
+###############################################################################
+### Tags of all cells in shared memory
+###############################################################################
+_missingInt = -2**63  # value of int columns for cells without the tag
+_rangeCondKeys = ['x','y','z','xnorm','ynorm','znorm']  # conds with [min, max) range (same criteria as in Network)
+
+
+class SharedCellTags (Mapping):
+    ''' Read-only mapping gid -> tags of all cells, stored as columns of arrays in node shared memory (see shareCellTags());
+        the tags dict of each cell is created when accessed '''
+
+    def __init__ (self, gids, columns, wins):
+        self.gids = gids  # sorted gids
+        self.columns = columns  # list of (key, kind, values, array) of each tag; kind: 'int', 'float' or 'id' (index in values)
+        self.wins = wins  # MPI windows of arrays
+
+    def _tags (self, i):
+        tags = {}
+        for key, kind, values, column in self.columns:
+            value = column[i]
+            if kind == 'id':
+                if value >= 0: tags[key] = values[value]
+            elif kind == 'int':
+                if value != _missingInt: tags[key] = int(value)
+            elif value == value:  # float (nan if missing)
+                tags[key] = float(value)
+        return tags
+
+    def __getitem__ (self, gid):
+        import numpy as np
+        i = int(np.searchsorted(self.gids, gid))
+        if i == len(self.gids) or self.gids[i] != gid: raise KeyError(gid)
+        return self._tags(i)
+
+    def __iter__ (self):
+        return iter(self.gids.tolist())
+
+    def __len__ (self):
+        return len(self.gids)
+
+    def iteritems (self):
+        for i, gid in enumerate(self.gids.tolist()):
+            yield gid, self._tags(i)
+
+    def _condMask (self, key, condValue):
+        ''' Boolean array of cells whose tag meets the condition: within [min, max) range for x, y, z, xnorm, ynorm and znorm,
+            in list of values, or equal to value (cells without the tag have value None, as with tags.get(key)) '''
+        import numpy as np
+        if key in _rangeCondKeys: test = lambda value: condValue[0] <= value < condValue[1]
+        elif isinstance(condValue, list): test = lambda value: value in condValue
+        else: test = lambda value: value == condValue
+        column = next(((kind, values, array) for colKey, kind, values, array in self.columns if colKey == key), None)
+        if column is None:  # no cell has the tag
+            return np.full(len(self.gids), bool(test(None)), dtype=bool)
+        kind, values, array = column
+        if kind == 'id':  # test each distinct value once
+            mask = np.in1d(array, [valueId for valueId, value in enumerate(values) if test(value)])
+            missing = array == -1
+        else:
+            missing = array == _missingInt if kind == 'int' else np.isnan(array)
+            if key in _rangeCondKeys:
+                mask = (array >= condValue[0]) & (array < condValue[1])
+            elif isinstance(condValue, list):
+                mask = np.in1d(array, [value for value in condValue if isinstance(value, Number)])
+            elif isinstance(condValue, Number):
+                mask = array == condValue
+            else:
+                mask = np.zeros(len(array), dtype=bool)
+            mask &= ~missing
+        if test(None): mask |= missing
+        return mask
+
+    def select (self, conds):
+        ''' Returns dict gid -> tags of cells that match all conds (dict tag -> value, list of values, or range), filtering the
+            columns, so tags dicts are only created for the matching cells '''
+        import numpy as np
+        mask = np.ones(len(self.gids), dtype=bool)
+        for key, condValue in conds.iteritems():
+            mask &= self._condMask(key, condValue)
+        return {int(self.gids[i]): self._tags(i) for i in np.flatnonzero(mask)}
+
+    def free (self):
+        ''' Frees MPI windows of arrays; must be called by all ranks '''
+        import numpy as np
+        self.gids, self.columns = np.zeros(0, dtype='int64'), []  # release views of windows before freeing them
+        while self.wins:
+            self.wins.pop().Free()
+
+
+def _cellTagsColumns (gids, allCellTags):
+    ''' Returns list of (key, kind, values) and list of arrays with a column for each tag key of allCellTags: 'int' and 'float'
+        columns for numeric tags, and 'id' columns (index in list of values; -1 if missing) for other tags (eg. popLabel, label) '''
+    import numpy as np
+    from numbers import Number
+    keys = sorted(set([key for tags in allCellTags.itervalues() for key in tags]))
+    columns, arrays = [], []
+    for key in keys:
+        present = [allCellTags[gid][key] for gid in gids if key in allCellTags[gid]]
+        if all([isinstance(value, (int, long, np.integer)) and not isinstance(value, (bool, np.bool_)) for value in present]):
+            columns.append((key, 'int', None))
+            arrays.append(np.array([allCellTags[gid].get(key, _missingInt) for gid in gids], dtype='int64'))
+        elif all([isinstance(value, Number) and not isinstance(value, (bool, np.bool_)) for value in present]):
+            columns.append((key, 'float', None))
+            arrays.append(np.array([allCellTags[gid].get(key, np.nan) for gid in gids], dtype='float64'))
+        else:
+            values, valueIds = [], {}
+            column = np.empty(len(gids), dtype='int64')
+            for i, gid in enumerate(gids):
+                if key not in allCellTags[gid]:
+                    column[i] = -1
+                    continue
+                value = allCellTags[gid][key]
+                valueKey = (type(value), repr(value))  # hashable (eg. lists of labels)
+                if valueKey not in valueIds:
+                    valueIds[valueKey] = len(values)
+                    values.append(value)
+                column[i] = valueIds[valueKey]
+            columns.append((key, 'id', values))
+            arrays.append(column)
+    return columns, arrays
+
+
+class CellTagsColumns (object):
+    ''' Tags of all cells encoded as columns pop by pop while the cells are created (cfg.sharedMemory), so they are never kept
+        as a dict of tags; only stored in the first rank of each node, and then copied to node shared memory by shareCellTags() '''
+
+    def __init__ (self):
+        try:
+            from mpi4py import MPI
+            nodeComm = MPI.COMM_WORLD.Split_type(MPI.COMM_TYPE_SHARED)
+            self.store = nodeComm.rank == 0  # whether this rank stores the tags
+            nodeComm.Free()
+        except ImportError:
+            self.store = True
+        self.parts = []  # (gids, columns, arrays) of each group of cells
+
+    def addCells (self, firstGid, cellsTags):
+        ''' Adds list of tags of cells with consecutive gids starting at firstGid '''
+        import numpy as np
+        if not self.store or not cellsTags: return
+        gids = range(firstGid, firstGid+len(cellsTags))
+        columns, arrays = _cellTagsColumns(gids, dict(zip(gids, cellsTags)))
+        self.parts.append((np.array(gids, dtype='int64'), columns, arrays))
+
+    def columns (self):
+        ''' Returns gids (sorted), list of (key, kind, values) and list of arrays of the tags of all cells added, with a single
+            column per key ('int' if int in all groups of cells, 'float' if numeric, or 'id' otherwise) '''
+        import numpy as np
+        gids = np.concatenate([part[0] for part in self.parts]) if self.parts else np.zeros(0, dtype='int64')
+        partCols = [{key: (kind, values, array) for (key, kind, values), array in zip(columns, arrays)} for partGids, columns, arrays in self.parts]
+        keys = sorted(set([key for cols in partCols for key in cols]))
+        columns, arrays = [], []
+        for key in keys:
+            kinds = set([cols[key][0] for cols in partCols if key in cols])
+            if kinds == set(['int']):
+                columns.append((key, 'int', None))
+                arrays.append(np.concatenate([cols[key][2] if key in cols else np.full(len(part[0]), _missingInt, dtype='int64')
+                                              for cols, part in zip(partCols, self.parts)]))
+            elif 'id' not in kinds:
+                def toFloat (kind, values, array):
+                    if kind == 'float': return array
+                    return np.where(array == _missingInt, np.nan, array.astype('float64'))
+                columns.append((key, 'float', None))
+                arrays.append(np.concatenate([toFloat(*cols[key]) if key in cols else np.full(len(part[0]), np.nan)
+                                              for cols, part in zip(partCols, self.parts)]))
+            else:  # values of all groups of cells in a single table
+                values, valueIds = [], {}
+                def valueId (value):
+                    valueKey = (type(value), repr(value))
+                    if valueKey not in valueIds:
+                        valueIds[valueKey] = len(values)
+                        values.append(value)
+                    return valueIds[valueKey]
+                column = []
+                for cols, part in zip(partCols, self.parts):
+                    if key not in cols:
+                        column.append(np.full(len(part[0]), -1, dtype='int64'))
+                        continue
+                    kind, partValues, array = cols[key]
+                    if kind == 'id':
+                        newIds = np.array([valueId(value) for value in partValues] + [-1], dtype='int64')  # -1: missing
+                        column.append(newIds[array])
+                    elif kind == 'int':
+                        column.append(np.array([valueId(int(value)) if value != _missingInt else -1 for value in array], dtype='int64'))
+                    else:
+                        column.append(np.array([valueId(float(value)) if value == value else -1 for value in array], dtype='int64'))
+                columns.append((key, 'id', values))
+                arrays.append(np.concatenate(column))
+        order = np.argsort(gids, kind='mergesort')
+        return gids[order], columns, [array[order] for array in arrays]
+
+
+def shareCellTags (allCellTags):
+    ''' Returns SharedCellTags with the tags of all cells (dict gid -> tags, same gids in all ranks) stored once per node, in node
+        shared memory: the first rank in each node encodes its tags as int, float and id columns (the small tables of values
+        of id columns are broadcast to the other ranks of the node). allCellTags can also be CellTagsColumns, with the tags
+        already encoded while creating cells. Must be called by all ranks. If mpi4py is not available, returns allCellTags, or
+        SharedCellTags with arrays private to the rank if CellTagsColumns. '''
+    import numpy as np
+    try:
+        from mpi4py import MPI
+    except ImportError:
+        if sim.rank == 0: print('  Warning: mpi4py not available, so cannot use shared memory; each rank will keep its own copy')
+        if isinstance(allCellTags, CellTagsColumns):
+            gids, columns, arrays = allCellTags.columns()
+            return SharedCellTags(gids, [column+(array,) for column, array in zip(columns, arrays)], [])
+        return allCellTags
+    sim.timing('start', 'shareCellTagsTime')
+
+    nodeComm = MPI.COMM_WORLD.Split_type(MPI.COMM_TYPE_SHARED)
+    if nodeComm.rank == 0:
+        if isinstance(allCellTags, CellTagsColumns):
+            gids, columns, arrays = allCellTags.columns()
+            allCellTags.parts = []  # release encoded tags once copied to shared memory
+        else:
+            gids = sorted(allCellTags.keys())
+            columns, arrays = _cellTagsColumns(gids, allCellTags)
+            gids = np.array(gids, dtype='int64')
+    else:
+        columns, arrays, gids = None, None, None
+    columns = nodeComm.bcast(columns, root=0)
+    numCells = nodeComm.bcast(len(gids) if nodeComm.rank == 0 else None, root=0)
+    nodeComm.Free()
+    if arrays is None:  # only shapes required in other ranks (not copied to window)
+        gids = np.broadcast_to(np.int64(0), (numCells,))
+        arrays = [np.broadcast_to(np.float64(0) if kind == 'float' else np.int64(0), (numCells,)) for key, kind, values in columns]
+
+    wins = []
+    intCols = [i for i, (key, kind, values) in enumerate(columns) if kind != 'float']
+    floatCols = [i for i, (key, kind, values) in enumerate(columns) if kind == 'float']
+    sharedInts = createSharedArrays([gids]+[arrays[i] for i in intCols], dtype='int64', wins=wins)
+    sharedFloats = createSharedArrays([arrays[i] for i in floatCols], dtype='float64', wins=wins)
+    sharedArrays = dict(zip(intCols, sharedInts[1:]) + zip(floatCols, sharedFloats))
+    sharedCellTags = SharedCellTags(sharedInts[0], [columns[i]+(sharedArrays[i],) for i in range(len(columns))], wins)
+
+    sim.timing('stop', 'shareCellTagsTime')
+    if sim.rank == 0:
+        print('  Placed tags of %d cells (%d columns) in node shared memory' % (numCells, len(columns)))
+        if sim.cfg.timing: print('  Done; shared cell tags setup time = %0.2f s.' % sim.timingData['shareCellTagsTime'])
+    return sharedCellTags
+
+
+###############################################################################
+### Free MPI windows of shared arrays
+###############################################################################
+def freeSharedArrays ():
+    ''' Restores lists in netParams replaced by shared arrays (so netParams remains valid after the windows are freed),
+        and frees the MPI windows; must be called by all ranks '''
+    while _sharedRefs:
+        obj, key, sharedArr = _sharedRefs.pop()
+        if obj.get(key) is sharedArr: obj[key] = sharedArr.tolist()
+    while _sharedWins:
+        _sharedWins.pop().Free()
@@ -16,6 +16,15 @@ if '-nogui' in sys.argv:
 # import all required modules
 from simFuncs import *
 from neuromlFuncs import *
+from partitionFuncs import *
+from sharedMemFuncs import *
+from hdf5Funcs import *
+from containerFuncs import *
+from jsonFuncs import *
+from snapshotFuncs import *
+from sonataFuncs import *
+from spikeFuncs import *
+from checkpointFuncs import *
 from wrappers import *
 import analysis
 from network import Network
@@ -9,8 +9,8 @@ Contributors: salvadordura@gmail.com
 __all__ = []
 __all__.extend(['initialize', 'setNet', 'setNetParams', 'setSimCfg', 'createParallelContext', 'setupRecording', 'clearAll', 'setGlobals']) # init and setup
 __all__.extend(['preRun', 'runSim', 'runSimWithIntervalFunc', '_gatherAllCellTags', '_gatherCells', 'gatherData'])  # run and gather
-__all__.extend(['saveData', 'loadSimCfg', 'loadNetParams', 'loadNet', 'loadSimData', 'loadAll']) # saving and loading
-__all__.extend(['popAvgRates', 'id32', 'copyReplaceItemObj', 'clearObj', 'replaceItemObj', 'replaceNoneObj', 'replaceFuncObj', 'replaceDictODict', 'readCmdLineArgs', 'getCellsList', 'cellByGid',\
+__all__.extend(['saveData', 'waitSaveData', 'saveDataShards', 'loadSimCfg', 'loadNetParams', 'getNodeGids', 'loadNet', 'loadSimData', 'loadAll']) # saving and loading
+__all__.extend(['popAvgRates', 'popStats', 'id32', 'normalizeObj', 'copyReplaceItemObj', 'clearObj', 'replaceItemObj', 'replaceNoneObj', 'replaceFuncObj', 'replaceDictODict', 'readCmdLineArgs', 'getCellsList', 'cellByGid',\
 'timing',  'version', 'gitversion', 'loadBalance'])  # misc/utilities
 
 import sys
@@ -20,10 +20,14 @@ import cPickle as pk
 import hashlib 
 from numbers import Number
 from copy import copy
+from types import FunctionType, MethodType
 from specs import Dict, ODict
 from collections import OrderedDict
+from contextlib import contextmanager
 from neuron import h, init # Import NEURON
 import sim, specs
+from partitionFuncs import _clearCellCosts
+from spikeFuncs import _openSpikeFile, _closeSpikeFile, _numFileSpikes, _nodeSpikes
 
 
 
@@ -45,6 +49,8 @@ def initialize (netParams = None, simConfig = None, net = None):
     sim.timingData = Dict()  # dict to store timing
 
     sim.createParallelContext()  # iniitalize PC, nhosts and rank
+    sim.hostLoads = [0.0]*sim.nhosts  # initialize estimated load of each host (used to distribute cells based on cost)
+    _clearCellCosts()  # costs cached by cellParams rule label may be stale (eg. batch runs)
     
     sim.setSimCfg(simConfig)  # set simulation configuration
     
@@ -59,6 +65,9 @@ def initialize (netParams = None, simConfig = None, net = None):
 
     sim.setNetParams(netParams)  # set network parameters
 
+    if sim.cfg.sharedMemory and sim.nhosts > 1:
+        sim.shareNetParamsArrays()  # place bulk read-only data of netParams in node shared memory
+
     sim.timing('stop', 'initialTime')
 
 
@@ -111,7 +120,7 @@ def createParallelContext ():
 # Load netParams from cell
 ###############################################################################
 def loadNetParams (filename, data=None, setLoaded=True):
-    if not data: data = _loadFile(filename)
+    if not data: data = _loadFile(filename, include=['netParams'])
     print('Loading netParams...')
     if 'net' in data and 'params' in data['net']:
         if setLoaded:
@@ -127,29 +136,54 @@ def loadNetParams (filename, data=None, setLoaded=True):
 ###############################################################################
 # Load cells and pops from file and create NEURON objs
 ###############################################################################
+def getNodeGids (allGids):
+    ''' Returns gids of cells to instantiate in this node when loading a network (sorted allGids of all nodes): round robin, or from cfg.cellPartitionFile if cfg.cellPartition == 'file' '''
+    if getattr(sim.cfg, 'cellPartition', 'roundRobin') == 'file' and getattr(sim.cfg, 'cellPartitionFile', None):
+        partition = sim.loadCellPartition(sim.cfg.cellPartitionFile)
+        return [gid for i, gid in enumerate(allGids) if partition.get(gid, i) % sim.nhosts == sim.rank]
+    return allGids[int(sim.rank)::sim.nhosts]
+
+
 def loadNet (filename, data=None, instantiate=True):
-    if not data: data = _loadFile(filename)
-    if 'net' in data and 'cells' in data['net'] and 'pops' in data['net']:
+    ''' Loads cells and pops from file, and instantiates in each node only its own cells (CompartCells and PointCells); 
+        for container and HDF5 files, each node only reads its own cells and conns from file (or node 0 all cells, if not instantiate) '''
+    import os
+    partial = not data and (os.path.isdir(filename) or os.path.splitext(filename)[1] in ['.hdf5', '.h5'])  # formats that can read subsets of gids
+    if not data: data = _loadFile(filename, include=['netPops'] if partial else ['netCells', 'netPops'])
+    if 'net' in data and 'pops' in data['net'] and ('cells' in data['net'] or partial):
         if sim.rank == 0:
             sim.timing('start', 'loadNetTime')
             print('Loading net...')
             sim.net.allPops = data['net']['pops']
-            sim.net.allCells = data['net']['cells']
+            if not partial: sim.net.allCells = data['net']['cells']
+            elif not instantiate: sim.net.allCells = _loadFile(filename, include=['netCells'])['net']['cells']  # all cells, as for other formats
         if instantiate:
-            # calculate cells to instantiate in this node
-            cellsNode = [data['net']['cells'][i] for i in xrange(int(sim.rank), len(data['net']['cells']), sim.nhosts)] 
+            # calculate cells to instantiate in this node, and read only those if possible
+            if partial:
+                allGids = sorted([gid for popLoad in data['net']['pops'].values() for gid in popLoad.get('cellGids', [])])
+                cellsNode = _loadFile(filename, include=['netCells'], gids=getNodeGids(allGids))['net']['cells']
+                sim.net.allCellTags = {}  # tags of cells in other nodes not read; gathered when required
+            else:
+                allGids = sorted([cellLoad['gid'] for cellLoad in data['net']['cells']])
+                nodeGids = set(getNodeGids(allGids))
+                cellsNode = [cellLoad for cellLoad in data['net']['cells'] if cellLoad['gid'] in nodeGids]
+                sim.net.allCellTags = {cellLoad['gid']: cellLoad['tags'] for cellLoad in data['net']['cells']}
+                if sim.cfg.sharedMemory and sim.nhosts > 1: sim.net.allCellTags = sim.shareCellTags(sim.net.allCellTags)
+
             if sim.cfg.createPyStruct:
                 for popLoadLabel, popLoad in data['net']['pops'].iteritems():
-                    pop = sim.Pop(popLoadLabel, popLoad['tags'])
-                    pop.cellGids = popLoad['cellGids']
-                    sim.net.pops[popLoadLabel] = pop
+                    sim.net.pops[popLoadLabel] = sim.Pop.fromTags(popLoadLabel, popLoad['tags'], popLoad['cellGids'])
                 for cellLoad in cellsNode:
-                    # create new CompartCell object and add attributes, but don't create sections or associate gid yet
-                    # TO DO: assumes CompartCell -- add condition to load PointCell
-                    cell = sim.CompartCell(gid=cellLoad['gid'], tags=cellLoad['tags'], create=False, associateGid=False)  
-                    cell.secs = Dict(cellLoad['secs'])
+                    # create new CompartCell or PointCell object and add attributes, but don't create NEURON objs or associate gid yet
+                    if 'params' in cellLoad:  # PointCell (eg. NetStim, IntFire1)
+                        tags = dict(cellLoad['tags'])
+                        tags['params'] = cellLoad['params']
+                        cell = sim.PointCell(gid=cellLoad['gid'], tags=tags, create=False, associateGid=False)
+                    else:
+                        cell = sim.CompartCell(gid=cellLoad['gid'], tags=cellLoad['tags'], create=False, associateGid=False)  
+                        cell.secs = Dict(cellLoad['secs'])
                     cell.conns = [Dict(conn) for conn in cellLoad['conns']]
-                    cell.stims = [Dict(stim) for stim in cellLoad['stims']]
+                    cell.stims = [Dict(stim) for stim in cellLoad.get('stims', [])]
                     sim.net.cells.append(cell)
                 print('  Created %d cells' % (len(sim.net.cells)))
                 print('  Created %d connections' % (sum([len(c.conns) for c in sim.net.cells])))
@@ -158,10 +192,12 @@ def loadNet (filename, data=None, instantiate=True):
                 # only create NEURON objs, if there is Python struc (fix so minimal Python struct is created)
                 if sim.cfg.createNEURONObj:  
                     if sim.cfg.verbose: print("  Adding NEURON objects...")
-                    # create NEURON sections, mechs, syns, etc; and associate gid
+                    # create NEURON sections, mechs, syns, etc (or point processes); and associate gid
                     for cell in sim.net.cells:
-                        prop = {'secs': cell.secs}
-                        cell.createNEURONObj(prop)  # use same syntax as when creating based on high-level specs 
+                        if isinstance(cell, sim.PointCell):
+                            cell.createNEURONObj()
+                        else:
+                            cell.createNEURONObj({'secs': cell.secs})  # use same syntax as when creating based on high-level specs 
                         cell.associateGid()  # can only associate once the hSection obj has been created
                     # create all NEURON Netcons, NetStims, etc
                     sim.pc.barrier()
@@ -182,7 +218,7 @@ def loadNet (filename, data=None, instantiate=True):
 # Load simulation config from file
 ###############################################################################
 def loadSimCfg (filename, data=None, setLoaded=True):
-    if not data: data = _loadFile(filename)
+    if not data: data = _loadFile(filename, include=['simConfig'])
     print('Loading simConfig...')
     if 'simConfig' in data:
         if setLoaded:
@@ -197,8 +233,8 @@ def loadSimCfg (filename, data=None, setLoaded=True):
 ###############################################################################
 # Load netParams from cell
 ###############################################################################
-def loadSimData (filename, data=None):
-    if not data: data = _loadFile(filename)
+def loadSimData (filename, data=None, gids=None, simDataKeys=None):
+    if not data: data = _loadFile(filename, include=['simData'], gids=gids, simDataKeys=simDataKeys)
     print('Loading simData...')
     if 'simData' in data:
         sim.allSimData = data['simData']
@@ -219,51 +255,167 @@ def loadAll (filename, data=None):
     loadSimData(filename, data=data)
 
     
+###############################################################################
+# Open file compressed with gzip, lz4 or zstd (streamed)
+###############################################################################
+_compressionMagic = {'gzip': '\x1f\x8b', 'lz4': '\x04\x22\x4d\x18', 'zstd': '\x28\xb5\x2f\xfd'}
+
+@contextmanager
+def _openCompressed (filename, mode, compression=None):
+    ''' Returns file object that compresses (mode 'wb') or decompresses (mode 'rb') while writing or reading;
+        compression: None, 'gzip', 'lz4' (requires lz4) or 'zstd' (requires zstandard); detected from file header when reading '''
+    import io
+    with open(filename, mode) as rawFile:
+        if 'r' in mode:
+            header = rawFile.read(4)
+            rawFile.seek(0)
+            compression = next((comp for comp, magic in _compressionMagic.iteritems() if header.startswith(magic)), None)
+        elif compression not in [None, 'gzip']:
+            try:
+                __import__({'lz4': 'lz4.frame', 'zstd': 'zstandard'}[compression])
+            except (ImportError, KeyError):
+                print('  Warning: compression %s not available; using gzip' % (compression))
+                compression = 'gzip'
+
+        if compression == 'gzip':
+            import gzip
+            fileObj = gzip.GzipFile(fileobj=rawFile, mode=mode, compresslevel=4)
+        elif compression == 'lz4':
+            import lz4.frame
+            fileObj = lz4.frame.LZ4FrameFile(rawFile, mode=mode[0])
+        elif compression == 'zstd':
+            import zstandard
+            if 'r' in mode:
+                fileObj = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(rawFile))
+            else:
+                fileObj = zstandard.ZstdCompressor().stream_writer(rawFile)
+        else:
+            fileObj = rawFile
+        try:
+            yield fileObj
+        finally:
+            if fileObj is not rawFile: fileObj.close()
+
+
+###############################################################################
+# Save data to pickle file (highest protocol, lists of numbers in simData as numpy arrays)
+###############################################################################
+def _simDataToNumpy (simData):
+    ''' Returns copy of simData (same structure) with lists of numbers (eg. spikes, traces) replaced by numpy arrays '''
+    import numpy as np
+    def toArray (val):
+        if isinstance(val, list) and val and isinstance(val[0], Number):
+            arr = np.array(val)
+            if arr.ndim == 1 and arr.dtype.kind in 'iuf': return arr
+        return val
+
+    simDataNumpy = {}
+    for key, val in simData.iteritems():
+        if isinstance(val, dict):  # eg. ['V_soma']['cell_1'] or ['stims']['cell_1']['background']
+            simDataNumpy[key] = {key2: {key3: toArray(val3) for key3, val3 in val2.iteritems()} if isinstance(val2, dict) else toArray(val2)
+                                 for key2, val2 in val.iteritems()}
+        else:
+            simDataNumpy[key] = toArray(val)
+    return simDataNumpy
+
+
+def _savePickle (dataSave, filename, compression=None):
+    ''' Saves data using the highest pickle protocol, with spikes and traces as numpy arrays, streamed through compression
+        (None, 'gzip', 'lz4' or 'zstd') '''
+    if 'simData' in dataSave:
+        dataSave = dict(dataSave)
+        dataSave['simData'] = _simDataToNumpy(dataSave['simData'])
+    with _openCompressed(filename, 'wb', compression) as fileObj:
+        pk.dump(dataSave, fileObj, protocol=pk.HIGHEST_PROTOCOL)
+
+
 ###############################################################################
 # Load data from file
 ###############################################################################
-def _loadFile (filename):
+def _mat2dict (obj):
+    ''' Converts structs and cell arrays loaded with scipy.io.loadmat (squeeze_me=True, struct_as_record=False) to dicts and lists;
+        numeric arrays are kept as numpy arrays '''
+    import numpy as np
+    if hasattr(obj, '_fieldnames'):  # mat_struct
+        return {field: _mat2dict(getattr(obj, field)) for field in obj._fieldnames}
+    elif isinstance(obj, np.ndarray):
+        if obj.dtype == object:  # cell array
+            return [_mat2dict(item) for item in obj.tolist()]
+        elif obj.dtype.kind in ['U', 'S']:
+            return obj.tolist()
+        elif obj.ndim == 0:
+            return obj.item()
+        return obj
+    elif isinstance(obj, np.generic):
+        return obj.item()
+    elif isinstance(obj, unicode):
+        return str(obj)
+    return obj
+
+
+def _matHObjNone (obj):
+    ''' Replaces empty arrays of NEURON object keys (eg. hSec, hPointp; None saved as [] in .mat files) with None, in place '''
+    import numpy as np
+    if isinstance(obj, dict):
+        for key, val in obj.iteritems():
+            if key.startswith('h') and isinstance(val, (np.ndarray, list)) and len(val) == 0:
+                obj[key] = None
+            else:
+                _matHObjNone(val)
+    elif isinstance(obj, list):
+        for item in obj: _matHObjNone(item)
+
+
+def _loadFile (filename, include=None, gids=None, simDataKeys=None):
+    ''' Loads data saved with sim.saveData(); for container, HDF5, json and mat files only the parts in include are read
+        ('simConfig', 'netParams', 'netCells', 'netPops', 'simData'), and for container and HDF5 files only the cells, conns, spikes and
+        traces of gids, and the simData keys in simDataKeys (eg. ['spkt', 'spkid']) '''
     import os
 
     if hasattr(sim, 'cfg') and sim.cfg.timing: sim.timing('start', 'loadFileTime')
-    ext = os.path.basename(filename).split('.')[1]
+    ext = os.path.splitext(filename)[1][1:]
 
-    # load pickle file
-    if ext == 'pkl':
-        import pickle
-        print('Loading file %s ... ' % (filename))
-        with open(filename, 'r') as fileObj:
-            data = pickle.load(fileObj)
+    # load container directory (only blocks with required gids; arrays are memory-mapped)
+    if os.path.isdir(filename):
+        print('Loading container %s ... ' % (filename))
+        data = sim.loadContainer(filename, include=include, gids=gids, simDataKeys=simDataKeys)
 
-    # load dpk file
-    elif ext == 'dpk':
-        import gzip
+    # load pickle or dpk file (compression detected from file header)
+    elif ext in ['pkl', 'dpk']:
         print('Loading file %s ... ' % (filename))
-        #fn=sim.cfg.filename #.split('.')
-        #gzip.open(fn, 'wb').write(pk.dumps(dataSave)) # write compressed string
-        print('NOT IMPLEMENTED!')
+        with _openCompressed(filename, 'rb') as fileObj:
+            data = pk.load(fileObj)
 
-    # load json file
+    # load json file (read by parts, skipping parts not in include; lists of numbers in simData read as numpy arrays)
     elif ext == 'json':
-        import json
         print('Loading file %s ... ' % (filename))
-        with open(filename, 'r') as fileObj:
-            data = json.load(fileObj, object_pairs_hook=OrderedDict)
+        data = sim.loadJsonStream(filename, include=include)
 
-    # load mat file
+    # load mat file (only top-level variables required by include)
     elif ext == 'mat':
-        from scipy.io import savemat 
+        from scipy.io import loadmat
+        import numpy as np
         print('Loading file %s ... ' % (filename))
-        #savemat(sim.cfg.filename+'.mat', replaceNoneObj(dataSave))  # replace None and {} with [] so can save in .mat format
-        print('Finished saving!')
-
-    # load HDF5 file (uses very inefficient hdf5storage module which supports dicts)
-    elif ext == 'saveHDF5':
-        #dataSaveUTF8 = _dict2utf8(replaceNoneObj(dataSave)) # replace None and {} with [], and convert to utf
-        import hdf5storage
+        variables = None
+        if include is not None:
+            variables = list(set(['net' if item in ['netParams', 'netCells', 'netPops'] else item for item in include] + ['netpyne_version']))
+        matData = loadmat(filename, variable_names=variables, squeeze_me=True, struct_as_record=False, chars_as_strings=True)
+        data = {key: _mat2dict(val) for key, val in matData.iteritems() if not key.startswith('__')}
+        if 'net' in data and isinstance(data['net'].get('cells'), dict):  # single cell saved as struct
+            data['net']['cells'] = [data['net']['cells']]
+        for cell in data.get('net', {}).get('cells', []):  # single conn or stim saved as struct
+            for key in ['conns', 'stims']:
+                if isinstance(cell.get(key), dict): cell[key] = [cell[key]]
+                elif isinstance(cell.get(key), np.ndarray): cell[key] = cell[key].tolist()  # empty list
+            for sec in cell.get('secs', {}).values():  # single synMech saved as struct
+                if isinstance(sec, dict) and isinstance(sec.get('synMechs'), dict): sec['synMechs'] = [sec['synMechs']]
+                elif isinstance(sec, dict) and isinstance(sec.get('synMechs'), np.ndarray): sec['synMechs'] = sec['synMechs'].tolist()
+            _matHObjNone(cell)
+
+    # load HDF5 file (only parts in include, and only cells, conns, spikes and traces of gids)
+    elif ext in ['hdf5', 'h5']:
         print('Loading file %s ... ' % (filename))
-        #hdf5storage.writes(dataSaveUTF8, filename=sim.cfg.filename+'.hdf5')
-        print('NOT IMPLEMENTED!')
+        data = sim.loadHDF5(filename, include=include, gids=gids, simDataKeys=simDataKeys)
 
     # load CSV file (currently only saves spikes)
     elif ext == 'csv':
@@ -304,6 +456,9 @@ def _loadFile (filename):
 # Clear all sim objects in memory
 ###############################################################################
 def clearAll ():
+    # wait for output being saved in background
+    waitSaveData()
+
     # clean up
     sim.pc.barrier() 
     sim.pc.gid_clear()                    # clear previous gid settings
@@ -314,6 +469,8 @@ def clearAll ():
     for key in sim.simData.keys(): del sim.simData[key]  
     for c in sim.net.cells: del c
     for p in sim.net.pops: del p
+    sim.net.clearAllCellTags()
+    sim.freeSharedArrays()  # restores lists in netParams and frees node shared memory windows
     del sim.net.params
     
     
@@ -332,6 +489,7 @@ def clearAll ():
         matplotlib.pyplot.close('all')
 
     del sim.net
+    _clearCellCosts()
 
     import gc; gc.collect()
 
@@ -340,41 +498,85 @@ def clearAll ():
 ###############################################################################
 # Hash function to obtain random value
 ###############################################################################
+_id32Cache = {}  # cache of hash values (eg. seeds shared by many NetStims)
 def id32 (obj): 
-    return int(hashlib.md5(obj).hexdigest()[0:8],16)  # convert 8 first chars of md5 hash in base 16 to int
+    if obj not in _id32Cache:
+        _id32Cache[obj] = int(hashlib.md5(obj).hexdigest()[0:8],16)  # convert 8 first chars of md5 hash in base 16 to int
+    return _id32Cache[obj]
     
 
+###############################################################################
+### Normalize nested dicts and lists in a single pass (used before saving and gathering)
+###############################################################################
+_funcTypes = (FunctionType, MethodType)
+
+def normalizeObj (obj, copy=False, keystart=None, newval=None, funcs=False, none=False, dicts=False, tuples=False, utf8=False):
+    ''' Walks nested dicts and lists once (iteratively, without recursion) applying all the requested conversions;
+        other values (eg. numpy arrays, Vectors) are leaves and are not traversed:
+        - copy: copy dicts and lists instead of modifying them in place
+        - keystart: replace values (not dicts or lists) of keys starting with keystart with newval (eg. 'h' to remove NEURON objects)
+        - funcs: replace functions with 'func' (so can be pickled)
+        - none: replace None and {} values of dicts with [] (so can be saved in .mat format)
+        - dicts: replace Dict with dict and ODict with OrderedDict
+        - tuples: replace tuples with str
+        - utf8: decode str to unicode, and convert numeric keys to str (so can be saved in HDF5 format) '''
+    def isContainer (val):
+        return type(val) is list or isinstance(val, dict)
+
+    def newContainer (val):
+        if type(val) is list: return []
+        return OrderedDict() if isinstance(val, OrderedDict) else {}
+
+    def convert (key, val, inDict):
+        if keystart is not None and inDict and isinstance(key, basestring) and key.startswith(keystart): return newval
+        elif funcs and type(val) in _funcTypes: return 'func'
+        elif none and inDict and val is None: return []
+        elif tuples and type(val) is tuple: return str(val)
+        elif utf8 and isinstance(val, str): return val.decode('utf8')
+        return val
+
+    if not isContainer(obj):
+        return convert(None, obj, False)
+    copyRoot = copy or (dicts and isinstance(obj, (Dict, ODict))) or (utf8 and not type(obj) is list and type(obj) is not dict)
+    root = newContainer(obj) if copyRoot else obj
+    stack = [(obj, root)]
+    while stack:
+        src, dst = stack.pop()
+        copying = dst is not src
+        inDict = type(src) is not list
+        for key, val in (src.items() if inDict else enumerate(src)):
+            if isContainer(val):
+                if none and inDict and isinstance(val, dict) and not val:
+                    newVal = []
+                elif copy or (dicts and isinstance(val, (Dict, ODict))) or (utf8 and type(val) is not list and type(val) is not dict):
+                    newVal = newContainer(val)
+                    stack.append((val, newVal))
+                else:
+                    newVal = val
+                    stack.append((val, val))
+            else:
+                newVal = convert(key, val, inDict)
+            if utf8 and inDict and isinstance(key, Number):
+                if not copying: del dst[key]
+                key = str(key).decode('utf8')
+                dst[key] = newVal
+            elif copying:
+                if inDict: dst[key] = newVal
+                else: dst.append(newVal)
+            elif newVal is not val:
+                dst[key] = newVal
+    return root
+
+
 ###############################################################################
 ### Replace item with specific key from dict or list (used to remove h objects)
 ###############################################################################
 def copyReplaceItemObj (obj, keystart, newval, objCopy='ROOT'):
-    if type(obj) == list:
-        if objCopy=='ROOT': 
-            objCopy = []
-        for item in obj:
-            if type(item) in [list]:
-                objCopy.append([])
-                copyReplaceItemObj(item, keystart, newval, objCopy[-1])
-            elif type(item) in [dict, Dict]:
-                objCopy.append({})
-                copyReplaceItemObj(item, keystart, newval, objCopy[-1])
-            else:
-                objCopy.append(item)
-
-    elif type(obj) in [dict, Dict]:
-        if objCopy == 'ROOT':
-            objCopy = Dict() 
-        for key,val in obj.iteritems():
-            if type(val) in [list]:
-                objCopy[key] = [] 
-                copyReplaceItemObj(val, keystart, newval, objCopy[key])
-            elif type(val) in [dict, Dict]:
-                objCopy[key] = {}
-                copyReplaceItemObj(val, keystart, newval, objCopy[key])
-            elif key.startswith(keystart):
-                objCopy[key] = newval
-            else:
-                objCopy[key] = val
+    objCopy = normalizeObj(obj, copy=True, keystart=keystart, newval=newval)
+    if type(objCopy) is dict:  # root dict returned as Dict
+        rootCopy = Dict()
+        rootCopy.update(objCopy)
+        return rootCopy
     return objCopy
 
 
@@ -400,138 +602,35 @@ def clearObj (obj):
 ### Replace item with specific key from dict or list (used to remove h objects)
 ###############################################################################
 def replaceItemObj (obj, keystart, newval):
-    if type(obj) == list:
-        for item in obj:
-            if type(item) in [list, dict]:
-                replaceItemObj(item, keystart, newval)
-
-    elif type(obj) == dict:
-        for key,val in obj.iteritems():
-            if type(val) in [list, dict]:
-                replaceItemObj(val, keystart, newval)
-            if key.startswith(keystart):
-                obj[key] = newval
-    return obj
+    return normalizeObj(obj, keystart=keystart, newval=newval)
 
 
 ###############################################################################
 ### Replace functions from dict or list with function string (so can be pickled)
 ###############################################################################
-def replaceFuncObj (obj):
-    if type(obj) == list:
-        for item in obj:
-            if type(item) in [list, dict]:
-                replaceFuncObj(item)
-
-    elif type(obj) == dict:
-        for key,val in obj.iteritems():
-            if type(val) in [list, dict]:
-                replaceFuncObj(val)
-            if 'func_name' in dir(val): #hasattr(val,'func_name'):  # avoid hasattr() since it creates key in Dicts() 
-                obj[key] = 'func' # funcSource
-    return obj
+def replaceFuncObj (obj, copy=False):
+    return normalizeObj(obj, copy=copy, funcs=True)
 
 
 ###############################################################################
 ### Replace None from dict or list with [](so can be saved to .mat)
 ###############################################################################
 def replaceNoneObj (obj):
-    if type(obj) == list:# or type(obj) == tuple:
-        for item in obj:
-            if type(item) in [list, dict, Dict, ODict]:
-                replaceNoneObj(item)
-
-    elif type(obj) in [dict, Dict, ODict]:
-        for key,val in obj.iteritems():
-            if type(val) in [list, dict, Dict, ODict]:
-                replaceNoneObj(val)
-            if val == None:
-                obj[key] = []
-            elif val == {}:
-                obj[key] = [] # also replace empty dicts with empty list
-    return obj
+    return normalizeObj(obj, none=True)
 
 
 ###############################################################################
 ### Replace Dict with dict and Odict with OrderedDict
 ###############################################################################
 def replaceDictODict (obj):
-    if type(obj) == list:
-        for item in obj:
-            if type(item) == Dict:
-                item = item.todict()
-            elif type(item) == ODict:
-                item = item.toOrderedDict()
-            if type(item) in [list, dict, OrderedDict]:
-                replaceDictODict(item)
-
-    elif type(obj) in [dict, OrderedDict, Dict, ODict]:
-        for key,val in obj.iteritems():
-            if type(val) == Dict:
-                obj[key] = val.todict()
-            elif type(val) == ODict:
-                obj[key] = val.toOrderedDict()
-            if type(val) in [list, dict, OrderedDict]:
-                replaceDictODict(val)       
-
-    # elif type(obj) == Dict:
-    #     obj = obj.todict()
-    #     for key,val in obj.iteritems():
-    #         if type(val) in [list, dict, Dict, ODict]:
-    #             replaceDictODict(val)
-
-    # elif type(obj) == ODict:
-    #     print obj.keys()
-    #     obj = obj.toOrderedDict()
-    #     for key,val in obj.iteritems():
-    #         if type(val) in [list, dict, Dict, ODict]:
-    #             replaceDictODict(val)
-
-    # elif type(obj) == dict:
-    #     for key,val in obj.iteritems():
-    #         if type(val) in [list, dict, Dict, ODict]:
-    #             replaceDictODict(val)
-    return obj
+    return normalizeObj(obj, dicts=True)
+
 
 ###############################################################################
 ### Replace tuples with str
 ###############################################################################
 def tupleToStr (obj):
-    if type(obj) == list:
-        for item in obj:
-            if type(item) in [list, dict]:
-                tupleToStr(item)
-            elif type(item) == tuple:
-                obj[obj.index(item)] = str(item)
-
-    elif type(obj) == dict or type(obj) == ODict:
-        for key,val in obj.iteritems():
-            if type(val) in [list, dict, ODict]:
-                tupleToStr(val)
-            elif type(val) == tuple:
-                obj[key] = str(val) # also replace empty dicts with empty list
-    return obj
-
-
-###############################################################################
-### Convert dict strings to utf8 so can be saved in HDF5 format
-###############################################################################
-def _dict2utf8 (obj):
-#unidict = {k.decode('utf8'): v.decode('utf8') for k, v in strdict.items()}
-    #print obj
-    import collections
-    if isinstance(obj, basestring):
-        return obj.decode('utf8')
-    elif isinstance(obj, collections.Mapping):
-        for key in obj.keys():
-            if isinstance(key, Number):
-                obj[str(key).decode('utf8')] = obj[key]
-                obj.pop(key)
-        return dict(map(_dict2utf8, obj.iteritems()))
-    elif isinstance(obj, collections.Iterable):
-        return type(obj)(map(_dict2utf8, obj))
-    else:
-        return obj
+    return normalizeObj(obj, tuples=True)
 
 
 ###############################################################################
@@ -632,6 +731,9 @@ def setupRecording ():
 
         for key in sim.cfg.recordTraces.keys(): sim.simData[key] = Dict()  # create dict to store traces
         for cell in cellsRecord: cell.recordTraces()  # call recordTraces function for each cell
+
+    # tags of all cells no longer required once network is connected and recording set up
+    sim.net.clearAllCellTags()
     
     timing('stop', 'setrecordTime')
 
@@ -710,10 +812,28 @@ def setGlobals ():
 ### Commands required just before running simulation
 ###############################################################################
 def preRun ():
-    # set initial v of cells
+    # free tags of all cells (if setupRecording was not called)
+    sim.net.clearAllCellTags()
+
+    # set num of threads and distribute cells across threads
+    if sim.cfg.nthreads > 1 or sim.pc.nthread() > 1:
+        sim.partitionThreads()
+
+    # set initial v of cells using a single handler (sections grouped by vinit in hoc SectionLists; no python calls per cell)
     sim.fih = []
+    vinitSecs = OrderedDict()
     for cell in sim.net.cells:
-       sim.fih.append(h.FInitializeHandler(cell.initV))
+        if isinstance(cell, sim.CompartCell):
+            for sec in cell.secs.values():
+                if 'vinit' in sec and sec.get('hSec') is not None:
+                    vinitSecs.setdefault(sec['vinit'], []).append(sec['hSec'])
+    if vinitSecs:
+        _hocExec('objref netpyneVinitSecs[%d], netpyneVinitValues' % (len(vinitSecs)))
+        for i, secs in enumerate(vinitSecs.values()):
+            _hocExec('netpyneVinitSecs[%d] = new SectionList()' % (i))
+            for hSec in secs: h.netpyneVinitSecs[i].append(sec=hSec)
+        h.netpyneVinitValues = h.Vector(vinitSecs.keys())
+        sim.fih.append(h.FInitializeHandler('for netpyneVinitIdx=0,%d { forsec netpyneVinitSecs[netpyneVinitIdx] v = netpyneVinitValues.x[netpyneVinitIdx] }' % (len(vinitSecs)-1)))
 
     # cvode variables
     if not getattr(h, 'cvode', None):
@@ -740,9 +860,7 @@ def preRun ():
     h.tstop = sim.cfg.duration
     
     # parallelcontext vars
-    sim.pc.set_maxstep(10)
-    mindelay = sim.pc.allreduce(sim.pc.set_maxstep(10), 2) # flag 2 returns minimum value
-    if sim.rank==0 and sim.cfg.verbose: print('Minimum delay (time-step for queue exchange) is %.2f'%(mindelay))
+    _setupSpikeExchange()
     sim.pc.setup_transfer()  # setup transfer of source_var to target_var
 
     # handler for printing out time during simulation run
@@ -756,34 +874,141 @@ def preRun ():
         sim.printRunTime = printRunTime
         sim.fih.append(h.FInitializeHandler(1, sim.printRunTime))
 
-    # reset all netstims so runs are always equivalent
+    # reset all netstims so runs are always equivalent (reseeded in a single hoc loop)
+    netStimRands = _netStimRands()
+    if netStimRands:
+        rands = h.List()
+        for rand, randId, randSeed in netStimRands: rands.append(rand)
+        _hocExec('objref netpyneRands, netpyneRandIds, netpyneRandSeeds')
+        h.netpyneRands = rands
+        h.netpyneRandIds = h.Vector([randId for rand, randId, randSeed in netStimRands])
+        h.netpyneRandSeeds = h.Vector([randSeed for rand, randId, randSeed in netStimRands])
+        _hocExec('for netpyneRandIdx=0,netpyneRands.count()-1 { netpyneRands.o(netpyneRandIdx).Random123(netpyneRandIds.x[netpyneRandIdx], netpyneRandSeeds.x[netpyneRandIdx]) netpyneRands.o(netpyneRandIdx).negexp(1) }')
+
+
+###############################################################################
+### Execute hoc statement raising errors (h() only prints them and returns 0)
+###############################################################################
+def _hocExec (statement):
+    if not h(statement):
+        raise RuntimeError('hoc error executing: %s' % (statement))
+
+
+###############################################################################
+### Random number generators of NetStims (cells and stims)
+###############################################################################
+def _netStimRands ():
+    ''' Returns list of (Random, id, seed) of the random number generators of NetStim cells and stims of this node '''
+    rands = []
     for cell in sim.net.cells:
         if cell.tags.get('cellModel') == 'NetStim':
-            cell.hRandom.Random123(cell.gid, sim.id32('%d'%(cell.params['seed'])))
-            cell.hRandom.negexp(1)
+            rands.append((cell.hRandom, cell.gid, sim.id32('%d'%(cell.params['seed']))))
         for stim in cell.stims:
             if 'hRandom' in stim:
-                stim['hRandom'].Random123(cell.gid, sim.id32('%d'%(stim['seed'])))
-                stim['hRandom'].negexp(1)
+                rands.append((stim['hRandom'], cell.gid, sim.id32('%d'%(stim['seed']))))
+    return rands
+
+
+###############################################################################
+### Set spike exchange interval (from min conn delay), spike compression and queue mode
+###############################################################################
+def _setupSpikeExchange ():
+    # global min delay of conns between cells (NetStims excluded since not exchanged)
+    delays = [conn['delay'] for cell in sim.net.cells for conn in cell.conns 
+                if isinstance(conn.get('preGid'), Number) and not conn.get('gapJunction') and isinstance(conn.get('delay'), Number)]
+    minDelay = sim.pc.allreduce(min(delays) if delays else 1e9, 3)  # flag 3 returns minimum value
+    if minDelay >= 1e9: minDelay = 10  # no conns between cells
+    if minDelay < sim.cfg.dt and sim.rank == 0:
+        print('  Warning: min conn delay (%.3f ms) is smaller than dt (%.3f ms); spikes will be exchanged every time step' % (minDelay, sim.cfg.dt))
+    sim.minDelay = sim.pc.set_maxstep(max(minDelay, sim.cfg.dt))  # spikes exchanged every minDelay
+    if sim.rank==0 and sim.cfg.verbose: print('Minimum delay (time-step for queue exchange) is %.2f'%(sim.minDelay))
+
+    # expected num of spikes of each host per exchange interval, and of events per time step
+    numCellsHost = sim.pc.allreduce(len(sim.net.cells), 2)  # flag 2 returns maximum value
+    numConnsHost = sim.pc.allreduce(sum([len(cell.conns) for cell in sim.net.cells]), 2)
+    spikesPerInterval = numCellsHost * sim.cfg.expectedRate/1e3 * sim.minDelay
+    eventsPerStep = numConnsHost * sim.cfg.expectedRate/1e3 * sim.cfg.dt
+
+    # compressed spike exchange (send up to nspike spikes per interval in a single fixed-size message)
+    spikeCompress = sim.cfg.spikeCompress
+    if spikeCompress == 'auto':
+        spikeCompress = sim.nhosts > 1 and spikesPerInterval < 100
+    if spikeCompress and sim.nhosts > 1:
+        nspike = int(min(max(2*spikesPerInterval, 1), 250))  # extra room to avoid second exchange when many spikes
+        gidCompress = 1 if numCellsHost < 256 else 0  # send local index instead of gid (1 byte) if few cells per host
+        sim.pc.spike_compress(nspike, gidCompress)
+        if sim.rank == 0: print('  Using compressed spike exchange (%d spikes per message%s)' % (nspike, ', compressed gids' if gidCompress else ''))
+    else:
+        sim.pc.spike_compress(0, 0)
+
+    # bin queue (events delivered at start of time step; only fixed step)
+    queueMode = sim.cfg.queueMode
+    if queueMode == 'auto':
+        queueMode = not sim.cfg.cvode_active and eventsPerStep >= 1
+    if queueMode and sim.cfg.cvode_active:
+        if sim.rank == 0: print('  Warning: bin queue cannot be used with CVode variable time step')
+        queueMode = False
+    h.cvode.queue_mode(1 if queueMode else 0, 0)
+    if queueMode and sim.rank == 0: print('  Using bin queue for spike delivery')
+
+
+###############################################################################
+### Print max computation and spike exchange time across hosts
+###############################################################################
+def _printExchangeTime ():
+    sim.runTimeData = Dict()
+    sim.runTimeData['computeTime'] = sim.pc.allreduce(sim.pc.step_time(), 2)  # flag 2 returns maximum value
+    sim.runTimeData['exchangeTime'] = sim.pc.allreduce(sim.pc.wait_time(), 2)  # time waiting for spike exchange (includes load imbalance)
+    if sim.rank == 0 and sim.cfg.timing and sim.nhosts > 1:
+        print('  Max computation time = %0.2f s; max spike exchange time = %0.2f s' % (sim.runTimeData['computeTime'], sim.runTimeData['exchangeTime']))
 
 
 ###############################################################################
 ### Run Simulation
 ###############################################################################
+def _initRun ():
+    ''' Initializes run (preRun and finitialize), unless continuing from state restored by sim.loadCheckpoint(); opens
+        spike file if cfg.spikeWriteInterval '''
+    resume = getattr(sim, 'checkpointLoaded', None)
+    sim.checkpointLoaded = None
+    if not resume:
+        preRun()
+        init()
+    if sim.rank == 0: print('\nRunning...' if not resume else '\nResuming from t = %0.2f ms...' % (h.t))
+    if getattr(sim.cfg, 'spikeWriteInterval', None): _openSpikeFile(resumeSize=resume.get('spikeFileSize') if resume else None)
+    if getattr(sim.cfg, 'checkpointInterval', None): sim.nextCheckpoint = (int(h.t / sim.cfg.checkpointInterval + 1e-9) + 1) * sim.cfg.checkpointInterval
+
+
+def _runInterval ():
+    ''' Called after each interval of the run: appends spikes to file and saves checkpoint when due '''
+    sim.writeSpikes()
+    if getattr(sim.cfg, 'checkpointInterval', None) and h.t >= sim.nextCheckpoint - h.dt/2 and round(h.t) < sim.cfg.duration:
+        sim.saveCheckpoint()
+        while sim.nextCheckpoint <= h.t + h.dt/2: sim.nextCheckpoint += sim.cfg.checkpointInterval
+
+
 def runSim ():
     sim.pc.barrier()
     timing('start', 'runTime')
-    preRun()
-    init()
-
-    if sim.rank == 0: print('\nRunning...')
-    sim.pc.psolve(sim.cfg.duration)
+    _initRun()
+
+    if getattr(sim.cfg, 'spikeWriteInterval', None) or getattr(sim.cfg, 'checkpointInterval', None):  # run in intervals, writing spikes and checkpoints after each as required
+        while round(h.t) < sim.cfg.duration:
+            stops = [sim.cfg.duration]
+            if getattr(sim.cfg, 'spikeWriteInterval', None): stops.append(h.t+sim.cfg.spikeWriteInterval)
+            if getattr(sim.cfg, 'checkpointInterval', None): stops.append(sim.nextCheckpoint)
+            sim.pc.psolve(min(stops))
+            _runInterval()
+    else:
+        sim.pc.psolve(sim.cfg.duration)
+    _closeSpikeFile()
     
     sim.pc.barrier() # Wait for all hosts to get to this point
     timing('stop', 'runTime')
     if sim.rank==0: 
         print('  Done; run time = %0.2f s; real-time ratio: %0.2f.' % 
             (sim.timingData['runTime'], sim.cfg.duration/1000/sim.timingData['runTime']))
+    _printExchangeTime()
 
 
 ###############################################################################
@@ -792,25 +1017,30 @@ def runSim ():
 def runSimWithIntervalFunc (interval, func):
     sim.pc.barrier()
     timing('start', 'runTime')
-    preRun()
-    init()
-    if sim.rank == 0: print('\nRunning...')
+    _initRun()  # spikes and checkpoints written at each interval as required
 
     while round(h.t) < sim.cfg.duration:
         sim.pc.psolve(min(sim.cfg.duration, h.t+interval))
         func(h.t) # function to be called at intervals
+        _runInterval()
+
+    _closeSpikeFile()
 
     sim.pc.barrier() # Wait for all hosts to get to this point
     timing('stop', 'runTime')
     if sim.rank==0: 
         print('  Done; run time = %0.2f s; real-time ratio: %0.2f.' % 
             (sim.timingData['runTime'], sim.cfg.duration/1000/sim.timingData['runTime']))
+    _printExchangeTime()
                 
 
 ###############################################################################
 ### Gather tags from cells
 ###############################################################################
 def _gatherAllCellTags ():
+    if sim.net.allCellTags:  # tags of all cells already available in each node (stored when creating or loading cells)
+        return sim.net.allCellTags
+
     data = [{cell.gid: cell.tags for cell in sim.net.cells}]*sim.nhosts  # send cells data to other nodes
     gather = sim.pc.py_alltoall(data)  # collect cells data from other nodes (required to generate connections)
     sim.pc.barrier()
@@ -831,6 +1061,84 @@ def _gatherAllCellTags ():
     return allCellTags
 
 
+###############################################################################
+### Gather recorded Vectors from nodes as contiguous arrays
+###############################################################################
+def _gatherSimDataVecs (simDataVecs):
+    ''' Sends all Vectors recorded in each node (spikes, traces, stim spikes) concatenated in a single Vector to node 0 
+        via pc.alltoall, so bulk data is not pickled; only the key and length of each Vector are sent via py_alltoall. 
+        Returns dict with numpy arrays (views of a single contiguous array) in node 0.'''
+    import numpy as np
+
+    # concatenate local Vectors, keeping key and length of each
+    vsrc = h.Vector()
+    vecKeys, vecLens = [], []
+    vecTypes = ODict()
+    for key in simDataVecs:
+        if key not in sim.simData: continue
+        val = sim.simData[key]
+        if isinstance(val, dict):
+            vecTypes[key] = 'dict'
+            for cell,val2 in val.iteritems():
+                if isinstance(val2, dict):
+                    for stim,val3 in val2.iteritems():  # dicts of dicts of Vectors (eg. ['stim']['cell_1']['background']=h.Vector)
+                        vecKeys.append((key, cell, stim))
+                        vecLens.append(int(val3.size()))
+                        vsrc.append(val3)
+                else:  # dicts of Vectors (eg. ['v']['cell_1']=h.Vector)
+                    vecKeys.append((key, cell))
+                    vecLens.append(int(val2.size()))
+                    vsrc.append(val2)
+        else:  # Vectors (eg. ['spkt']=h.Vector)
+            vecTypes[key] = 'vec'
+            vecKeys.append((key,))
+            vecLens.append(int(val.size()))
+            vsrc.append(val)
+
+    # send metadata via py_alltoall and Vector data via alltoall (only to node 0)
+    data = [None]*sim.nhosts
+    data[0] = {'vecKeys': vecKeys, 'vecLens': vecLens, 'vecTypes': vecTypes}
+    gather = sim.pc.py_alltoall(data)
+    vcnt = h.Vector(sim.nhosts)
+    vcnt.x[0] = vsrc.size()
+    vdest = h.Vector()
+    sim.pc.alltoall(vsrc, vcnt, vdest)
+    sim.pc.barrier()
+
+    allSimDataVecs = Dict()
+    if sim.rank == 0:
+        allVecs = vdest.as_numpy().copy()
+        for key,vecType in gather[0]['vecTypes'].iteritems():
+            allSimDataVecs[key] = Dict() if vecType == 'dict' else []
+
+        # split contiguous array into Vectors of each node
+        offset = 0
+        for node in gather:
+            for vecKey,vecLen in zip(node['vecKeys'], node['vecLens']):
+                vec = allVecs[offset:offset+vecLen]
+                offset += vecLen
+                if len(vecKey) == 3:
+                    allSimDataVecs[vecKey[0]].setdefault(vecKey[1], Dict())[vecKey[2]] = vec
+                elif len(vecKey) == 2:
+                    allSimDataVecs[vecKey[0]][vecKey[1]] = vec
+                else:
+                    allSimDataVecs[vecKey[0]].append(vec)
+        
+        # concatenate Vectors from all nodes (eg. spike times and gids)
+        for key,vecType in gather[0]['vecTypes'].iteritems():
+            if vecType == 'vec':
+                allSimDataVecs[key] = np.concatenate(allSimDataVecs[key]) if allSimDataVecs[key] else np.array([])
+
+    # clean to avoid mem leaks
+    for node in gather: 
+        if node:
+            node.clear()
+            del node
+    del vsrc, vdest
+
+    return allSimDataVecs
+
+
 ###############################################################################
 ### Gather data from nodes
 ###############################################################################
@@ -854,10 +1162,17 @@ def gatherData ():
     simDataVecs = ['spkt','spkid','stims']+sim.cfg.recordTraces.keys()
     if sim.nhosts > 1:  # only gather if >1 nodes 
         netPopsCellGids = {popLabel: list(pop.cellGids) for popLabel,pop in sim.net.pops.iteritems()}
+
+        # gather recorded Vectors as contiguous arrays (not pickled); remaining simData gathered via py_alltoall
+        if getattr(sim.cfg, 'gatherBinaryData', False):
+            allSimDataVecs = _gatherSimDataVecs(simDataVecs)
+            nodeSimData = {k: v for k,v in sim.simData.iteritems() if k not in simDataVecs}
+        else:
+            nodeSimData = sim.simData
         
         # gather only sim data
         if getattr(sim.cfg, 'gatherOnlySimData', False):
-            nodeData = {'simData': sim.simData} 
+            nodeData = {'simData': nodeSimData} 
             data = [None]*sim.nhosts
             data[0] = {}
             for k,v in nodeData.iteritems():
@@ -887,6 +1202,7 @@ def gatherData ():
                                 sim.allSimData[key] = list(sim.allSimData[key])+list(val) # udpate simData dicts which are Vectors
                         else: 
                             sim.allSimData[key].update(val)           # update simData dicts which are not Vectors
+                if getattr(sim.cfg, 'gatherBinaryData', False): sim.allSimData.update(allSimDataVecs)
 
             
             sim.net.allPops = ODict() # pops
@@ -896,7 +1212,7 @@ def gatherData ():
         
         # gather cells, pops and sim data
         else:
-            nodeData = {'netCells': [c.__getstate__() for c in sim.net.cells], 'netPopsCellGids': netPopsCellGids, 'simData': sim.simData} 
+            nodeData = {'netCells': [c.__getstate__() for c in sim.net.cells], 'netPopsCellGids': netPopsCellGids, 'simData': nodeSimData} 
             data = [None]*sim.nhosts
             data[0] = {}
             for k,v in nodeData.iteritems():
@@ -933,6 +1249,7 @@ def gatherData ():
                                 sim.allSimData[key] = list(sim.allSimData[key])+list(val) # udpate simData dicts which are Vectors
                         else: 
                             sim.allSimData[key].update(val)           # update simData dicts which are not Vectors
+                if getattr(sim.cfg, 'gatherBinaryData', False): sim.allSimData.update(allSimDataVecs)
 
                 sim.net.allCells =  sorted(allCells, key=lambda k: k['gid']) 
                 
@@ -976,14 +1293,19 @@ def gatherData ():
                 else: 
                     sim.allSimData[key].update(val)           # update simData dicts which are not Vectors
 
+    # spikes kept in spike files (cfg.spikeWriteInterval without cfg.spikeWriteReload) are counted but not gathered
+    numFileSpikes = int(sim.pc.allreduce(_numFileSpikes(), 1))  # 1 = sum
+
     ## Print statistics
     sim.pc.barrier()
     if sim.rank == 0:
         timing('stop', 'gatherTime')
         if sim.cfg.timing: print('  Done; gather time = %0.2f s.' % sim.timingData['gatherTime'])
+        if numFileSpikes:
+            print('  Warning: %d spikes written to %s_spikes_node*.bin were not gathered (cfg.spikeWriteReload is False); read them with sim.loadSpikes()' % (numFileSpikes, sim.cfg.filename))
 
         print('\nAnalyzing...')
-        sim.totalSpikes = len(sim.allSimData['spkt'])   
+        sim.totalSpikes = len(sim.allSimData['spkt']) + numFileSpikes
         sim.totalSynapses = sum([len(cell['conns']) for cell in sim.net.allCells]) 
         sim.totalConnections = sum([len(set([conn['preGid'] for conn in cell['conns']])) for cell in sim.net.allCells])   
         sim.numCells = len(sim.net.allCells)
@@ -1042,6 +1364,74 @@ def popAvgRates (trange = None, show = True):
     return avgRates
 
 
+###############################################################################
+### Calculate pop stats in each node and combine them via allreduce (no need to gather data)
+###############################################################################
+def popStats (trange = None, binSize = 5, show = True):
+    ''' Calculates num of cells, num of spikes, avg rate (Hz), mean ISI coefficient of variation (cells with >2 spikes) 
+        and synchrony (Golomb chi, using spike counts in bins of binSize ms) of each pop from the spikes recorded in each node.
+        Partial results are summed across nodes via a single allreduce, so must be called by all nodes.'''
+    import numpy as np
+
+    if not trange: trange = [0, sim.cfg.duration]
+    popLabels = list(sim.net.pops.keys())
+    numPops = len(popLabels)
+    bins = np.arange(trange[0], trange[1]+binSize, binSize)
+    numBins = len(bins)-1
+    cellPops = {cell.gid: popLabels.index(cell.tags['popLabel']) for cell in sim.net.cells}
+
+    spkt, spkid = _nodeSpikes()  # from simData, or spike file (cfg.spikeWriteInterval)
+    inRange = (spkt >= trange[0]) & (spkt <= trange[1])
+    spkt, spkid = spkt[inRange], spkid[inRange]
+
+    # partial sums of this node: numCells, numSpikes, sumCV, numCellsCV, sumVar (per pop); and binned spike counts (per pop)
+    popSums = np.zeros((numPops, 5))
+    popHists = np.zeros((numPops, numBins))
+    for ipop in cellPops.values(): popSums[ipop, 0] += 1
+    order = np.argsort(spkid, kind='mergesort')
+    spkt, spkid = spkt[order], spkid[order]
+    gids, starts = np.unique(spkid, return_index=True)
+    for gid, cellSpkt in zip(gids, np.split(spkt, starts[1:])):
+        ipop = cellPops.get(int(gid))
+        if ipop is None: continue
+        cellSpkt = np.sort(cellSpkt)
+        popSums[ipop, 1] += len(cellSpkt)
+        if len(cellSpkt) > 2:
+            isi = np.diff(cellSpkt)
+            if isi.mean() > 0:
+                popSums[ipop, 2] += isi.std() / isi.mean()
+                popSums[ipop, 3] += 1
+        cellHist = np.histogram(cellSpkt, bins)[0]
+        popSums[ipop, 4] += cellHist.var()
+        popHists[ipop] += cellHist
+
+    # sum across nodes
+    vec = h.Vector(np.concatenate([popSums.ravel(), popHists.ravel()]).tolist())
+    sim.pc.allreduce(vec, 1)  # 1 = sum
+    allSums = np.array(vec.to_python())
+    popSums = allSums[:numPops*5].reshape(numPops, 5)
+    popHists = allSums[numPops*5:].reshape(numPops, numBins)
+
+    tsecs = float(trange[1]-trange[0])/1000.0
+    stats = Dict()
+    for ipop, popLabel in enumerate(popLabels):
+        numCells, numSpikes, sumCV, numCellsCV, sumVar = popSums[ipop]
+        stats[popLabel] = Dict()
+        stats[popLabel]['numCells'] = int(numCells)
+        stats[popLabel]['numSpikes'] = int(numSpikes)
+        stats[popLabel]['rate'] = numSpikes/numCells/tsecs if numCells > 0 and tsecs > 0 else 0.0
+        stats[popLabel]['cv'] = sumCV/numCellsCV if numCellsCV > 0 else 0.0
+        popVar = (popHists[ipop]/numCells).var() if numCells > 0 else 0.0  # variance of pop-averaged activity
+        stats[popLabel]['sync'] = float(np.sqrt(popVar/(sumVar/numCells))) if sumVar > 0 else 0.0
+
+    if show and sim.rank == 0:
+        print('  Pop stats (rate, ISI CV, synchrony):')
+        for popLabel, popStat in stats.iteritems():
+            print '   %s : %.3f Hz, CV = %.3f, sync = %.3f (%d spikes)'%(popLabel, popStat['rate'], popStat['cv'], popStat['sync'], popStat['numSpikes'])
+
+    return stats
+
+
 ###############################################################################
 ### Calculate and print load balance
 ###############################################################################
@@ -1101,11 +1491,190 @@ def _gatherCells ():
         sim.net.allCells = [c.__getstate__() for c in sim.net.cells]
       
 
+###############################################################################
+### Save columns of numbers to text file (formatting blocks of rows at once)
+###############################################################################
+def _writeTextColumns (fileObj, columns, delimiter='\t', formats=None, chunkValues=2**20):
+    ''' Writes list of 1D arrays, lists or Vectors as columns of text (shorter columns padded with nan), formatting chunks of
+        about chunkValues numbers at a time; formats: list with format of each column (default: '%.8g') '''
+    import numpy as np
+    columns = [col.as_numpy() if hasattr(col, 'as_numpy') else np.asarray(col, dtype='float64') for col in columns]
+    numRows = max([len(col) for col in columns]) if columns else 0
+    rowFormat = delimiter.join(formats or ['%.8g']*len(columns)) + '\n'
+    chunkRows = max(1, chunkValues // max(1, len(columns)))  # rows per chunk, so memory does not depend on num of columns
+    for start in xrange(0, numRows, chunkRows):
+        stop = min(start+chunkRows, numRows)
+        chunk = np.empty((stop-start, len(columns)))
+        for icol, col in enumerate(columns):
+            values = col[start:stop]
+            chunk[:len(values), icol] = values
+            chunk[len(values):, icol] = np.nan
+        fileObj.write((rowFormat * (stop-start)) % tuple(chunk.ravel().tolist()))
+
+
+def _saveTracesText (simData, filename, ext, delimiter='\t', scale=1.0, header=True):
+    ''' Saves each trace in simData to text file (filename_trace.ext) with time in the first column and one column per cell;
+        cells are split in files of cfg.textBlockSize cells (filename_trace_block.ext), or all in one file if None '''
+    import numpy as np
+    for ref in sim.cfg.recordTraces:
+        if ref not in simData or not simData[ref]: continue
+        cellLabels = sorted(simData[ref].keys(), key=lambda label: int(label.split('_')[-1]) if label.split('_')[-1].isdigit() else label)
+        blockSize = sim.cfg.textBlockSize or len(cellLabels)
+        numBlocks = (len(cellLabels) + blockSize - 1) // blockSize
+        for iblock in range(numBlocks):
+            labels = cellLabels[iblock*blockSize:(iblock+1)*blockSize]
+            fileName = '%s_%s%s.%s' % (filename, ref, '_%d' % (iblock) if numBlocks > 1 else '', ext)
+            traces = [np.asarray(simData[ref][label], dtype='float64') * scale for label in labels]
+            t = np.arange(max([len(trace) for trace in traces])) * sim.cfg.recordStep * scale
+            print('  Saving %d points of %s of %d cells to %s' % (len(t), ref, len(labels), fileName))
+            with open(fileName, 'w') as fileObj:
+                if header: fileObj.write(delimiter.join(['t'] + labels) + '\n')
+                _writeTextColumns(fileObj, [t] + traces, delimiter, formats=['%.12g'] + ['%.8g']*len(traces))  # traces shorter than t padded with nan
+
+
+###############################################################################
+### Save data in one format
+###############################################################################
+_saveFormats = [('pkl', 'savePickle'), ('dpk', 'saveDpk'), ('json', 'saveJson'), ('mat', 'saveMat'), ('hdf5', 'saveHDF5'),
+                ('container', 'saveContainer'), ('csv', 'saveCSV'), ('dat', 'saveDat')]  # output formats and cfg option that enables each
+_saveWriters = []  # background writers of saveData() not yet waited for (cfg.saveAsync)
+_saveAtExit = {'registered': False}  # waitSaveData() registered at exit on first background save
+
+
+def _saveDataFormat (dataSave, filename, fmt):
+    ''' Saves dataSave to filename in format fmt (dicts already converted by replaceDictODict() if saving to pkl or dpk) '''
+    # Save to pickle file (highest protocol, spikes and traces as numpy arrays; optionally compressed)
+    if fmt == 'pkl':
+        print('Saving output as %s ... ' % (filename+'.pkl'))
+        _savePickle(dataSave, filename+'.pkl', compression=sim.cfg.pickleCompression)
+        print('Finished saving!')
+
+    # Save to dpk file (gzip compressed pickle)
+    elif fmt == 'dpk':
+        print('Saving output as %s ... ' % (filename+'.dpk'))
+        _savePickle(dataSave, filename+'.dpk', compression='gzip')
+        print('Finished saving!')
+
+    # Save to json file (streamed item by item; arrays and Vectors written directly as lists of numbers)
+    elif fmt == 'json':
+        #dataSave = replaceDictODict(dataSave)  # not required since json saves as dict
+        print('Saving output as %s ... ' % (filename+'.json '))
+        sim.saveJsonStream(dataSave, filename+'.json')
+        print('Finished saving!')
+
+    # Save to mat file
+    elif fmt == 'mat':
+        from scipy.io import savemat 
+        print('Saving output as %s ... ' % (filename+'.mat'))
+        savemat(filename+'.mat', normalizeObj(dataSave, copy=True, none=True, tuples=True))  # replace None and {} with [], and tuples with str (in copy), so can save in .mat format
+        print('Finished saving!')
+
+    # Save to HDF5 file (spikes and traces as compressed datasets, cell tags as table and conns as columns; uses h5py)
+    elif fmt == 'hdf5':
+        print('Saving output as %s... ' % (filename+'.hdf5'))
+        sim.saveHDF5(dataSave, filename+'.hdf5', compression=sim.cfg.hdf5Compression)
+        print('Finished saving!')
+
+    # Save to container directory (one NumPy file per array and json index; cells, conns, spikes and traces in blocks of gids)
+    elif fmt == 'container':
+        print('Saving output as %s... ' % (filename+'_data'))
+        sim.saveContainer(dataSave, filename+'_data', blockSize=sim.cfg.containerBlockSize)
+        print('Finished saving!')
+
+    # Save to CSV files (spikes, and one file per trace with one column per cell)
+    elif fmt == 'csv':
+        if 'simData' in dataSave:
+            print('Saving output as %s ... ' % (filename+'.csv'))
+            if 'spkt' in dataSave['simData']:
+                with open(filename+'.csv', 'w') as fileObj:
+                    fileObj.write('spkt,spkid\n')
+                    _writeTextColumns(fileObj, [dataSave['simData']['spkt'], dataSave['simData']['spkid']], delimiter=',', formats=['%.12g', '%d'])
+            _saveTracesText(dataSave['simData'], filename, 'csv', delimiter=',', header=True)
+            print('Finished saving!')
+
+    # Save to Dat files (one file per trace with one column per cell; time in s and values divided by 1000, eg. V)
+    elif fmt == 'dat':
+        if 'simData' in dataSave:
+            _saveTracesText(dataSave['simData'], filename, 'dat', delimiter='\t', scale=1e-3, header=False)
+            print('Finished saving!')
+
+
+###############################################################################
+### Save data in background (thread or forked process)
+###############################################################################
+def _saveDataFormats (dataSave, filename, formats, errors):
+    ''' Saves dataSave in each format, one after the other (formats are written by Python code holding the GIL, so
+        concurrent threads would not write faster); appends (format, traceback) of each failed format to errors '''
+    import traceback
+    for fmt in formats:
+        try:
+            _saveDataFormat(dataSave, filename, fmt)
+        except Exception:
+            errors.append((fmt, traceback.format_exc()))
+            print('  Error saving %s as %s in background' % (filename, fmt))
+
+
+def _saveDataAsync (dataSave, filename, formats, mode):
+    ''' Hands dataSave to a background thread (mode 'thread') or forked process (mode 'fork') that saves all formats,
+        and returns immediately; use waitSaveData() to wait for it '''
+    import os
+    if not _saveAtExit['registered']:  # output being saved in background is written before exiting
+        import atexit
+        atexit.register(waitSaveData)
+        _saveAtExit['registered'] = True
+    writer = {'mode': mode, 'filename': filename, 'formats': formats, 'errors': []}
+    if mode == 'fork':
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid == 0:  # child: save and exit without running exit handlers of parent (eg. MPI and NEURON)
+            errors = []
+            try:
+                _saveDataFormats(dataSave, filename, formats, errors)
+                for fmt, error in errors: print(error)
+            finally:
+                sys.stdout.flush()
+                os._exit(1 if errors else 0)
+        writer['pid'] = pid
+    else:
+        import threading
+        writer['thread'] = threading.Thread(target=_saveDataFormats, args=(dataSave, filename, formats, writer['errors']))
+        writer['thread'].start()
+    _saveWriters.append(writer)
+    print('  Saving output as %s (%s) in background %s ...' % (filename, ', '.join(formats), 'process' if mode == 'fork' else 'thread'))
+
+
+###############################################################################
+### Wait for data being saved in background
+###############################################################################
+def waitSaveData ():
+    ''' Waits until all output being saved in background (cfg.saveAsync) is written, and reports failures; returns list of
+        (filename, format, error) of failed saves. Called by clearAll() and at exit. '''
+    import os
+    failed = []
+    while _saveWriters:
+        writer = _saveWriters.pop(0)
+        if writer['mode'] == 'fork':
+            _, status = os.waitpid(writer['pid'], 0)
+            if status != 0 and not writer['errors']:
+                writer['errors'].append((', '.join(writer['formats']), 'background process exited with status %d' % (status >> 8)))
+        else:
+            writer['thread'].join()
+        for fmt, error in writer['errors']:
+            print('  Error: could not save %s as %s:\n%s' % (writer['filename'], fmt, error))
+            failed.append((writer['filename'], fmt, error))
+        if not writer['errors']:
+            print('  Finished saving %s (%s) in background' % (writer['filename'], ', '.join(writer['formats'])))
+    return failed
+
+
 ###############################################################################
 ### Save data
 ###############################################################################
 def saveData (include = None):
 
+    if getattr(sim.cfg, 'saveShards', False):  # each node saves its own data; no need to gather
+        return saveDataShards(include)
+
     if sim.rank == 0 and not getattr(sim.net, 'allCells', None): needGather = True
     else: needGather = False
     if needGather: gatherData()
@@ -1149,7 +1718,7 @@ def saveData (include = None):
 
         dataSave['netpyne_version'] = sim.version(show=False)
         if getattr(sim.net.params, 'version', None): dataSave['netParams_version'] = sim.net.params.version
-        if 'netParams' in include: net['params'] = replaceFuncObj(sim.net.params.__dict__)
+        if 'netParams' in include: net['params'] = replaceFuncObj(sim.net.params.__dict__, copy=True)  # copy, so functions of netParams are kept
         if 'net' in include: include.extend(['netPops', 'netCells'])
         if 'netCells' in include: net['cells'] = sim.net.allCells
         if 'netPops' in include: net['pops'] = sim.net.allPops
@@ -1164,71 +1733,20 @@ def saveData (include = None):
                 timestampStr = datetime.fromtimestamp(timestamp).strftime('%Y%m%d_%H%M%S')
                 sim.cfg.filename = sim.cfg.filename+'-'+timestampStr
 
-            # Save to pickle file
-            if sim.cfg.savePickle:
-                import pickle
-                dataSave = replaceDictODict(dataSave)
-                print('Saving output as %s ... ' % (sim.cfg.filename+'.pkl'))
-                with open(sim.cfg.filename+'.pkl', 'wb') as fileObj:
-                    pickle.dump(dataSave, fileObj)
-                print('Finished saving!')
-
-            # Save to dpk file
-            if sim.cfg.saveDpk:
-                import gzip
-                print('Saving output as %s ... ' % (sim.cfg.filename+'.dpk'))
-                fn=sim.cfg.filename #.split('.')
-                gzip.open(fn, 'wb').write(pk.dumps(dataSave)) # write compressed string
-                print('Finished saving!')
-
-            # Save to json file
-            if sim.cfg.saveJson:
-                import json
-                #dataSave = replaceDictODict(dataSave)  # not required since json saves as dict
-                print('Saving output as %s ... ' % (sim.cfg.filename+'.json '))
-                with open(sim.cfg.filename+'.json', 'w') as fileObj:
-                    json.dump(dataSave, fileObj)
-                print('Finished saving!')
-
-            # Save to mat file
-            if sim.cfg.saveMat:
-                from scipy.io import savemat 
-                print('Saving output as %s ... ' % (sim.cfg.filename+'.mat'))
-                savemat(sim.cfg.filename+'.mat', tupleToStr(replaceNoneObj(dataSave)))  # replace None and {} with [] so can save in .mat format
-                print('Finished saving!')
-
-            # Save to HDF5 file (uses very inefficient hdf5storage module which supports dicts)
-            if sim.cfg.saveHDF5:
-                dataSaveUTF8 = _dict2utf8(replaceNoneObj(dataSave)) # replace None and {} with [], and convert to utf
-                import hdf5storage
-                print('Saving output as %s... ' % (sim.cfg.filename+'.hdf5'))
-                hdf5storage.writes(dataSaveUTF8, filename=sim.cfg.filename+'.hdf5')
-                print('Finished saving!')
-
-            # Save to CSV file (currently only saves spikes)
-            if sim.cfg.saveCSV:
-                if 'simData' in dataSave:
-                    import csv
-                    print('Saving output as %s ... ' % (sim.cfg.filename+'.csv'))
-                    writer = csv.writer(open(sim.cfg.filename+'.csv', 'wb'))
-                    for dic in dataSave['simData']:
-                        for values in dic:
-                            writer.writerow(values)
-                    print('Finished saving!')
-
-            # Save to Dat file(s) 
-            if sim.cfg.saveDat:
-                traces = sim.cfg.recordTraces
-                for ref in traces.keys():
-                    for cellid in sim.allSimData[ref].keys():
-                        dat_file_name = '%s_%s.dat'%(ref,cellid)
-                        dat_file = open(dat_file_name, 'w')
-                        trace = sim.allSimData[ref][cellid]
-                        print("Saving %i points of data on: %s:%s to %s"%(len(trace),ref,cellid,dat_file_name))
-                        for i in range(len(trace)):
-                            dat_file.write('%s\t%s\n'%((i*sim.cfg.dt/1000),trace[i]/1000))
-
-                print('Finished saving!')
+            filename = sim.cfg.filename
+            formats = [fmt for fmt, option in _saveFormats if getattr(sim.cfg, option, False)]
+            if 'pkl' in formats or 'dpk' in formats: dataSave = replaceDictODict(dataSave)
+
+            if getattr(sim.cfg, 'saveAsync', False) and formats:  # save in background and return immediately
+                mode = 'fork' if sim.cfg.saveAsync == 'fork' else 'thread'
+                if mode == 'fork' and sim.nhosts > 1:  # many MPI implementations do not support fork()
+                    print('  Warning: cannot fork MPI process to save in background; using background thread instead')
+                    mode = 'thread'
+                if mode == 'thread' and 'simConfig' in dataSave:  # cfg may change before saved; net and simData are replaced (not modified) by later gathers
+                    dataSave = dict(dataSave, simConfig=normalizeObj(dataSave['simConfig'], copy=True))
+                _saveDataAsync(dataSave, filename, formats, mode=mode)
+            else:
+                for fmt in formats: _saveDataFormat(dataSave, filename, fmt)
 
             # Save timing
             if sim.cfg.timing: 
@@ -1239,9 +1757,10 @@ def saveData (include = None):
                 with open('timing.pkl', 'wb') as file: pickle.dump(sim.timing, file)
 
 
-            # clean to avoid mem leaks
-            for key in dataSave.keys(): 
-                del dataSave[key]
+            # clean to avoid mem leaks (unless still being saved in background)
+            if not getattr(sim.cfg, 'saveAsync', False):
+                for key in dataSave.keys(): 
+                    del dataSave[key]
             del dataSave
 
             # return full path
@@ -1252,6 +1771,90 @@ def saveData (include = None):
             print('Nothing to save')
 
 
+###############################################################################
+### Save data of each node to a separate file (shard), plus index file
+###############################################################################
+def saveDataShards (include = None):
+    ''' Each node saves its own cells, pops (with local cell gids) and simData to a separate file, and node 0 saves an 
+        index (filename_shards.json) with the file, format and gids of each shard. Shards can be read as a single 
+        dataset or merged offline using netpyne.shards (does not require NEURON).'''
+    import os
+    timing('start', 'saveTime')
+    if not include: include = sim.cfg.saveDataInclude
+    if 'net' in include: include = include + ['netPops', 'netCells']
+    ext = 'pkl' if sim.cfg.savePickle or not sim.cfg.saveJson else 'json'
+
+    # create folder if missing
+    targetFolder = os.path.dirname(sim.cfg.filename)
+    if sim.rank == 0 and targetFolder and not os.path.exists(targetFolder):
+        try:
+            os.mkdir(targetFolder)
+        except OSError:
+            print ' Could not create target folder: %s' % (targetFolder)
+    sim.pc.barrier()
+
+    # data of this node
+    simDataVecs = ['spkt','spkid','stims']+sim.cfg.recordTraces.keys()
+    dataSave = {'netpyne_version': sim.version(show=False), 'node': sim.rank, 'nhosts': sim.nhosts}
+    net = {}
+    if sim.rank == 0:
+        if 'netParams' in include: net['params'] = replaceFuncObj(sim.net.params.__dict__, copy=True)  # copy, so functions of netParams are kept
+        if 'simConfig' in include: dataSave['simConfig'] = sim.cfg.__dict__
+    if 'netCells' in include: net['cells'] = [c.__getstate__() for c in sim.net.cells]
+    if 'netPops' in include: 
+        net['pops'] = ODict()
+        for popLabel,pop in sim.net.pops.iteritems(): net['pops'][popLabel] = pop.__getstate__() # cellGids of local cells
+    if net: dataSave['net'] = net
+    spkt, spkid = _nodeSpikes()  # from simData, or spike file (cfg.spikeWriteInterval)
+    if 'simData' in include: 
+        import numpy as np
+        toArray = lambda vec: vec.as_numpy() if hasattr(vec, 'as_numpy') else np.asarray(vec)  # Vectors as numpy arrays (without copy)
+        simData = Dict()
+        for key,val in sim.simData.iteritems():
+            if key == 'spkt': simData[key] = spkt
+            elif key == 'spkid': simData[key] = spkid
+            elif key in simDataVecs:
+                if isinstance(val,dict):
+                    simData[key] = Dict()
+                    for cell,val2 in val.iteritems():
+                        if isinstance(val2,dict):
+                            simData[key][cell] = Dict({stim: toArray(val3) for stim,val3 in val2.iteritems()})
+                        else:
+                            simData[key][cell] = toArray(val2)
+                else:
+                    simData[key] = toArray(val)
+            else:
+                simData[key] = val
+        dataSave['simData'] = simData
+
+    shardFilename = '%s_node%d.%s' % (sim.cfg.filename, sim.rank, ext)
+    if ext == 'pkl':
+        _savePickle(replaceDictODict(dataSave), shardFilename, compression=sim.cfg.pickleCompression)
+    else:
+        sim.saveJsonStream(dataSave, shardFilename)
+
+    # gather shard info in node 0 and save index
+    gids = sorted([cell.gid for cell in sim.net.cells])  # actual gids (with round-robin or cost partitions, range spans most gids)
+    shardInfo = {'node': sim.rank, 'file': os.path.basename(shardFilename), 'numCells': len(gids), 
+                'gidRange': [gids[0], gids[-1]] if gids else [], 'gids': gids, 'numSpikes': len(spkt)}
+    data = [None]*sim.nhosts
+    data[0] = shardInfo
+    gather = sim.pc.py_alltoall(data)
+    sim.pc.barrier()
+
+    if sim.rank == 0:
+        import json
+        indexFilename = sim.cfg.filename+'_shards.json'
+        print('Saving output as %d shards (%s) with index %s ... ' % (sim.nhosts, ext, indexFilename))
+        with open(indexFilename, 'w') as fileObj:
+            json.dump({'netpyne_version': sim.version(show=False), 'format': ext, 'nhosts': sim.nhosts, 
+                        'include': include, 'shards': gather}, fileObj, indent=2)
+        print('Finished saving!')
+        timing('stop', 'saveTime')
+        if sim.cfg.timing: print('  Done; saving time = %0.2f s.' % sim.timingData['saveTime'])
+        return os.getcwd()+'/'+indexFilename
+
+
 ###############################################################################
 ### Timing - Stop Watch
 ###############################################################################
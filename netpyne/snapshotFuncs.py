@@ -0,0 +1,208 @@
+"""
+snapshotFuncs.py
+
+Contains functions to save a binary snapshot of the instantiated network (cells of each node, cellParams rules of each
+cell, and conns of each cell as contiguous NumPy arrays), and to instantiate the network from it. Allows building a
+network once and simulating it many times, without regenerating it or parsing cell and conn dicts.
+
+Contributors: salvadordura@gmail.com
+"""
+
+__all__ = []
+__all__.extend(['saveSnapshot', 'loadSnapshot'])  # snapshot
+
+import os
+import json
+from numbers import Number
+from specs import Dict
+from partitionFuncs import _cellRuleConds
+import sim
+
+
+snapshotFormatVersion = 1  # version of layout of snapshot directories, saved in index
+
+_connLabelKeys = ['sec', 'synMech', 'label', 'preLabel']  # conn keys saved as ids of table of labels of each node
+_connNumKeys = ['loc', 'weight', 'delay', 'threshold']  # conn keys saved as float arrays (nan if missing)
+
+
+###############################################################################
+### Helper functions
+###############################################################################
+def _nodeFilename (path, node, ext):
+    return os.path.join(path, 'node_%d.%s' % (node, ext))
+
+
+def _isHObj (value):
+    return type(value).__module__ in ['hoc', 'nrn']  # NEURON objects (eg. Vectors of conns with shape); hasattr on netpyne Dicts creates the key
+
+
+###############################################################################
+### Save snapshot of network
+###############################################################################
+def saveSnapshot (path=None):
+    ''' Each node saves its cells to path/node_<rank>.npz (gids, cellParams rules and conns as arrays) and path/node_<rank>.json
+        (tags, stims and tables of labels), and node 0 saves path/index.json (nhosts and pops); must be called by all nodes
+        after the network is created and connected. Default path: cfg.filename+'_snapshot' '''
+    import numpy as np
+    if path is None: path = sim.cfg.filename+'_snapshot'
+    sim.timing('start', 'saveSnapshotTime')
+    if sim.rank == 0 and not os.path.exists(path): os.makedirs(path)
+    sim.pc.barrier()
+
+    cellRules = sim.net.params.cellParams.keys()
+    labels = {key: [] for key in _connLabelKeys}
+    labelIds = {key: {} for key in _connLabelKeys}
+    def labelId (key, value):
+        if value is None: return -1
+        if value not in labelIds[key]:
+            labelIds[key][value] = len(labels[key])
+            labels[key].append(value)
+        return labelIds[key][value]
+
+    gids, pointCells, ruleStart, ruleIds, connStart = [], [], [0], [], [0]
+    preGids = []
+    connIds = {key: [] for key in _connLabelKeys}
+    connNums = {key: [] for key in _connNumKeys}
+    cellsData, connExtras = [], {}
+    for cell in sim.net.cells:
+        gids.append(cell.gid)
+        isPointCell = isinstance(cell, sim.PointCell)
+        pointCells.append(isPointCell)
+        if not isPointCell:
+            ruleIds.extend([i for i, ruleLabel in enumerate(cellRules) if _cellRuleConds(cell.tags, sim.net.params.cellParams[ruleLabel]['conds'])])
+        ruleStart.append(len(ruleIds))
+        cellData = {'tags': cell.tags, 'stims': [{k: v for k, v in stim.iteritems() if not k.startswith('h')} for stim in cell.stims]}
+        if isPointCell: cellData['params'] = cell.params
+        cellsData.append(cellData)
+
+        for conn in cell.conns:
+            preGid = conn.get('preGid')
+            preGids.append(int(preGid) if isinstance(preGid, Number) else -1)  # -1: NetStim
+            for key in _connLabelKeys:
+                connIds[key].append(labelId(key, conn.get(key)))
+            for key in _connNumKeys:
+                connNums[key].append(conn[key] if isinstance(conn.get(key), Number) else float('nan'))
+            extra = {k: v for k, v in conn.iteritems() if k not in _connLabelKeys+_connNumKeys+['preGid'] and not k.startswith('h') and not _isHObj(v)}
+            if extra: connExtras[len(preGids)-1] = extra  # eg. plast
+        connStart.append(len(preGids))
+
+    arrays = {'gids': np.array(gids, dtype='int64'), 'pointCells': np.array(pointCells, dtype='bool'),
+              'ruleStart': np.array(ruleStart, dtype='int64'), 'ruleIds': np.array(ruleIds, dtype='int32'),
+              'connStart': np.array(connStart, dtype='int64'), 'preGid': np.array(preGids, dtype='int64')}
+    arrays.update({key: np.array(connIds[key], dtype='int32') for key in _connLabelKeys})
+    arrays.update({key: np.array(connNums[key], dtype='float64') for key in _connNumKeys})
+    np.savez(_nodeFilename(path, sim.rank, 'npz'), **arrays)
+    with open(_nodeFilename(path, sim.rank, 'json'), 'w') as fileObj:
+        json.dump({'cellRules': cellRules, 'labels': labels, 'cells': cellsData, 'connExtras': connExtras}, fileObj, default=str)
+
+    if sim.rank == 0:
+        index = {'format': 'netpyne-snapshot', 'snapshotFormatVersion': snapshotFormatVersion, 'netpyne_version': sim.version(show=False),
+                 'nhosts': sim.nhosts, 'pops': {popLabel: pop.tags for popLabel, pop in sim.net.pops.iteritems()}}
+        with open(os.path.join(path, 'index.json'), 'w') as fileObj:
+            json.dump(index, fileObj, default=str)
+
+    sim.pc.barrier()
+    sim.timing('stop', 'saveSnapshotTime')
+    if sim.rank == 0:
+        print('  Saved snapshot of network to %s (%d nodes)' % (path, sim.nhosts))
+        if sim.cfg.timing: print('  Done; snapshot saving time = %0.2f s.' % sim.timingData['saveSnapshotTime'])
+    return path
+
+
+###############################################################################
+### Add conns of cell from snapshot arrays
+###############################################################################
+def _snapshotConns (arrays, nodeData, ind):
+    ''' Returns list of conns (Dicts) of cell with index ind in node arrays '''
+    start, stop = arrays['connStart'][ind], arrays['connStart'][ind+1]
+    if stop == start: return []
+    preGids = arrays['preGid'][start:stop].tolist()
+    ids = {key: arrays[key][start:stop].tolist() for key in _connLabelKeys}
+    nums = {key: arrays[key][start:stop].tolist() for key in _connNumKeys}
+    labels = nodeData['labels']
+    connExtras = nodeData['connExtras']
+
+    conns = []
+    for i in range(stop-start):
+        conn = Dict({'preGid': preGids[i] if preGids[i] >= 0 else 'NetStim'})
+        for key in _connLabelKeys:
+            if ids[key][i] >= 0: conn[key] = labels[key][ids[key][i]]
+        for key in _connNumKeys:
+            if nums[key][i] == nums[key][i]: conn[key] = nums[key][i]  # skip nan (missing)
+        if connExtras and str(start+i) in connExtras: conn.update(connExtras[str(start+i)])
+        conns.append(conn)
+    return conns
+
+
+###############################################################################
+### Instantiate network from snapshot
+###############################################################################
+def loadSnapshot (path=None):
+    ''' Instantiates network saved with saveSnapshot(): if running on the same number of nodes, each node only reads its own
+        file and keeps the saved partition; otherwise cells are distributed as in sim.loadNet(). CompartCells are created
+        directly from the cellParams rules saved for each cell (netParams must be set), and conns from the saved arrays.
+        Must be called by all nodes after sim.initialize(). Default path: cfg.filename+'_snapshot' '''
+    import numpy as np
+    if path is None: path = sim.cfg.filename+'_snapshot'
+    sim.timing('start', 'loadSnapshotTime')
+    with open(os.path.join(path, 'index.json'), 'r') as fileObj:
+        index = json.load(fileObj)
+
+    # nodes to read (own file if same num of nodes; otherwise all files, keeping cells assigned to this node)
+    if index['nhosts'] == sim.nhosts:
+        nodes, nodeGids = [sim.rank], None
+    else:
+        nodes = range(index['nhosts'])
+        allGids = sorted([gid for node in nodes for gid in np.load(_nodeFilename(path, node, 'npz'))['gids'].tolist()])
+        nodeGids = set(sim.getNodeGids(allGids))
+        if sim.rank == 0: print('  Snapshot saved with %d nodes; redistributing cells across %d nodes' % (index['nhosts'], sim.nhosts))
+
+    for popLabel, popTags in index['pops'].iteritems():
+        sim.net.pops[popLabel] = sim.Pop.fromTags(popLabel, popTags)
+
+    # create cells and associate gids
+    cellsConns = []
+    for node in nodes:
+        arrays = np.load(_nodeFilename(path, node, 'npz'))
+        arrays = {key: arrays[key] for key in arrays.files}
+        with open(_nodeFilename(path, node, 'json'), 'r') as fileObj:
+            nodeData = json.load(fileObj)
+        cellRules = [sim.net.params.cellParams.get(ruleLabel) for ruleLabel in nodeData['cellRules']]
+        ruleStart, ruleIds = arrays['ruleStart'].tolist(), arrays['ruleIds'].tolist()
+
+        for ind, gid in enumerate(arrays['gids'].tolist()):
+            if nodeGids is not None and gid not in nodeGids: continue
+            cellData = nodeData['cells'][ind]
+            if arrays['pointCells'][ind]:
+                tags = dict(cellData['tags'])
+                tags['params'] = cellData['params']
+                cell = sim.PointCell(gid, tags, create=True, associateGid=True)
+            else:
+                cell = sim.CompartCell(gid, cellData['tags'], create=False, associateGid=False)
+                for ruleId in ruleIds[ruleStart[ind]:ruleStart[ind+1]]:  # apply saved rules; no need to check conds
+                    if cellRules[ruleId] is None:
+                        print('  Error: cellParams rule %s of cell %d not found in netParams' % (nodeData['cellRules'][ruleId], gid))
+                        continue
+                    if sim.cfg.createPyStruct: cell.createPyStruct(cellRules[ruleId])
+                    if sim.cfg.createNEURONObj: cell.createNEURONObj(cellRules[ruleId])
+                cell.associateGid()
+            cell.stims = [Dict(stim) for stim in cellData['stims']]
+            if cell.tags.get('popLabel') in sim.net.pops: sim.net.pops[cell.tags['popLabel']].cellGids.append(gid)
+            sim.net.cells.append(cell)
+            cellsConns.append((cell, arrays, nodeData, ind))
+
+    # create stims and conns
+    sim.pc.barrier()
+    for cell, arrays, nodeData, ind in cellsConns:
+        cell.conns = _snapshotConns(arrays, nodeData, ind)
+        if sim.cfg.createNEURONObj:
+            cell.addStimsNEURONObj()  # add stims first so can then create conns between netstims
+            cell.addConnsNEURONObj()
+    sim.net.allCellTags = {}  # gathered from nodes when required
+
+    sim.pc.barrier()
+    sim.timing('stop', 'loadSnapshotTime')
+    numConns = sum([len(cell.conns) for cell in sim.net.cells])
+    print('  Node %d: instantiated %d cells and %d conns from snapshot %s' % (sim.rank, len(sim.net.cells), numConns, path))
+    if sim.rank == 0 and sim.cfg.timing: print('  Done; snapshot instantiation time = %0.2f s.' % sim.timingData['loadSnapshotTime'])
+    return sim.net.cells
@@ -0,0 +1,330 @@
+"""
+sonataFuncs.py
+
+Contains functions to export the network to SONATA format (nodes and edges as columnar HDF5 files, plus space-delimited
+CSV tables of node and edge types, and circuit config), and to instantiate a network from SONATA files, where each node
+only reads its own cells and, using the target index of each edge file, only the edge ranges of its own cells.
+
+Contributors: salvadordura@gmail.com
+"""
+
+__all__ = []
+__all__.extend(['saveSONATA', 'loadSONATA'])  # SONATA
+
+import os
+import csv
+import json
+from numbers import Number
+from collections import OrderedDict
+import sim
+
+
+_nodePopulation = 'netpyne'  # name of node population of exported network
+_nodeColumns = ['x', 'y', 'z', 'xnorm', 'ynorm', 'znorm']  # numeric cell tags saved as columns of node group
+_edgeColumns = [('syn_weight', 'weight'), ('delay', 'delay'), ('afferent_section_pos', 'loc'), ('threshold', 'threshold')]  # (edge group column, conn key)
+_readRanges = 10000  # max number of edge ranges read from file at a time
+
+
+###############################################################################
+### Helper functions
+###############################################################################
+def _writeTypes (fileName, columns, rows):
+    ''' Writes SONATA types table (space-delimited CSV) '''
+    with open(fileName, 'wb') as fileObj:
+        writer = csv.writer(fileObj, delimiter=' ', quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow([row.get(column, 'NONE') for column in columns])
+
+
+def _readTypes (fileName, idColumn):
+    ''' Reads SONATA types table; returns dict of id: row (dict) '''
+    types = {}
+    with open(fileName, 'rb') as fileObj:
+        for row in csv.DictReader(fileObj, delimiter=' ', skipinitialspace=True):
+            types[int(row[idColumn])] = {k: v for k, v in row.iteritems() if k and v not in [None, 'NONE']}
+    return types
+
+
+def _resolvePath (fileName, manifest, basePath):
+    for key, value in manifest.iteritems():
+        fileName = fileName.replace(key, value)
+    return fileName if os.path.isabs(fileName) else os.path.normpath(os.path.join(basePath, fileName))
+
+
+def _loadConfig (path):
+    ''' Returns circuit config (dict) with paths of nodes and edges files resolved '''
+    configFile = os.path.join(path, 'circuit_config.json') if os.path.isdir(path) else path
+    basePath = os.path.dirname(os.path.abspath(configFile))
+    with open(configFile, 'r') as fileObj:
+        config = json.load(fileObj)
+    manifest = {key: _resolvePath(value, {}, basePath) for key, value in config.get('manifest', {}).iteritems()}
+    for _ in range(len(manifest)):  # manifest entries can refer to other entries
+        manifest = {key: _resolvePath(value, manifest, basePath) for key, value in manifest.iteritems()}
+    for key in ['nodes', 'edges']:
+        for files in config.get('networks', {}).get(key, []):
+            for fileKey in files:
+                if fileKey.endswith('_file'): files[fileKey] = _resolvePath(files[fileKey], manifest, basePath)
+    if 'netpyne' in config and 'netParams' in config['netpyne']:
+        config['netpyne']['netParams'] = _resolvePath(config['netpyne']['netParams'], manifest, basePath)
+    return config
+
+
+def _readIndices (dataset, indices):
+    ''' Reads values of dataset at indices: as one block if indices are dense enough, otherwise each run of consecutive
+        indices separately (eg. edges of cells of this node, interleaved with those of other nodes) '''
+    import numpy as np
+    if not len(indices): return dataset[0:0]
+    start, stop = int(indices.min()), int(indices.max())+1
+    if stop - start <= 4*len(indices):
+        return dataset[start:stop][indices - start]
+    runs = np.split(indices, np.flatnonzero(np.diff(indices) != 1) + 1)
+    return np.concatenate([dataset[int(run[0]):int(run[-1])+1] for run in runs])
+
+
+def _readGroupColumns (popGroup, groupIds, groupIndex):
+    ''' Returns dict of numeric columns of node or edge groups, for nodes or edges with groupIds and groupIndex '''
+    import numpy as np
+    columns = {}
+    for groupId in np.unique(groupIds).tolist():
+        if str(groupId) not in popGroup: continue
+        inGroup = np.flatnonzero(groupIds == groupId)
+        for name, dataset in popGroup[str(groupId)].iteritems():
+            if not hasattr(dataset, 'dtype') or dataset.dtype.kind not in 'biuf': continue
+            values = _readIndices(dataset, groupIndex[inGroup].astype('int64'))
+            if name == 'positions' and values.ndim == 2:  # positions as (n, 3) dataset
+                for i, axis in enumerate(['x', 'y', 'z']):
+                    columns.setdefault(axis, np.full(len(groupIds), np.nan))[inGroup] = values[:, i]
+            elif values.ndim == 1:
+                columns.setdefault(name, np.full(len(groupIds), np.nan))[inGroup] = values
+    return columns
+
+
+###############################################################################
+### Export network to SONATA
+###############################################################################
+def saveSONATA (path=None):
+    ''' Exports network to SONATA files in path: nodes.h5 and node_types.csv (one node type per population; cell positions
+        as node group columns), edges.h5 and edge_types.csv (one edge type per synMech and section; weight, delay, loc and
+        threshold as edge group columns; edges sorted by target with target_to_source index), and circuit_config.json, which
+        also includes the pop tags and netParams (netParams.json) used by loadSONATA(). Conns from NetStims are not exported.
+        Must be called by all nodes; gathers cells in node 0 if required. Default path: cfg.filename+'_sonata' '''
+    import numpy as np
+    import h5py
+    if path is None: path = sim.cfg.filename+'_sonata'
+    needGather = sim.pc.py_broadcast(not getattr(sim.net, 'allCells', None), 0)  # allCells only set in node 0, so all nodes follow its decision
+    if needGather: sim.gatherData()
+    if sim.rank != 0: return path
+
+    sim.timing('start', 'saveSONATATime')
+    print('Exporting network to SONATA files in %s ...' % (path))
+    if not os.path.exists(path): os.makedirs(path)
+
+    # node types (one per population)
+    popLabels = sim.net.allPops.keys()
+    popIds = {popLabel: i for i, popLabel in enumerate(popLabels)}
+    nodeTypes = []
+    for popLabel in popLabels:
+        tags = sim.net.allPops[popLabel]['tags']
+        pointCell = 'params' in tags
+        nodeTypes.append({'node_type_id': popIds[popLabel], 'pop_name': popLabel, 'cell_type': tags.get('cellType', 'NONE'),
+                          'model_type': ('virtual' if tags.get('cellModel') in ['NetStim', 'VecStim'] else 'point_neuron') if pointCell else 'biophysical',
+                          'model_template': 'nrn:%s' % (tags.get('cellModel'))})
+    _writeTypes(os.path.join(path, 'node_types.csv'), ['node_type_id', 'pop_name', 'cell_type', 'model_type', 'model_template'], nodeTypes)
+
+    # nodes (node_id = gid) and edges (sorted by target)
+    cells = sorted(sim.net.allCells, key=lambda cell: cell['gid'])
+    gids = np.array([cell['gid'] for cell in cells], dtype='uint64')
+    numNodes = int(gids.max())+1 if len(gids) else 0
+    edgeTypeIds = OrderedDict()
+    sources, targets, types = [], [], []
+    values = {column: [] for column, key in _edgeColumns}
+    for cell in cells:
+        for conn in cell['conns']:
+            if not isinstance(conn.get('preGid'), Number): continue  # NetStim
+            edgeType = (conn.get('synMech'), conn.get('sec'))
+            if edgeType not in edgeTypeIds: edgeTypeIds[edgeType] = len(edgeTypeIds)
+            sources.append(conn['preGid'])
+            targets.append(cell['gid'])
+            types.append(edgeTypeIds[edgeType])
+            for column, key in _edgeColumns:
+                values[column].append(conn[key] if isinstance(conn.get(key), Number) else np.nan)
+
+    with h5py.File(os.path.join(path, 'nodes.h5'), 'w') as h5file:
+        popGroup = h5file.create_group('nodes/%s' % (_nodePopulation))
+        popGroup.create_dataset('node_id', data=gids)
+        popGroup.create_dataset('node_type_id', data=np.array([popIds[cell['tags']['popLabel']] for cell in cells], dtype='uint64'))
+        popGroup.create_dataset('node_group_id', data=np.zeros(len(cells), dtype='uint32'))
+        popGroup.create_dataset('node_group_index', data=np.arange(len(cells), dtype='uint64'))
+        group = popGroup.create_group('0')
+        for column in _nodeColumns:
+            if any(column in cell['tags'] for cell in cells):
+                group.create_dataset(column, data=np.array([cell['tags'].get(column, np.nan) for cell in cells], dtype='float64'))
+
+    with h5py.File(os.path.join(path, 'edges.h5'), 'w') as h5file:
+        edgePopulation = '%s_to_%s' % (_nodePopulation, _nodePopulation)
+        popGroup = h5file.create_group('edges/%s' % (edgePopulation))
+        targets = np.array(targets, dtype='uint64')
+        popGroup.create_dataset('source_node_id', data=np.array(sources, dtype='uint64')).attrs['node_population'] = _nodePopulation
+        popGroup.create_dataset('target_node_id', data=targets).attrs['node_population'] = _nodePopulation
+        popGroup.create_dataset('edge_type_id', data=np.array(types, dtype='uint64'))
+        popGroup.create_dataset('edge_group_id', data=np.zeros(len(targets), dtype='uint32'))
+        popGroup.create_dataset('edge_group_index', data=np.arange(len(targets), dtype='uint64'))
+        group = popGroup.create_group('0')
+        for column, key in _edgeColumns:
+            group.create_dataset(column, data=np.array(values[column], dtype='float64'))
+        # target index: one range of edges per node (edges sorted by target)
+        index = popGroup.create_group('indices/target_to_source')
+        starts = np.searchsorted(targets, np.arange(numNodes+1, dtype='uint64'))
+        index.create_dataset('range_to_edge_id', data=np.column_stack((starts[:-1], starts[1:])).astype('uint64').reshape((-1, 2)))
+        index.create_dataset('node_id_to_ranges', data=np.column_stack((np.arange(numNodes), np.arange(1, numNodes+1))).astype('uint64').reshape((-1, 2)))
+
+    edgeTypes = [{'edge_type_id': i, 'model_template': synMech, 'sec': sec} for (synMech, sec), i in edgeTypeIds.iteritems()]
+    _writeTypes(os.path.join(path, 'edge_types.csv'), ['edge_type_id', 'model_template', 'sec'], edgeTypes)
+
+    sim.saveJsonStream(sim.replaceFuncObj(sim.net.params.__dict__, copy=True), os.path.join(path, 'netParams.json'))
+    config = {'manifest': {'$NETWORK_DIR': '.'},
+              'networks': {'nodes': [{'nodes_file': '$NETWORK_DIR/nodes.h5', 'node_types_file': '$NETWORK_DIR/node_types.csv'}],
+                           'edges': [{'edges_file': '$NETWORK_DIR/edges.h5', 'edge_types_file': '$NETWORK_DIR/edge_types.csv'}]},
+              'netpyne': {'netpyne_version': sim.version(show=False), 'netParams': '$NETWORK_DIR/netParams.json',
+                          'pops': {popLabel: sim.net.allPops[popLabel]['tags'] for popLabel in popLabels}}}
+    with open(os.path.join(path, 'circuit_config.json'), 'w') as fileObj:
+        json.dump(config, fileObj, indent=2, default=str)
+
+    sim.timing('stop', 'saveSONATATime')
+    print('  Exported %d nodes and %d edges' % (len(cells), len(targets)))
+    if sim.cfg.timing: print('  Done; SONATA export time = %0.2f s.' % sim.timingData['saveSONATATime'])
+    return path
+
+
+###############################################################################
+### Read nodes of SONATA files
+###############################################################################
+def _readNodes (config):
+    ''' Returns list of node populations (dict with name, gid offset, node ids, type ids and node types) of all nodes files,
+        with consecutive gids across populations '''
+    import numpy as np
+    import h5py
+    nodePops, offset = [], 0
+    for files in config['networks'].get('nodes', []):
+        nodeTypes = _readTypes(files['node_types_file'], 'node_type_id')
+        with h5py.File(files['nodes_file'], 'r') as h5file:
+            for name, popGroup in h5file['nodes'].iteritems():
+                typeIds = popGroup['node_type_id'][...]
+                nodeIds = popGroup['node_id'][...].astype('int64') if 'node_id' in popGroup else np.arange(len(typeIds))
+                nodePops.append({'name': name, 'file': files['nodes_file'], 'offset': offset, 'nodeIds': nodeIds,
+                                 'typeIds': typeIds, 'types': nodeTypes})
+                offset += int(nodeIds.max())+1 if len(nodeIds) else 0
+    return nodePops
+
+
+def _popLabel (nodeType, typeId):
+    return nodeType.get('pop_name', nodeType.get('model_name', 'type_%d' % (typeId)))
+
+
+###############################################################################
+### Instantiate network from SONATA files
+###############################################################################
+def loadSONATA (path=None):
+    ''' Instantiates network from SONATA files (circuit config file, or directory with circuit_config.json): each node
+        reads and creates its own cells (as in sim.loadNet()), and reads only the edges targeting them, using the
+        target_to_source index of edge files. One netpyne pop is created per node type; cellParams and synMechParams
+        must be set in netParams (if empty, taken from netParams.json of exported networks). Edge type columns
+        model_template and sec are used as conn synMech and section. Must be called by all nodes after sim.initialize().
+        Default path: cfg.filename+'_sonata' '''
+    import numpy as np
+    import h5py
+    if path is None: path = sim.cfg.filename+'_sonata'
+    sim.timing('start', 'loadSONATATime')
+    config = _loadConfig(path)
+    netpyneConfig = config.get('netpyne', {})
+    if not sim.net.params.cellParams and os.path.exists(netpyneConfig.get('netParams', '')):
+        if sim.rank == 0: print('  Loading netParams from %s' % (netpyneConfig['netParams']))
+        sim.setNetParams(sim.loadJsonStream(netpyneConfig['netParams']))
+
+    # pops (one per node type) and gids of this node
+    nodePops = _readNodes(config)
+    popTags = netpyneConfig.get('pops', {})
+    for nodePop in nodePops:
+        for typeId, nodeType in nodePop['types'].iteritems():
+            popLabel = _popLabel(nodeType, typeId)
+            if popLabel in sim.net.pops: continue
+            tags = dict(popTags.get(popLabel, {'cellType': nodeType.get('cell_type', popLabel),
+                                               'cellModel': nodeType.get('model_template', popLabel).split(':')[-1]}))
+            params = tags.pop('params', None)
+            sim.net.pops[popLabel] = sim.Pop(popLabel, tags)
+            if params is not None: sim.net.pops[popLabel].tags['params'] = params
+    allGids = sorted([gid for nodePop in nodePops for gid in (nodePop['offset'] + nodePop['nodeIds']).tolist()])
+    nodeGids = set(sim.getNodeGids(allGids))
+
+    # create cells of this node
+    for nodePop in nodePops:
+        gids = nodePop['offset'] + nodePop['nodeIds']
+        rows = np.flatnonzero([gid in nodeGids for gid in gids.tolist()])
+        with h5py.File(nodePop['file'], 'r') as h5file:
+            popGroup = h5file['nodes'][nodePop['name']]
+            groupIds = popGroup['node_group_id'][...] if 'node_group_id' in popGroup else np.zeros(len(gids), dtype='uint32')
+            groupIndex = popGroup['node_group_index'][...] if 'node_group_index' in popGroup else np.arange(len(gids))
+            columns = _readGroupColumns(popGroup, groupIds[rows], groupIndex[rows])
+        for i, row in enumerate(rows.tolist()):
+            typeId = int(nodePop['typeIds'][row])
+            pop = sim.net.pops[_popLabel(nodePop['types'][typeId], typeId)]
+            tags = {key: value for key, value in pop.tags.iteritems() if key in ['popLabel', 'cellType', 'cellModel']}
+            tags.update({key: float(values[i]) for key, values in columns.iteritems() if key in _nodeColumns and values[i] == values[i]})
+            if 'params' in pop.tags: tags['params'] = pop.tags['params']
+            gid = int(gids[row])
+            cell = pop.cellModelClass(gid, tags)
+            pop.cellGids.append(gid)
+            sim.net.cells.append(cell)
+    sim.net.allCellTags = {}  # gathered from nodes when required
+    sim.pc.barrier()
+
+    # read edges targeting cells of this node and add conns
+    offsets = {nodePop['name']: nodePop['offset'] for nodePop in nodePops}
+    numConns = 0
+    for files in config['networks'].get('edges', []):
+        edgeTypes = _readTypes(files['edge_types_file'], 'edge_type_id')
+        with h5py.File(files['edges_file'], 'r') as h5file:
+            for name, popGroup in h5file['edges'].iteritems():
+                targetOffset = offsets.get(popGroup['target_node_id'].attrs.get('node_population'), 0)
+                sourceOffset = offsets.get(popGroup['source_node_id'].attrs.get('node_population'), 0)
+                localNodeIds = np.array(sorted(gid - targetOffset for gid in sim.net.gid2lid if gid >= targetOffset), dtype='int64')
+
+                # edge ranges of local cells (from target index if available; otherwise read all targets)
+                if 'indices/target_to_source' in popGroup:
+                    nodeRanges = popGroup['indices/target_to_source/node_id_to_ranges'][...]
+                    edgeRanges = popGroup['indices/target_to_source/range_to_edge_id'][...]
+                    localNodeIds = localNodeIds[localNodeIds < len(nodeRanges)]
+                    rangeIds = np.concatenate([np.arange(start, stop) for start, stop in nodeRanges[localNodeIds].tolist()] or [np.zeros(0, dtype='int64')])
+                    ranges = edgeRanges[rangeIds.astype('int64')] if len(rangeIds) else np.zeros((0, 2), dtype='int64')
+                else:
+                    edges = np.flatnonzero(np.in1d(popGroup['target_node_id'][...].astype('int64'), localNodeIds))
+                    ranges = np.column_stack((edges, edges+1))
+
+                for start in xrange(0, len(ranges), _readRanges):
+                    edges = np.concatenate([np.arange(begin, end) for begin, end in ranges[start:start+_readRanges].tolist()] or [np.zeros(0, dtype='int64')]).astype('int64')
+                    if not len(edges): continue
+                    sources, targets, types = [_readIndices(popGroup[key], edges) for key in ['source_node_id', 'target_node_id', 'edge_type_id']]
+                    groupIds = _readIndices(popGroup['edge_group_id'], edges) if 'edge_group_id' in popGroup else np.zeros(len(edges), dtype='uint32')
+                    groupIndex = _readIndices(popGroup['edge_group_index'], edges) if 'edge_group_index' in popGroup else edges
+                    columns = _readGroupColumns(popGroup, groupIds, groupIndex)
+
+                    for i in xrange(len(edges)):
+                        edgeType = edgeTypes.get(int(types[i]), {})
+                        params = {'preGid': int(sources[i]) + sourceOffset, 'sec': edgeType.get('sec', 'soma'), 'synsPerConn': 1,
+                                  'synMech': edgeType.get('model_template')}
+                        for column, key in _edgeColumns:
+                            value = columns[column][i] if column in columns else float(edgeType[column]) if column in edgeType else None
+                            if value is not None and value == value: params[key] = float(value)
+                        params.setdefault('loc', 0.5)
+                        params.setdefault('weight', sim.net.params.defaultWeight)
+                        params.setdefault('delay', sim.net.params.defaultDelay)
+                        if sim.cfg.includeParamsLabel: params['label'] = name
+                        sim.net.cells[sim.net.gid2lid[int(targets[i]) + targetOffset]].addConn(params=params)
+                    numConns += len(edges)
+
+    sim.pc.barrier()
+    sim.timing('stop', 'loadSONATATime')
+    print('  Node %d: instantiated %d cells and %d conns from SONATA files' % (sim.rank, len(sim.net.cells), numConns))
+    if sim.rank == 0 and sim.cfg.timing: print('  Done; SONATA instantiation time = %0.2f s.' % sim.timingData['loadSONATATime'])
+    return sim.net.cells
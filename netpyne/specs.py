@@ -461,10 +461,22 @@ class SimConfig (object):
         self.addSynMechs = True  # whether to add synaptich mechanisms or not
         self.includeParamsLabel = True  # include label of param rule that created that cell, conn or stim
         self.gatherOnlySimData = False  # omits gathering of net+cell data thus reducing gatherData time 
+        self.skipGather = False  # do not gather data in node 0 after simulating (eg. when only need printPopStats or saveShards)
+        self.gatherBinaryData = False  # gather recorded spikes and traces as contiguous float arrays via pc.alltoall (not pickled); stored as numpy arrays
+        self.nthreads = 1  # num of threads per host; cells distributed across threads based on cost (see cellCostFile)
+        self.spikeCompress = False  # compress spike exchange across hosts: True, False or 'auto' (based on num cells per host and expectedRate)
+        self.queueMode = False  # use bin queue to deliver spikes (fixed time step only): True, False or 'auto' (based on num conns per host and expectedRate)
+        self.expectedRate = 10  # expected avg firing rate (Hz), used to select 'auto' spikeCompress and queueMode settings
+        self.sharedMemory = False  # place connLists, subConn density maps, morphologies and tags of all cells in memory shared by ranks of same node (requires mpi4py)
+        self.cellPartition = 'roundRobin'  # method to distribute cells across hosts ('roundRobin', 'cost', 'spatial' or 'file')
+        self.cellCostFile = None  # file with measured cell costs (saved via sim.saveCellCosts()) used when cellPartition='cost'
+        self.cellPartitionFile = None  # file with gid-to-host map (saved via sim.saveCellPartition()) used when cellPartition='file'
+        self.reportConnTraffic = False  # print num of local vs remote (cross-node) conns in each node after connecting cells
         self.timing = True  # show timing of each process
         self.saveTiming = False  # save timing data to pickle file
         self.printRunTime = False  # print run time at interval (in sec) specified here (eg. 0.1)
         self.printPopAvgRates = False  # print population avg firing rates after run
+        self.printPopStats = False  # calculate (in each node, combined via allreduce) and print pop rates, ISI CV and synchrony after run
         self.verbose = False  # show detailed messages 
 
         # Recording 
@@ -484,8 +496,18 @@ class SimConfig (object):
         self.saveMat = False # save to mat file
         self.saveCSV = False # save to txt file
         self.saveDpk = False # save to .dpk pickled file
+        self.pickleCompression = None # compression of pickle output, streamed while saving and detected when loading (None, 'gzip', 'lz4' or 'zstd')
         self.saveHDF5 = False # save to HDF5 file 
+        self.hdf5Compression = 'gzip' # compression of HDF5 datasets ('gzip', 'lzf' or None)
         self.saveDat = False # save traces to .dat file(s)
+        self.textBlockSize = 1000 # max number of cells (columns) per trace file when saving .dat or .csv (None: all cells in one file)
+        self.saveContainer = False # save to directory (filename_data) with one NumPy file per array and index, split in blocks of gids (allows memory-mapping subsets of gids)
+        self.containerBlockSize = 10000 # number of consecutive gids per block of container
+        self.spikeWriteInterval = None # interval of simulated time (ms) at which each node appends its recorded spikes to filename_spikes_node<rank>.bin and clears them (None: keep all in memory)
+        self.spikeWriteReload = False # read spikes back from file into simData at end of run (so can be gathered and saved as usual); if False, read them via sim.loadSpikes()
+        self.checkpointInterval = None # interval of simulated time (ms) at which sim.saveCheckpoint() saves state of the run to filename_checkpoint, so it can be resumed with sim.loadCheckpoint() (None: no checkpoints)
+        self.saveAsync = False # save output formats in background ('thread' or 'fork') and return immediately; waited for by sim.waitSaveData(), sim.clearAll() and at exit
+        self.saveShards = False # each node saves its own cells and simData to a separate file (pkl, or json if saveJson), plus index file (no gather required)
         self.backupCfgFile = [] # copy cfg file, list with [sourceFile,destFolder] (eg. ['cfg.py', 'backupcfg/'])
         self.saveCellSecs = True  # save all the sections info for each cell (False reduces time+space; available in netParams; prevents re-simulation)
         self.saveCellConns = True  # save all the conns info for each cell (False reduces time+space; prevents re-simulation)
@@ -0,0 +1,146 @@
+"""
+spikeFuncs.py
+
+Contains functions to stream spikes to disk during the simulation: at intervals of simulated time (cfg.spikeWriteInterval),
+each node appends the spikes recorded since the last write to its own binary file (filename_spikes_node<rank>.bin) and
+clears its spike Vectors, so memory does not grow with the duration of the run and spikes already written are kept if
+the run stops. Spike files can be read back as the same spkt/spkid arrays stored in simData.
+
+Contributors: salvadordura@gmail.com
+"""
+
+__all__ = []
+__all__.extend(['writeSpikes', 'loadSpikes'])  # spike files
+
+import os
+import glob
+import sim
+
+
+_spikeDtype = [('t', '<f8'), ('gid', '<i8')]  # record of each spike in file (16 bytes, little-endian)
+_spikeFile = {}  # file of this node being written (keys: 'fileObj', 'filename', 'numSpikes')
+
+
+###############################################################################
+### Helper functions
+###############################################################################
+def _spikeFilename (filename, node):
+    return '%s_spikes_node%d.bin' % (filename, node)
+
+
+def _readSpikeFile (filename):
+    ''' Returns array of spike records in file, ignoring last record if incomplete (eg. if run stopped while writing) '''
+    import numpy as np
+    itemsize = np.dtype(_spikeDtype).itemsize
+    count = os.path.getsize(filename) // itemsize
+    return np.fromfile(filename, dtype=_spikeDtype, count=count)
+
+
+###############################################################################
+### Open spike file of this node
+###############################################################################
+def _openSpikeFile (resumeSize=None):
+    ''' Creates (or truncates) spike file of this node; called by runSim() at start of run if cfg.spikeWriteInterval. When 
+        resuming from a checkpoint, the file is kept up to resumeSize (bytes written when the checkpoint was saved) '''
+    targetFolder = os.path.dirname(sim.cfg.filename)
+    if targetFolder and not os.path.exists(targetFolder):
+        try:
+            os.makedirs(targetFolder)
+        except OSError:
+            if not os.path.exists(targetFolder): print(' Could not create target folder: %s' % (targetFolder))
+    filename = _spikeFilename(sim.cfg.filename, sim.rank)
+    if resumeSize is not None and os.path.exists(filename):
+        fileObj = open(filename, 'r+b')
+        fileObj.truncate(resumeSize)
+        fileObj.seek(resumeSize)
+    else:
+        fileObj = open(filename, 'wb')
+    _spikeFile.update({'fileObj': fileObj, 'filename': filename, 'numSpikes': 0})
+    if sim.rank == 0: print('  Writing spikes every %s ms to %s_spikes_node*.bin' % (sim.cfg.spikeWriteInterval, sim.cfg.filename))
+
+
+###############################################################################
+### Append spikes recorded in this node to file, and clear spike Vectors
+###############################################################################
+def writeSpikes ():
+    ''' Appends spikes recorded in this node since last call to its spike file, and clears the spike Vectors (recording
+        continues in the same Vectors); file is flushed so spikes written are kept if run stops '''
+    import numpy as np
+    if not _spikeFile.get('fileObj') or 'spkt' not in sim.simData: return 0
+    spkt, spkid = sim.simData['spkt'], sim.simData['spkid']
+    numSpikes = int(spkt.size())
+    if numSpikes:
+        records = np.empty(numSpikes, dtype=_spikeDtype)
+        records['t'] = spkt.as_numpy()
+        records['gid'] = spkid.as_numpy()
+        records.tofile(_spikeFile['fileObj'])
+        _spikeFile['fileObj'].flush()
+        _spikeFile['numSpikes'] += numSpikes
+        spkt.resize(0)
+        spkid.resize(0)
+    return numSpikes
+
+
+def _spikeFileSize ():
+    ''' Bytes written to spike file of this node (None if not writing spikes) '''
+    return _spikeFile['fileObj'].tell() if _spikeFile.get('fileObj') else None
+
+
+###############################################################################
+### Close spike file of this node
+###############################################################################
+def _closeSpikeFile ():
+    ''' Writes remaining spikes and closes spike file; if cfg.spikeWriteReload, spikes of this node are read back into
+        simData, so can be gathered, saved and analyzed as usual. Called by runSim() at end of run '''
+    if not _spikeFile.get('fileObj'): return
+    writeSpikes()
+    _spikeFile['fileObj'].close()
+    _spikeFile['fileObj'] = None
+    if getattr(sim.cfg, 'spikeWriteReload', False):
+        records = _readSpikeFile(_spikeFile['filename'])
+        sim.simData['spkt'].from_python(records['t'])
+        sim.simData['spkid'].from_python(records['gid'].astype('float64'))
+    if sim.cfg.verbose: print('  Node %d: wrote %d spikes to %s' % (sim.rank, _spikeFile['numSpikes'], _spikeFile['filename']))
+
+
+###############################################################################
+### Spikes of this node (from simData, or from its spike file if not reloaded)
+###############################################################################
+def _numFileSpikes ():
+    ''' Number of spikes of this node kept only in its spike file (run with cfg.spikeWriteInterval and not
+        cfg.spikeWriteReload), or 0 if spikes are in simData '''
+    if not getattr(sim.cfg, 'spikeWriteInterval', None) or getattr(sim.cfg, 'spikeWriteReload', False): return 0
+    if _spikeFile.get('fileObj') or not _spikeFile.get('filename') or not os.path.exists(_spikeFile['filename']): return 0
+    import numpy as np
+    return os.path.getsize(_spikeFile['filename']) // np.dtype(_spikeDtype).itemsize
+
+
+def _nodeSpikes ():
+    ''' Returns spkt and spkid arrays of the spikes recorded in this node, read from its spike file if not in simData '''
+    import numpy as np
+    if _numFileSpikes():
+        records = _readSpikeFile(_spikeFile['filename'])
+        return records['t'], records['gid'].astype('float64')
+    spkt = sim.simData['spkt'].as_numpy() if 'spkt' in sim.simData else np.array([])
+    spkid = sim.simData['spkid'].as_numpy() if 'spkid' in sim.simData else np.array([])
+    return spkt, spkid
+
+
+###############################################################################
+### Load spikes from spike files of all nodes
+###############################################################################
+def loadSpikes (filename=None, timeRange=None, gids=None):
+    ''' Returns dict with spkt and spkid arrays (sorted by time) of the spike files of all nodes (filename_spikes_node*.bin,
+        written during a run with cfg.spikeWriteInterval), optionally only spikes in timeRange ([start, stop]) and of gids.
+        Default filename: cfg.filename '''
+    import numpy as np
+    if filename is None: filename = sim.cfg.filename
+    files = sorted(glob.glob('%s_spikes_node*.bin' % (filename)))
+    records = [_readSpikeFile(fileName) for fileName in files]
+    records = np.concatenate(records) if records else np.zeros(0, dtype=_spikeDtype)
+    if timeRange is not None:
+        records = records[(records['t'] >= timeRange[0]) & (records['t'] <= timeRange[1])]
+    if gids is not None:
+        records = records[np.in1d(records['gid'], list(gids))]
+    records = records[np.argsort(records['t'], kind='mergesort')]
+    return {'spkt': records['t'], 'spkid': records['gid'].astype('float64')}
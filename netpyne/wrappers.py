@@ -38,7 +38,10 @@ def create (netParams=None, simConfig=None, output=False):
 def simulate ():
     ''' Sequence of commands to simulate network '''
     sim.runSim()                      # run parallel Neuron simulation  
-    sim.gatherData()                  # gather spiking data and cell info from each node
+    if sim.cfg.printPopStats:
+        sim.simData['popStats'] = sim.popStats()  # pop stats calculated in each node and combined (no gather required)
+    if not sim.cfg.skipGather:
+        sim.gatherData()                  # gather spiking data and cell info from each node
     
 
 ###############################################################################
@@ -46,8 +49,11 @@ def simulate ():
 ###############################################################################
 def analyze ():
     ''' Sequence of commands to simulate network '''
-    sim.saveData()                      # run parallel Neuron simulation  
-    sim.analysis.plotData()                  # gather spiking data and cell info from each node
+    if sim.cfg.skipGather:  # data not available in node 0, so can only save shards
+        if sim.cfg.saveShards: sim.saveData()
+    else:
+        sim.saveData()                      # run parallel Neuron simulation  
+        sim.analysis.plotData()                  # gather spiking data and cell info from each node
 
 
 ###############################################################################
@@ -118,7 +124,7 @@ def loadSimulateAnalyze (filename, simConfig=None, output=False):
 ###############################################################################
 # Wrapper to create and export network to NeuroML2
 ###############################################################################
-def createExportNeuroML2 (netParams=None, simConfig=None, reference=None, connections=True, stimulations=True, output=False):
+def createExportNeuroML2 (netParams=None, simConfig=None, reference=None, connections=True, stimulations=True, fileFormat='xml', output=False):
     ''' Sequence of commands to create and export network to NeuroML2 '''
     import __main__ as top
     if not netParams: netParams = top.netParams
@@ -130,7 +136,7 @@ def createExportNeuroML2 (netParams=None, simConfig=None, reference=None, connec
     conns = sim.net.connectCells()                # create connections between cells based on params
     stims = sim.net.addStims()                    # add external stimulation to cells (IClamps etc)
     simData = sim.setupRecording()              # setup variables to record for each cell (spikes, V traces, etc)
-    sim.exportNeuroML2(reference,connections,stimulations)     # export cells and connectivity to NeuroML 2 format
+    sim.exportNeuroML2(reference,connections,stimulations,fileFormat)     # export cells and connectivity to NeuroML 2 format
 
     if output: return (pops, cells, conns, stims, simData)
     